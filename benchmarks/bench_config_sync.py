@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+
+"""
+Replay the recorded Config notifications through the config-sync pipeline offline, and measure the cost.
+
+The pipeline runs in process:
+
+    LambdaSnsTopicSubscriber.lambda_handler
+        → lambda.invoke (routed to LambdaSsmApi.lambda_handler)
+            → DRFAPI (pointed to the local fake shadowsocks-manager server, see fake_ssm.py)
+
+Each fixture in `fixtures/` is a recorded SNS event with the server data (`seed`) it's replayed against.
+Each fixture is replayed twice with the handlers run sequentially to count the calls deterministically:
+`cold` with a new DRFAPI client and `warm` with the client of the cold pass. Then it's replayed once more
+with the default concurrency to measure the wall time only (`concurrent`).
+
+It reports the Lambda invokes, HTTP requests and wall time per fixture, per handler class and per event
+type (CREATE/UPDATE/DELETE), and fails if any count exceeds the baseline in `baseline.json`.
+
+The dependencies of the Lambdas (boto3, requests) must be installed.
+
+Usage:
+    python benchmarks/bench_config_sync.py [--latency SECONDS] [--json] [--verbose] [--update-baseline]
+"""
+
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from unittest import mock
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'lambdas'))
+# the shared module of the Lambda layer, at /opt/python in the Lambda runtime
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'lambdas', 'layers', 'LambdaLayerCommon', 'python'))
+sys.path.insert(0, BENCH_DIR)
+
+import boto3
+import LambdaSsmApi
+import LambdaSnsTopicSubscriber
+import vpn_common
+from fake_ssm import FakeSsmServer
+
+FIXTURES_DIR = os.path.join(BENCH_DIR, 'fixtures')
+SEEDS_DIR = os.path.join(FIXTURES_DIR, 'seeds')
+BASELINE_FILE = os.path.join(BENCH_DIR, 'baseline.json')
+
+LAMBDA_SSM_API_ARN = 'arn:aws:lambda:us-east-1:123456789012:function:LambdaSsmApi'
+
+
+class Stats(object):
+    """
+    The counters of the Lambda invokes and the per handler cost of a pass.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.lock = threading.Lock()
+        self.invokes = 0
+        self.handlers = defaultdict(lambda: dict(invokes=0, http=0, elapsed=0.0, calls=0))
+
+    @property
+    def http(self):
+        return self.server.request_count
+
+    def snapshot(self):
+        return self.invokes, self.http, time.time()
+
+
+class FakeLambdaClient(object):
+    """
+    Route the invokes of the Lambda of SSM API to LambdaSsmApi.lambda_handler in process.
+    """
+
+    def __init__(self, stats_ref):
+        # the client is cached by the Lambdas, so the stats of the current pass are looked up at each invoke
+        self.stats_ref = stats_ref
+
+    def invoke(self, FunctionName, Payload, **kwargs):
+        if FunctionName != LAMBDA_SSM_API_ARN:
+            raise RuntimeError('unexpected Lambda function: {}'.format(FunctionName))
+        stats = self.stats_ref[0]
+        with stats.lock:
+            stats.invokes += 1
+        result = LambdaSsmApi.lambda_handler(json.loads(Payload), None)
+        return {'StatusCode': 200, 'Payload': io.BytesIO(json.dumps(result).encode())}
+
+
+def instrument_handlers(stats_ref):
+    """
+    Wrap the create/update/delete of the handler classes to count the cost per handler class.
+
+    The cost is the delta of the counters around the outermost call, which is exact only if the handlers
+    run sequentially.
+    """
+    local = threading.local()
+
+    def wrap(func):
+        def wrapper(self, *args, **kwargs):
+            if getattr(local, 'depth', 0):
+                return func(self, *args, **kwargs)
+            stats = stats_ref[0]
+            local.depth = 1
+            start = stats.snapshot()
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                local.depth = 0
+                end = stats.snapshot()
+                cost = stats.handlers[type(self).__name__]
+                cost['invokes'] += end[0] - start[0]
+                cost['http'] += end[1] - start[1]
+                cost['elapsed'] += end[2] - start[2]
+                cost['calls'] += 1
+        return wrapper
+
+    patches = []
+    for obj in vars(LambdaSnsTopicSubscriber).values():
+        if isinstance(obj, type) and issubclass(obj, LambdaSnsTopicSubscriber.Handler):
+            for action in ['create', 'update', 'delete']:
+                if action in vars(obj):
+                    patches.append(mock.patch.object(obj, action, wrap(vars(obj)[action])))
+    return patches
+
+
+def load_fixtures():
+    fixtures = {}
+    for path in sorted(glob.glob(os.path.join(FIXTURES_DIR, '*.json'))):
+        with open(path) as f:
+            fixture = json.load(f)
+        seed = {}
+        if fixture.get('seed'):
+            with open(os.path.join(SEEDS_DIR, '{}.json'.format(fixture['seed']))) as f:
+                seed = json.load(f)
+        fixture['seed_data'] = seed
+        fixture['change_type'] = json.loads(
+            fixture['event']['Records'][0]['Sns']['Message'])['configurationItemDiff']['changeType']
+        fixtures[os.path.basename(path)[:-len('.json')]] = fixture
+    return fixtures
+
+
+def replay(fixture, server, stats_ref, cold, sequential, verbose):
+    server.reset(fixture['seed_data'])
+    server.reset_counters()
+    stats = stats_ref[0] = Stats(server)
+    if cold:
+        LambdaSsmApi._api_clients.clear()
+
+    env = dict(HANDLER_MAX_WORKERS='1', RESOURCE_MAX_WORKERS='1') if sequential else {}
+    output = io.StringIO()
+    start = time.time()
+    error = None
+    with mock.patch.dict(os.environ, env), \
+            contextlib.redirect_stdout(sys.stdout if verbose else output):
+        try:
+            LambdaSnsTopicSubscriber.lambda_handler(json.loads(json.dumps(fixture['event'])), None)
+        except Exception as e:
+            error = '{}: {}'.format(type(e).__name__, e)
+    return dict(
+        invokes=stats.invokes,
+        http=stats.http,
+        wall=time.time() - start,
+        error=error,
+        handlers={name: dict(cost) for name, cost in stats.handlers.items()},
+    )
+
+
+def run(latency, verbose):
+    server = FakeSsmServer(latency=latency).start()
+    env = {
+        'LAMBDA_SSM_API_ARN': LAMBDA_SSM_API_ARN,
+        'SSM_SCHEME': 'http',
+        'SSM_HOST': server.host,
+        'SSM_ADMIN_USERNAME': server.username,
+        'SSM_ADMIN_PASSWORD': server.password,
+        'SSM_CSRF_ENABLED': 'true',
+    }
+    stats_ref = [None]
+    lambda_client = FakeLambdaClient(stats_ref)
+
+    def client(service_name, *args, **kwargs):
+        if service_name != 'lambda':
+            raise RuntimeError('unexpected AWS client in the benchmark: {}'.format(service_name))
+        return lambda_client
+
+    results = {}
+    # the cached AWS clients are dropped, so the fake is created and never outlives the run
+    patches = [mock.patch.dict(os.environ, env), mock.patch.object(boto3, 'client', client),
+               mock.patch.dict(vpn_common._clients, clear=True)]
+    patches += instrument_handlers(stats_ref)
+    with contextlib.ExitStack() as stack:
+        for patch in patches:
+            stack.enter_context(patch)
+        try:
+            for name, fixture in load_fixtures().items():
+                results[name] = dict(
+                    change_type=fixture['change_type'],
+                    cold=replay(fixture, server, stats_ref, cold=True, sequential=True, verbose=verbose),
+                    warm=replay(fixture, server, stats_ref, cold=False, sequential=True, verbose=verbose),
+                    concurrent=replay(fixture, server, stats_ref, cold=False, sequential=False, verbose=verbose),
+                )
+        finally:
+            server.stop()
+    return results
+
+
+def summarize(results):
+    """
+    Aggregate the warm pass per handler class and per event type.
+    """
+    per_handler = defaultdict(lambda: dict(invokes=0, http=0, elapsed=0.0, calls=0))
+    per_type = defaultdict(lambda: dict(events=0, invokes=0, http=0, wall=0.0, wall_concurrent=0.0))
+    for result in results.values():
+        warm = result['warm']
+        for name, cost in warm['handlers'].items():
+            for key in per_handler[name]:
+                per_handler[name][key] += cost[key]
+        agg = per_type[result['change_type']]
+        agg['events'] += 1
+        agg['invokes'] += warm['invokes']
+        agg['http'] += warm['http']
+        agg['wall'] += warm['wall']
+        agg['wall_concurrent'] += result['concurrent']['wall']
+    return dict(per_handler), dict(per_type)
+
+
+def get_counts(results):
+    # the counts compared with the baseline
+    counts = {}
+    for name, result in results.items():
+        counts[name] = {}
+        for pass_name in ['cold', 'warm']:
+            r = result[pass_name]
+            counts[name][pass_name] = dict(
+                invokes=r['invokes'],
+                http=r['http'],
+                handlers={h: dict(invokes=c['invokes'], http=c['http']) for h, c in sorted(r['handlers'].items())},
+            )
+    return counts
+
+
+def compare(counts, baseline):
+    """
+    Return the list of the regressions: the counts greater than the baseline.
+    """
+    regressions = []
+
+    def check(path, current, expected):
+        for key in ['invokes', 'http']:
+            if expected is not None and current[key] > expected.get(key, 0):
+                regressions.append('{} {}: {} > {}'.format(path, key, current[key], expected.get(key, 0)))
+
+    for name, passes in counts.items():
+        for pass_name, current in passes.items():
+            expected = baseline.get(name, {}).get(pass_name)
+            if expected is None:
+                print('WARNING: no baseline for {} {}'.format(name, pass_name))
+                continue
+            check('{} {}'.format(name, pass_name), current, expected)
+            for handler, cost in current['handlers'].items():
+                check('{} {} {}'.format(name, pass_name, handler), cost,
+                      expected.get('handlers', {}).get(handler, dict(invokes=0, http=0)))
+    return regressions
+
+
+def report(results):
+    print('{:<16} {:<7} {:<11} {:>8} {:>6} {:>9}  {}'.format(
+        'fixture', 'type', 'pass', 'invokes', 'http', 'wall(ms)', 'error'))
+    for name, result in results.items():
+        for pass_name in ['cold', 'warm', 'concurrent']:
+            r = result[pass_name]
+            print('{:<16} {:<7} {:<11} {:>8} {:>6} {:>9.1f}  {}'.format(
+                name, result['change_type'], pass_name, r['invokes'], r['http'], r['wall'] * 1000, r['error'] or ''))
+
+    per_handler, per_type = summarize(results)
+    print()
+    print('{:<24} {:>6} {:>8} {:>6} {:>9}'.format('handler (warm)', 'calls', 'invokes', 'http', 'time(ms)'))
+    for name, cost in sorted(per_handler.items()):
+        print('{:<24} {:>6} {:>8} {:>6} {:>9.1f}'.format(
+            name, cost['calls'], cost['invokes'], cost['http'], cost['elapsed'] * 1000))
+
+    print()
+    print('{:<24} {:>6} {:>8} {:>6} {:>9} {:>15}'.format(
+        'event type (warm)', 'events', 'invokes', 'http', 'wall(ms)', 'concurrent(ms)'))
+    for name, agg in sorted(per_type.items()):
+        print('{:<24} {:>6} {:>8} {:>6} {:>9.1f} {:>15.1f}'.format(
+            name, agg['events'], agg['invokes'], agg['http'], agg['wall'] * 1000, agg['wall_concurrent'] * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the config-sync pipeline offline.')
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help='the latency in seconds of each request to the fake server, default: 0.005')
+    parser.add_argument('--json', action='store_true', help='output the results in JSON')
+    parser.add_argument('--verbose', action='store_true', help='show the output of the Lambdas')
+    parser.add_argument('--update-baseline', action='store_true', help='save the counts as the new baseline')
+    args = parser.parse_args()
+
+    results = run(args.latency, args.verbose)
+    if args.json:
+        per_handler, per_type = summarize(results)
+        print(json.dumps(dict(fixtures=results, handlers=per_handler, event_types=per_type), indent=2))
+    else:
+        report(results)
+
+    errors = ['{} {}: {}'.format(name, pass_name, result[pass_name]['error'])
+              for name, result in results.items() for pass_name in ['cold', 'warm', 'concurrent']
+              if result[pass_name]['error']]
+    counts = get_counts(results)
+    if args.update_baseline:
+        with open(BASELINE_FILE, 'w') as f:
+            json.dump(counts, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('\nbaseline saved: {}'.format(BASELINE_FILE))
+        regressions = []
+    else:
+        baseline = {}
+        if os.path.exists(BASELINE_FILE):
+            with open(BASELINE_FILE) as f:
+                baseline = json.load(f)
+        regressions = compare(counts, baseline)
+
+    for line in errors:
+        print('ERROR: {}'.format(line), file=sys.stderr)
+    for line in regressions:
+        print('REGRESSION: {}'.format(line), file=sys.stderr)
+    return 1 if errors or regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
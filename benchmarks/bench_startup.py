@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+
+"""
+Measure the cold start of the Lambdas in `lambdas/`, and enforce the budget in `startup_budget.json`.
+
+Each run is a fresh interpreter, which measures:
+
+    * import_ms: the time of importing the Lambda module.
+    * first_invoke_ms: the time of the first invoke with an offline event of a latency-sensitive path:
+        - LambdaSsmApi: a GET to the local fake shadowsocks-manager server, including the login.
+        - LambdaSnsTopicSubscriber: an UPDATE event that changes nothing to sync.
+        - LambdaLexBot: a dialog turn which validates the instance name against the node listing of the
+          in-memory fake of the SSM API, the fake is loaded before the timer, along with requests.
+        - SsnLambdaSnsTopicSubscriber: a 'changeip' message while the stack is being updated, against a
+          local fake CloudFormation endpoint, including the import of boto3.
+    * the heavy modules loaded by the import and by the first invoke, such as boto3.
+
+The median of the runs is compared with the budget, it fails if any budget is exceeded, or any of the
+`forbidden_modules` of the budget is loaded by the import or the first invoke, or any of the
+`forbidden_import_modules` by the import.
+
+Usage:
+    python benchmarks/bench_startup.py [--runs N] [--json]
+"""
+
+import argparse
+import contextlib
+import http.server
+import importlib
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+LAMBDAS_DIR = os.path.join(BENCH_DIR, '..', 'lambdas')
+# the shared module of the Lambda layer, at /opt/python in the Lambda runtime
+LAYER_DIR = os.path.join(LAMBDAS_DIR, 'layers', 'LambdaLayerCommon', 'python')
+BUDGET_FILE = os.path.join(BENCH_DIR, 'startup_budget.json')
+
+HEAVY_MODULES = ['boto3', 'botocore', 'requests', 'urllib3']
+RESULT_MARKER = 'STARTUP_RESULT:'
+
+
+def invoke_ssm_api(module):
+    from fake_ssm import FakeSsmServer
+    server = FakeSsmServer().start()
+    os.environ.update({
+        'SSM_SCHEME': 'http',
+        'SSM_HOST': server.host,
+        'SSM_ADMIN_USERNAME': server.username,
+        'SSM_ADMIN_PASSWORD': server.password,
+    })
+    try:
+        start = time.perf_counter()
+        result = module.lambda_handler(dict(resource='/shadowsocks/node/', method='get'), None)
+        elapsed = time.perf_counter() - start
+    finally:
+        server.stop()
+    assert result['status_code'] == 200, result
+    return elapsed
+
+
+def invoke_sns_topic_subscriber(module):
+    with open(os.path.join(BENCH_DIR, 'fixtures', 'update-noop.json')) as f:
+        event = json.load(f)['event']
+    start = time.perf_counter()
+    module.lambda_handler(event, None)
+    return time.perf_counter() - start
+
+
+def invoke_lex_bot(module):
+    # the fake SSM API stands for the Lambda of SSM API, it's not part of the cold start of the bot
+    import LambdaSsmApi
+    os.environ['SSM_TRANSPORT'] = 'memory'
+    LambdaSsmApi.get_memory_api().reset({'/shadowsocks/node/': [
+        dict(id=i, name='vpn-{}'.format(i), sns_endpoint='arn:aws:sns:us-east-1:123456789012:vpn-{}'.format(i),
+             is_active=True) for i in range(20)]})
+
+    # the unknown name is validated against the cached listing, then a fresh one
+    event = {
+        'userId': 'bench',
+        'invocationSource': 'DialogCodeHook',
+        'sessionAttributes': {},
+        'currentIntent': {'name': 'GetNewIpForVpnInstance', 'slots': {'VpnInstanceName': 'vpn-99'}},
+    }
+    start = time.perf_counter()
+    result = module.lambda_handler(event, None)
+    elapsed = time.perf_counter() - start
+    assert result['dialogAction']['type'] == 'ElicitSlot', result
+    assert 'vpn-99: the instance name you specified does not exist' in result['dialogAction']['message']['content']
+    return elapsed
+
+
+class FakeCloudFormationHandler(http.server.BaseHTTPRequestHandler):
+    # DescribeStacks of a stack being updated, the only call made before the change is skipped
+    body = (
+        '<DescribeStacksResponse xmlns="http://cloudformation.amazonaws.com/doc/2010-05-15/">'
+        '<DescribeStacksResult><Stacks><member>'
+        '<StackId>arn:aws:cloudformation:us-east-1:123456789012:stack/bench/0</StackId>'
+        '<StackName>bench</StackName><StackStatus>UPDATE_IN_PROGRESS</StackStatus>'
+        '<CreationTime>2024-05-01T08:00:00Z</CreationTime>'
+        '</member></Stacks></DescribeStacksResult>'
+        '<ResponseMetadata><RequestId>bench</RequestId></ResponseMetadata>'
+        '</DescribeStacksResponse>'
+    ).encode()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+def invoke_ssn_topic_subscriber(module):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FakeCloudFormationHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ.update({
+        'AWS_ENDPOINT_URL': 'http://127.0.0.1:{}'.format(server.server_address[1]),
+        'AWS_DEFAULT_REGION': 'us-east-1',
+        'AWS_ACCESS_KEY_ID': 'bench',
+        'AWS_SECRET_ACCESS_KEY': 'bench',
+        'STACK_ID': 'arn:aws:cloudformation:us-east-1:123456789012:stack/bench/0',
+    })
+    event = {'Records': [{'Sns': {'Message': 'change_ip'}}]}
+    try:
+        start = time.perf_counter()
+        result = module.lambda_handler(event, None)
+        elapsed = time.perf_counter() - start
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert result is None, result
+    return elapsed
+
+
+SCENARIOS = {
+    'LambdaSsmApi': invoke_ssm_api,
+    'LambdaSnsTopicSubscriber': invoke_sns_topic_subscriber,
+    'LambdaLexBot': invoke_lex_bot,
+    'SsnLambdaSnsTopicSubscriber': invoke_ssn_topic_subscriber,
+}
+
+
+def child(name):
+    """
+    Run in a fresh interpreter: import the module, invoke it once, and print the result.
+    """
+    sys.path.insert(0, LAMBDAS_DIR)
+    sys.path.insert(0, LAYER_DIR)
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        start = time.perf_counter()
+        module = importlib.import_module(name)
+        import_ms = (time.perf_counter() - start) * 1000
+        import_modules = [m for m in HEAVY_MODULES if m in sys.modules]
+
+        first_invoke_ms = None
+        if name in SCENARIOS:
+            sys.path.insert(0, BENCH_DIR)
+            first_invoke_ms = SCENARIOS[name](module) * 1000
+        invoke_modules = [m for m in HEAVY_MODULES if m in sys.modules]
+
+    print(RESULT_MARKER + json.dumps(dict(
+        import_ms=import_ms,
+        first_invoke_ms=first_invoke_ms,
+        import_modules=import_modules,
+        invoke_modules=invoke_modules,
+    )))
+
+
+def measure(name, runs):
+    samples = []
+    for _ in range(runs):
+        proc = subprocess.run([sys.executable, __file__, '--child', name], capture_output=True, text=True)
+        lines = [line for line in proc.stdout.splitlines() if line.startswith(RESULT_MARKER)]
+        if proc.returncode or not lines:
+            raise RuntimeError('failed to measure {}: {}'.format(name, proc.stderr or proc.stdout))
+        samples.append(json.loads(lines[-1][len(RESULT_MARKER):]))
+
+    first_invokes = [s['first_invoke_ms'] for s in samples if s['first_invoke_ms'] is not None]
+    return dict(
+        import_ms=statistics.median(s['import_ms'] for s in samples),
+        first_invoke_ms=statistics.median(first_invokes) if first_invokes else None,
+        import_modules=samples[-1]['import_modules'],
+        invoke_modules=samples[-1]['invoke_modules'],
+    )
+
+
+def check(name, result, budget):
+    violations = []
+    for key in ['import_ms', 'first_invoke_ms']:
+        if key in budget and result[key] is not None and result[key] > budget[key]:
+            violations.append('{} {}: {:.1f} > {}'.format(name, key, result[key], budget[key]))
+    for module in budget.get('forbidden_modules', []):
+        if module in result['invoke_modules']:
+            violations.append('{} loaded the forbidden module: {}'.format(name, module))
+    for module in budget.get('forbidden_import_modules', []):
+        if module in result['import_modules']:
+            violations.append('{} loaded the forbidden module by the import: {}'.format(name, module))
+    return violations
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the cold start of the Lambdas.')
+    parser.add_argument('--runs', type=int, default=5, help='the number of the fresh interpreters, default: 5')
+    parser.add_argument('--json', action='store_true', help='output the results in JSON')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child)
+        return 0
+
+    with open(BUDGET_FILE) as f:
+        budgets = json.load(f)
+
+    names = sorted(os.path.basename(p)[:-len('.py')] for p in os.listdir(LAMBDAS_DIR) if p.endswith('.py'))
+    results = {name: measure(name, args.runs) for name in names}
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print('{:<30} {:>10} {:>16}  {}'.format('module', 'import(ms)', 'first invoke(ms)', 'heavy modules loaded'))
+        for name, r in results.items():
+            print('{:<30} {:>10.1f} {:>16}  {}'.format(
+                name, r['import_ms'],
+                '-' if r['first_invoke_ms'] is None else '{:.1f}'.format(r['first_invoke_ms']),
+                ','.join(r['invoke_modules'])))
+
+    violations = []
+    for name, result in results.items():
+        if name not in budgets:
+            print('WARNING: no budget for {}'.format(name))
+            continue
+        violations += check(name, result, budgets[name])
+    for line in violations:
+        print('OVER BUDGET: {}'.format(line), file=sys.stderr)
+    return 1 if violations else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+
+"""
+A local in-process stand-in for the shadowsocks-manager REST APIs, used by the benchmarks.
+
+It serves the Django admin login, the DRF token and JWT endpoints, and the DRF collections used by
+the Lambdas:
+
+    /domain/nameserver/, /domain/domain/, /domain/record/, /shadowsocks/node/, /shadowsocks/ssmanager/
+
+The collections support filtering by the query params, including the `<fk>__<field>` lookups through
+the foreign keys. The list is paginated in the DRF limit/offset style if the `limit` or `offset`
+query param is given, otherwise the whole list is returned. Every request sleeps for the configured
+latency and is counted. The query params filter the object of the detail endpoint too, as DRF does.
+
+Usage Example:
+
+server = FakeSsmServer(latency=0.005)
+server.start()
+os.environ['SSM_HOST'] = server.host
+...
+print(server.request_count)
+server.stop()
+"""
+
+import base64
+import copy
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+COLLECTIONS = [
+    '/domain/nameserver/',
+    '/domain/domain/',
+    '/domain/record/',
+    '/shadowsocks/node/',
+    '/shadowsocks/ssmanager/',
+]
+
+# the foreign key fields and the collections they refer to
+RELATIONS = {
+    'nameserver': '/domain/nameserver/',
+    'domain': '/domain/domain/',
+    'record': '/domain/record/',
+    'node': '/shadowsocks/node/',
+}
+
+# the query params of the limit/offset pagination, which are not the filters
+PAGINATION_PARAMS = ['limit', 'offset']
+
+
+class FakeSsmServer(object):
+
+    # the paths of obtaining the DRF token, and obtaining and refreshing the JWT
+    token_path = '/api-token-auth/'
+    jwt_path = '/api/token/'
+    jwt_refresh_path = '/api/token/refresh/'
+
+    def __init__(self, latency=0.0, username='admin', password='password', login_path='/admin/login/',
+                 jwt_ttl=300):
+        self.latency = latency
+        self.username = username
+        self.password = password
+        self.login_path = login_path
+        self.jwt_ttl = jwt_ttl
+
+        self.lock = threading.Lock()
+        self.sessions = set()
+        # the issued tokens to their expiry time, None for the DRF token which never expires
+        self.tokens = {}
+        self.refresh_tokens = set()
+        self.data = {}
+        self.next_id = 1
+        self.request_count = 0
+        self.requests = []
+        self.reset()
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), self._handler_class())
+        self.thread = None
+
+    @property
+    def host(self):
+        return '{}:{}'.format(*self.httpd.server_address)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def reset(self, seed=None):
+        """
+        Reset the data to the seed, which is a dict of the collection path to the list of objects.
+        The sessions are kept, so the clients stay logged in.
+        """
+        with self.lock:
+            self.data = {path: [] for path in COLLECTIONS}
+            for path, objs in copy.deepcopy(seed or {}).items():
+                self.data[path] = objs
+            ids = [obj['id'] for objs in self.data.values() for obj in objs]
+            self.next_id = max(ids, default=0) + 1
+
+    def reset_counters(self):
+        with self.lock:
+            self.request_count = 0
+            self.requests = []
+
+    def issue_jwt(self):
+        def encode(obj):
+            return base64.urlsafe_b64encode(json.dumps(obj).encode()).decode().rstrip('=')
+
+        expires = int(time.time() + self.jwt_ttl)
+        access = '.'.join([encode({'alg': 'none'}), encode({'exp': expires, 'jti': uuid.uuid4().hex}), 'sig'])
+        refresh = uuid.uuid4().hex
+        with self.lock:
+            self.tokens[access] = expires
+            self.refresh_tokens.add(refresh)
+        return access, refresh
+
+    def revoke_tokens(self):
+        with self.lock:
+            self.tokens.clear()
+            self.refresh_tokens.clear()
+
+    def _count(self, method, path):
+        with self.lock:
+            self.request_count += 1
+            self.requests.append((method, path))
+
+    def _split(self, path):
+        # '/domain/record/12/' -> ('/domain/record/', 12)
+        for collection in COLLECTIONS:
+            if path == collection:
+                return collection, None
+            if path.startswith(collection):
+                rest = path[len(collection):].strip('/')
+                if rest.isdigit():
+                    return collection, int(rest)
+        return None, None
+
+    def _get_value(self, obj, lookup):
+        field, _, rest = lookup.partition('__')
+        value = obj.get(field)
+        if rest and field in RELATIONS:
+            related = [o for o in self.data[RELATIONS[field]] if o['id'] == value]
+            return self._get_value(related[0], rest) if related else None
+        return value
+
+    def filter(self, collection, params):
+        objs = self.data[collection]
+        for lookup, values in params.items():
+            if lookup in PAGINATION_PARAMS:
+                continue
+            objs = [obj for obj in objs if str(self._get_value(obj, lookup)) in values]
+        return objs
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status, body=None, cookies=None):
+                content = b'' if body is None else json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                for cookie in cookies or []:
+                    self.send_header('Set-Cookie', cookie)
+                self.end_headers()
+                self.wfile.write(content)
+
+            def _read_body(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                raw = self.rfile.read(length).decode() if length else ''
+                if self.headers.get('Content-Type', '').startswith('application/json'):
+                    return json.loads(raw or 'null')
+                return {k: v[0] for k, v in parse_qs(raw).items()}
+
+            def _is_authenticated(self):
+                keyword, _, token = (self.headers.get('Authorization') or '').partition(' ')
+                if keyword in ['Token', 'Bearer']:
+                    expires = server.tokens.get(token, 0)
+                    return expires is None or expires > time.time()
+                return self._session() in server.sessions
+
+            def _session(self):
+                for item in (self.headers.get('Cookie') or '').split(';'):
+                    name, _, value = item.strip().partition('=')
+                    if name == 'sessionid':
+                        return value
+
+            def _dispatch(self, method):
+                time.sleep(server.latency)
+                url = urlparse(self.path)
+                server._count(method, url.path)
+
+                if url.path == server.login_path:
+                    return self._login(method)
+                if url.path in [server.token_path, server.jwt_path, server.jwt_refresh_path] and method == 'POST':
+                    return self._obtain_token(url.path)
+                if url.path == '/':
+                    return self._send(200, {})
+
+                if not self._is_authenticated():
+                    return self._send(403, {'detail': 'Authentication credentials were not provided.'})
+
+                collection, obj_id = server._split(url.path)
+                if collection is None:
+                    return self._send(404, {'detail': 'Not found.'})
+
+                with server.lock:
+                    return self._crud(method, collection, obj_id, parse_qs(url.query))
+
+            def _login(self, method):
+                if method == 'GET':
+                    return self._send(200, {}, cookies=['csrftoken={}; Path=/'.format(uuid.uuid4().hex)])
+                form = self._read_body()
+                if form.get('username') != server.username or form.get('password') != server.password:
+                    return self._send(200, {'detail': 'Please enter the correct username and password.'})
+                session = uuid.uuid4().hex
+                with server.lock:
+                    server.sessions.add(session)
+                return self._send(200, {}, cookies=['sessionid={}; Path=/'.format(session)])
+
+            def _obtain_token(self, path):
+                body = self._read_body() or {}
+                if path == server.jwt_refresh_path:
+                    if body.get('refresh') not in server.refresh_tokens:
+                        return self._send(401, {'detail': 'Token is invalid or expired'})
+                    access, _ = server.issue_jwt()
+                    return self._send(200, {'access': access})
+
+                if body.get('username') != server.username or body.get('password') != server.password:
+                    return self._send(400, {'non_field_errors': ['Unable to log in with provided credentials.']})
+                if path == server.jwt_path:
+                    access, refresh = server.issue_jwt()
+                    return self._send(200, {'access': access, 'refresh': refresh})
+                token = uuid.uuid4().hex
+                with server.lock:
+                    server.tokens[token] = None
+                return self._send(200, {'token': token})
+
+            def _list(self, collection, params):
+                objs = server.filter(collection, params)
+                if not any(k in params for k in PAGINATION_PARAMS):
+                    return self._send(200, objs)
+
+                limit = int(params.get('limit', [100])[0])
+                offset = int(params.get('offset', [0])[0])
+
+                def link(offset):
+                    query = dict({k: v[0] for k, v in params.items()}, limit=limit, offset=offset)
+                    return 'http://{}{}?{}'.format(server.host, collection, urlencode(query))
+
+                return self._send(200, {
+                    'count': len(objs),
+                    'next': link(offset + limit) if offset + limit < len(objs) else None,
+                    'previous': link(max(offset - limit, 0)) if offset > 0 else None,
+                    'results': objs[offset:offset + limit],
+                })
+
+            def _crud(self, method, collection, obj_id, params):
+                objs = server.data[collection]
+                if obj_id is None:
+                    if method == 'GET':
+                        return self._list(collection, params)
+                    if method == 'POST':
+                        obj = dict(self._read_body() or {}, id=server.next_id)
+                        server.next_id += 1
+                        objs.append(obj)
+                        return self._send(201, obj)
+                    return self._send(405, {'detail': 'Method "{}" not allowed.'.format(method)})
+
+                # DRF filters the object of the detail endpoint by the query params too
+                found = [obj for obj in server.filter(collection, params) if obj['id'] == obj_id]
+                if not found:
+                    return self._send(404, {'detail': 'Not found.'})
+                obj = found[0]
+                if method == 'GET':
+                    return self._send(200, obj)
+                if method in ['PUT', 'PATCH']:
+                    obj.update(self._read_body() or {})
+                    obj['id'] = obj_id
+                    return self._send(200, obj)
+                if method == 'DELETE':
+                    objs.remove(obj)
+                    return self._send(204)
+                return self._send(405, {'detail': 'Method "{}" not allowed.'.format(method)})
+
+            def do_GET(self):
+                self._dispatch('GET')
+
+            def do_POST(self):
+                self._dispatch('POST')
+
+            def do_PUT(self):
+                self._dispatch('PUT')
+
+            def do_PATCH(self):
+                self._dispatch('PATCH')
+
+            def do_DELETE(self):
+                self._dispatch('DELETE')
+
+        return Handler
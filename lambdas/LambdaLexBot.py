@@ -2,41 +2,85 @@
 
 """
 Manage the shadowsocks-manager nodes through AWS Lex Bot.
+
+The invocation is profiled with PROFILE=true, or `"profile": true` in the event of a test invoke, see
+profiled.
 """
 
-import botocore, boto3
 import json
 import logging
 import os
+import re
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import vpn_common
+from vpn_common import LazyJson, get_client, invoke_ssm, profiled
 
 print('Loading function')
 
+# LOG_LEVEL: INFO logs the summaries, DEBUG logs the full payloads
 logger = logging.getLogger()
-logger.setLevel(logging.DEBUG)
+logger.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
 
+# the node list is cached across the warm invocations, indexed by the lowercase node name
+_nodes_cache = {'expires': 0, 'index': {}}
+
+# the session attribute to carry over the node names between the dialog turns
+SESSION_NODES_KEY = 'vpnInstances'
+# the max number of the node names carried over, the session attributes are sent in every turn
+SESSION_NODES_MAX = int(os.getenv('SESSION_NODES_MAX', 100))
+
+# the service dimension of the metrics printed by vpn_common.span
+METRICS_SERVICE = 'LambdaLexBot'
+
+# the id to correlate the metrics of the invocation, it's passed to the SSM API
+_context = {'correlation_id': None}
+
+# the slot values to select all the active nodes
+ALL_INSTANCES = ['all', '*']
+
+
+def span(name, **dimensions):
+    return vpn_common.span(METRICS_SERVICE, name, _context['correlation_id'], **dimensions)
 
-# Helpers to build responses which match the structure of the necessary dialog actions
 
 def call_ssm(**kwargs):
-    config = botocore.config.Config(read_timeout=15, connect_timeout=5, retries={'max_attempts': 2})
-    client = boto3.client('lambda', config=config)
-    print('Calling the Lambda of SSM API with: {}'.format(kwargs))
-    resp = client.invoke(
-        FunctionName=os.getenv('LAMBDA_SSM_API_ARN'),
-        Payload=json.dumps(kwargs)
-    )
-    print('Response: {}'.format(resp))
-    if resp['StatusCode'] >= 400:
-        raise Exception('Failed to invoke the Lambda of SSM API. Response: {}'.format(resp))
-
-    func_resp = json.load(resp['Payload'])
-    print('Response from the SSM API: {}'.format(func_resp))
-    if func_resp['status_code'] >= 400:
-        raise Exception('Failed to call the SSM API. Response: {}'.format(func_resp))
+    payload = dict(kwargs, correlation_id=_context['correlation_id']) if _context['correlation_id'] else kwargs
+    with span('call_ssm', Resource=kwargs.get('resource', ''), Method=kwargs.get('method', '').lower()):
+        func_resp = invoke_ssm(payload)
+        logger.info('Called the SSM API: %s %s, status code: %s',
+                    kwargs.get('method'), kwargs.get('resource'), func_resp['status_code'])
+        if func_resp['status_code'] >= 400:
+            raise Exception('Failed to call the SSM API. Response: {}'.format(func_resp))
 
     return func_resp['body']
 
 
+def iter_ssm(resource, params=None, page_size=None, fields=None):
+    """
+    Yield the objects of a collection page by page, each page is a call of the SSM API.
+
+    The SSM API follows the `next` links of the pagination, so the collection is never loaded as a whole,
+    if the pagination is disabled by the server, the whole collection comes in a single page.
+    """
+    kwargs = dict(resource=resource, method='get', params=params or {}, paginate=True)
+    if page_size:
+        kwargs['limit'] = page_size
+    if fields:
+        kwargs['fields'] = fields
+    while True:
+        page = call_ssm(**kwargs)
+        for obj in page['results']:
+            yield obj
+        if not page['next']:
+            return
+        kwargs['cursor'] = page['next']
+
+
+# Helpers to build responses which match the structure of the necessary dialog actions
+
 def get_slots(intent_request):
     return intent_request['currentIntent']['slots']
 
@@ -92,17 +136,69 @@ def build_validation_result(is_valid, violated_slot, message_content):
 
 
 def get_instances():
-    return call_ssm(resource='/shadowsocks/node/', method='get', params={})
+    return iter_ssm('/shadowsocks/node/', page_size=int(os.getenv('NODE_PAGE_SIZE', 100)),
+                    fields=['name', 'sns_endpoint', 'is_active'])
+
+
+def get_instance_index(force=False):
+    """
+    Get the dict of the lowercase node name to the node, it's cached for `NODE_CACHE_TTL` seconds.
+    `force` refetches the node list anyway.
+
+    It's the only source of the SNS endpoints and the active flags, they're never taken from the
+    session attributes, which the Lex clients can set.
+    """
+    now = time.time()
+    if force or now >= _nodes_cache['expires']:
+        _nodes_cache['index'] = {i['name'].lower(): i for i in get_instances()}
+        _nodes_cache['expires'] = now + int(os.getenv('NODE_CACHE_TTL', 60))
+    return _nodes_cache['index']
+
+
+def carry_over_names(session_attributes, index):
+    # the session attributes must be strings, the names are dropped if there are too many to carry over
+    names = sorted(index)
+    if len(names) <= SESSION_NODES_MAX:
+        session_attributes[SESSION_NODES_KEY] = json.dumps(names)
+    else:
+        session_attributes.pop(SESSION_NODES_KEY, None)
+
+
+def get_instance_names(session_attributes, force=False):
+    """
+    Get the lowercase node names to validate the slots.
+
+    The names are carried over in the session attributes, so the later dialog turns landing on a cold
+    container don't need to refetch the node list. They're only a hint of the validation, a name not
+    carried over is checked by refetching the node list, and the fulfillment resolves the node from
+    `get_instance_index`.
+    """
+    if not force and time.time() >= _nodes_cache['expires']:
+        try:
+            names = json.loads(session_attributes.get(SESSION_NODES_KEY) or 'null')
+        except ValueError:
+            names = None
+        if (isinstance(names, list) and len(names) <= SESSION_NODES_MAX
+                and all(isinstance(name, str) for name in names)):
+            return names
+
+    index = get_instance_index(force)
+    carry_over_names(session_attributes, index)
+    return list(index)
 
 
 def get_sns_endpoint(instance):
-    for i in get_instances() or []:
-        if instance.lower() == i['name'].lower():
-            return i['sns_endpoint']
+    node = get_instance_index().get(instance.lower())
+    if node:
+        return node['sns_endpoint']
 
 
-def validate_instance(instance):
-    names = [i['name'].lower() for i in get_instances() or []]
+def validate_instance(instance, session_attributes):
+    names = get_instance_names(session_attributes)
+    if instance.lower() not in names:
+        # the node may be added after the names are cached
+        names = get_instance_names(session_attributes, force=True)
+
     if instance.lower() not in names:
         return build_validation_result(
             False,
@@ -113,6 +209,59 @@ def validate_instance(instance):
     return build_validation_result(True, None, None)
 
 
+def parse_instances(value):
+    # the instance names are separated by commas or whitespaces
+    return [name for name in re.split(r'[,\s]+', (value or '').strip()) if name]
+
+
+def validate_instances(instances, session_attributes):
+    if [i.lower() for i in instances] in [[a] for a in ALL_INSTANCES]:
+        return build_validation_result(True, None, None)
+
+    names = get_instance_names(session_attributes)
+    if any(i.lower() not in names for i in instances):
+        # the nodes may be added after the names are cached
+        names = get_instance_names(session_attributes, force=True)
+
+    invalid = [i for i in instances if i.lower() not in names]
+    if invalid:
+        return build_validation_result(
+            False,
+            'VpnInstanceNames',
+            '{}: the instance names you specified do not exist, '
+            'the valid instance names are: {}.'.format(','.join(invalid), ','.join(names)))
+
+    return build_validation_result(True, None, None)
+
+
+def publish_change_ip(sns_endpoint):
+    return get_client('sns').publish(TopicArn=sns_endpoint, Message='change_ip')
+
+
+def publish_change_ip_bulk(nodes):
+    """
+    Publish the change_ip message to the SNS endpoints of the nodes concurrently.
+
+    Returns
+    -------
+    dict
+        The dict of the node name to the error message, None if published.
+    """
+    def publish(node):
+        if not node.get('sns_endpoint'):
+            return 'not found the SNS endpoint on this instance'
+        try:
+            publish_change_ip(node['sns_endpoint'])
+        except Exception as e:
+            logger.exception('failed to publish to {}'.format(node['sns_endpoint']))
+            return str(e)
+
+    max_workers = int(os.getenv('SNS_PUBLISH_MAX_WORKERS', 8))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        errors = list(executor.map(publish, nodes))
+    return {node['name']: error for node, error in zip(nodes, errors)}
+
+
 # Functions that control the bot's behavior
 
 def change_ip(intent_request):
@@ -121,44 +270,99 @@ def change_ip(intent_request):
     slots = get_slots(intent_request)
     instance = slots['VpnInstanceName']
     source = intent_request['invocationSource']
+    session_attributes = intent_request.get('sessionAttributes') or {}
 
     if source == 'DialogCodeHook':
         # Perform basic validation on the supplied input slots.
         # Use the elicitSlot dialog action to re-prompt for the first violation detected.
 
         if not instance:
-            return elicit_slot(intent_request['sessionAttributes'],
+            return elicit_slot(session_attributes,
                                intent_request['currentIntent']['name'],
                                slots,
                                'VpnInstanceName',
                                None)
 
-        validation_result = validate_instance(instance)
+        validation_result = validate_instance(instance, session_attributes)
         if not validation_result['isValid']:
-            return elicit_slot(intent_request['sessionAttributes'],
+            return elicit_slot(session_attributes,
                                intent_request['currentIntent']['name'],
                                slots,
                                'VpnInstanceName',
                                validation_result['message'])
 
+        # let Lex go on with the dialog, the later turns validate by the names carried over in the session
+        # attributes, the fulfillment resolves the node from the node listing
+        return delegate(session_attributes, slots)
+
     # Send the SNS message for changing the IP address for the node.
     sns_endpoint = get_sns_endpoint(instance)
     if not sns_endpoint:
-        return close(intent_request['sessionAttributes'],
+        return close(session_attributes,
                      'Failed',
                      {'contentType': 'PlainText',
                       'content': '{}: not found the SNS endpoint on this instance.'.format(instance)})
-    resource = boto3.resource('sns')
-    topic = resource.Topic(sns_endpoint)
-    topic.publish(
-        Message='change_ip'
-    )
-    return close(intent_request['sessionAttributes'],
+    publish_change_ip(sns_endpoint)
+    return close(session_attributes,
                  'Fulfilled',
                  {'contentType': 'PlainText',
                   'content': 'The IP address of instance {} will be replaced with a new one.'.format(instance)})
 
 
+def change_ip_bulk(intent_request):
+    # Performs dialog management and fulfillment for changing IP address of several or all nodes.
+
+    slots = get_slots(intent_request)
+    instances = parse_instances(slots['VpnInstanceNames'])
+    source = intent_request['invocationSource']
+    session_attributes = intent_request.get('sessionAttributes') or {}
+
+    if source == 'DialogCodeHook':
+        if not instances:
+            return elicit_slot(session_attributes,
+                               intent_request['currentIntent']['name'],
+                               slots,
+                               'VpnInstanceNames',
+                               None)
+
+        validation_result = validate_instances(instances, session_attributes)
+        if not validation_result['isValid']:
+            return elicit_slot(session_attributes,
+                               intent_request['currentIntent']['name'],
+                               slots,
+                               'VpnInstanceNames',
+                               validation_result['message'])
+
+        return delegate(session_attributes, slots)
+
+    # resolve the nodes from a single node listing
+    index = get_instance_index()
+    if [i.lower() for i in instances] in [[a] for a in ALL_INSTANCES]:
+        nodes = [node for node in index.values() if node.get('is_active')]
+    else:
+        nodes = [index[i.lower()] for i in instances if i.lower() in index]
+    if not nodes:
+        return close(session_attributes,
+                     'Failed',
+                     {'contentType': 'PlainText',
+                      'content': '{}: not found the instances.'.format(','.join(instances))})
+
+    # Send the SNS messages for changing the IP address for the nodes.
+    errors = publish_change_ip_bulk(nodes)
+    published = [name for name, error in errors.items() if error is None]
+    failed = ['{} ({})'.format(name, error) for name, error in errors.items() if error is not None]
+
+    content = []
+    if published:
+        content.append('The IP address of instances {} will be replaced with new ones.'.format(', '.join(published)))
+    if failed:
+        content.append('Failed to change the IP address of instances: {}.'.format(', '.join(failed)))
+    return close(session_attributes,
+                 'Fulfilled' if published else 'Failed',
+                 {'contentType': 'PlainText',
+                  'content': ' '.join(content)})
+
+
 # Intents
 
 def dispatch(intent_request):
@@ -172,16 +376,20 @@ def dispatch(intent_request):
     # Dispatch to your bot's intent handlers
     if intent_name == 'GetNewIpForVpnInstance':
         return change_ip(intent_request)
+    if intent_name == 'GetNewIpForVpnInstances':
+        return change_ip_bulk(intent_request)
 
     raise Exception('Intent with name ' + intent_name + ' not supported')
 
 
 # Main handler
 
+@profiled
 def lambda_handler(event, context):
     # Route the incoming request based on intent.
     # The JSON body of the request is provided in the event slot.
 
-    logger.info('Received event' + json.dumps(event))
+    logger.debug('Received event: %s', LazyJson(event))
+    _context['correlation_id'] = getattr(context, 'aws_request_id', None) or str(uuid.uuid4())
 
     return dispatch(event)
@@ -3,71 +3,835 @@
 """
 Receive AWS Config events through SNS, update NameServer, Domain, Record, Node, and SSManager
 in shadowsocks-manager.
+
+The entry point `reconcile_handler` syncs the whole fleet in a single pass instead, see its docstring.
+
+The notifications are delivered at least once and out of order. With an event journal configured by
+EVENT_JOURNAL_TABLE (DynamoDB) or EVENT_JOURNAL_SQLITE (the path of a SQLite file, for the tests), the
+configuration items already applied or superseded by a newer one are skipped before any SSM call, and
+a retry only runs the handlers that failed, see EventJournal.
+
+The items over the size limit of SNS are delivered to S3 by AWS Config, with an
+OversizedConfigurationItemChangeNotification pointing to them, which are fetched from S3 and trimmed
+to the fields used by the handlers, see get_oversized_body.
+
+The invocation is profiled with PROFILE=true, or `"profile": true` in the event of a direct invoke, see
+profiled.
 """
 
+import copy
+import functools
+import gzip
 import json
+import logging
 import os
-import botocore, boto3
+import threading
+import time
+import uuid
 from abc import ABC, abstractmethod
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import vpn_common
+from vpn_common import (CircuitBreaker, CircuitOpenError, LazyJson, get_client, invoke_ssm, normalize_path, profiled,
+                        split_members)
 
 print('Loading function')
 
-def call_ssm(**kwargs):
-    config = botocore.config.Config(read_timeout=15, connect_timeout=5, retries={'max_attempts': 2})
-    client = boto3.client('lambda', config=config)
-    print('Calling the Lambda of SSM API with: {}'.format(kwargs))
-    resp = client.invoke(
-        FunctionName=os.getenv('LAMBDA_SSM_API_ARN'),
-        Payload=json.dumps(kwargs)
-    )
-    print('Response: {}'.format(resp))
-    if resp['StatusCode'] >= 400:
-        raise Exception('Failed to invoke the Lambda of SSM API. Response: {}'.format(resp))
-
-    func_resp = json.load(resp['Payload'])
-    print('Response from the SSM API: {}'.format(func_resp))
-    if func_resp['status_code'] >= 400:
-        raise Exception('Failed to call the SSM API. Response: {}'.format(func_resp))
+# LOG_LEVEL: INFO logs the summaries, DEBUG logs the full payloads
+logger = logging.getLogger()
+logger.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+
+# the long names of the AWS regions, the same as the SSM parameters:
+# /aws/service/global-infrastructure/regions/<region>/longName, the unknown regions are looked up in SSM
+REGION_LONG_NAMES = {
+    'af-south-1': 'Africa (Cape Town)',
+    'ap-east-1': 'Asia Pacific (Hong Kong)',
+    'ap-northeast-1': 'Asia Pacific (Tokyo)',
+    'ap-northeast-2': 'Asia Pacific (Seoul)',
+    'ap-northeast-3': 'Asia Pacific (Osaka)',
+    'ap-south-1': 'Asia Pacific (Mumbai)',
+    'ap-south-2': 'Asia Pacific (Hyderabad)',
+    'ap-southeast-1': 'Asia Pacific (Singapore)',
+    'ap-southeast-2': 'Asia Pacific (Sydney)',
+    'ap-southeast-3': 'Asia Pacific (Jakarta)',
+    'ap-southeast-4': 'Asia Pacific (Melbourne)',
+    'ca-central-1': 'Canada (Central)',
+    'ca-west-1': 'Canada West (Calgary)',
+    'eu-central-1': 'Europe (Frankfurt)',
+    'eu-central-2': 'Europe (Zurich)',
+    'eu-north-1': 'Europe (Stockholm)',
+    'eu-south-1': 'Europe (Milan)',
+    'eu-south-2': 'Europe (Spain)',
+    'eu-west-1': 'Europe (Ireland)',
+    'eu-west-2': 'Europe (London)',
+    'eu-west-3': 'Europe (Paris)',
+    'il-central-1': 'Israel (Tel Aviv)',
+    'me-central-1': 'Middle East (UAE)',
+    'me-south-1': 'Middle East (Bahrain)',
+    'sa-east-1': 'South America (Sao Paulo)',
+    'us-east-1': 'US East (N. Virginia)',
+    'us-east-2': 'US East (Ohio)',
+    'us-west-1': 'US West (N. California)',
+    'us-west-2': 'US West (Oregon)',
+}
+
+# the service dimension of the metrics printed by vpn_common.span
+METRICS_SERVICE = 'LambdaSnsTopicSubscriber'
+
+# the fields of the configuration used by the handlers, the oversized items are trimmed to them
+CONFIGURATION_FIELDS = ('instanceId', 'publicIpAddress', 'privateIpAddress', 'state', 'tags')
+
+# the breaker of the SSM API, shared by the calls in the container
+ssm_breaker = CircuitBreaker('ssm-api', threshold=int(os.getenv('SSM_BREAKER_THRESHOLD', 5)),
+                             reset_timeout=float(os.getenv('SSM_BREAKER_RESET_TIMEOUT', 30)))
+
+
+def invoke_ssm_guarded(payload):
+    """
+    Invoke the SSM API through the breaker, the errors and the 5xx responses count as the failures.
+    """
+    ssm_breaker.allow()
+    try:
+        func_resp = invoke_ssm(payload)
+    except Exception:
+        ssm_breaker.record_failure()
+        raise
+    statuses = [r['status_code'] for r in func_resp] if isinstance(func_resp, list) else [func_resp['status_code']]
+    if any(status >= 500 for status in statuses):
+        ssm_breaker.record_failure()
+    else:
+        ssm_breaker.record_success()
+    return func_resp
+
+
+def span(name, correlation_id=None, **dimensions):
+    return vpn_common.span(METRICS_SERVICE, name, correlation_id, **dimensions)
+
+
+def call_ssm(correlation_id=None, **kwargs):
+    # the correlation id is passed to the SSM API, so the metrics of both Lambdas can be correlated
+    payload = dict(kwargs, correlation_id=correlation_id) if correlation_id else kwargs
+    with span('call_ssm', correlation_id,
+              Resource=normalize_path(kwargs.get('resource', '')), Method=kwargs.get('method', '').lower()):
+        func_resp = invoke_ssm_guarded(payload)
+        logger.info('Called the SSM API: %s %s, status code: %s',
+                    kwargs.get('method'), kwargs.get('resource'), func_resp['status_code'])
+        if func_resp['status_code'] >= 400:
+            raise Exception('Failed to call the SSM API. Response: {}'.format(func_resp))
 
     return func_resp['body']
 
 
+def apply_list_options(objs, first=False, limit=None, fields=None):
+    """
+    Apply the list options to a list got without them, the same as the SSM API does.
+    """
+    if fields:
+        objs = [{k: obj.get(k) for k in fields} for obj in objs]
+    if first:
+        return objs[0] if objs else None
+    return objs if limit is None else objs[:limit]
+
+
+def call_ssm_batch(*requests, correlation_id=None):
+    """
+    Call the SSM API with a batch of requests in a single invoke, return the bodies in the same order.
+
+    Each request is a dict of the keyword arguments of `call_ssm`, optionally with `depends_on`:
+    the index(es) of the earlier requests which must succeed before it runs.
+    """
+    if correlation_id:
+        requests = [dict(request, correlation_id=correlation_id) for request in requests]
+    with span('call_ssm_batch', correlation_id):
+        func_resps = invoke_ssm_guarded(list(requests))
+    failed = [(i, r) for i, r in enumerate(func_resps) if r['status_code'] >= 400]
+    if failed:
+        raise Exception('Failed to call the SSM API. Failed requests: {}'.format(failed))
+
+    return [r['body'] for r in func_resps]
+
+
+class SsmCache(object):
+    """
+    A request-scoped read-through cache in front of the GETs of `call_ssm`.
+
+    The GETs are keyed by the resource and the normalized params, the concurrent GETs of the same key share
+    a single call. A write to a resource invalidates the cached GETs of the same collection, and seeds the
+    cache of the written object with the response body, as well as the lookup of the upsert.
+
+    The GETs with the list options `first`, `limit` and `fields` are answered from the cached GET of the
+    same params without the options if any, so the lookups after a write cost no call.
+    """
+
+    def __init__(self, correlation_id=None):
+        self.correlation_id = correlation_id
+        self.hits = 0
+        self.misses = 0
+        self._store = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_collection(resource):
+        # '/domain/record/12/' -> '/domain/record/'
+        parts = resource.strip('/').split('/')
+        if parts[-1].isdigit():
+            parts = parts[:-1]
+        return '/{}/'.format('/'.join(parts))
+
+    @classmethod
+    def get_key(cls, resource, **kwargs):
+        path = '/{}/'.format(resource.strip('/'))
+        kwargs = {k: v for k, v in kwargs.items() if v not in (None, {}, [])}
+        return cls.get_collection(path), path, json.dumps(kwargs, sort_keys=True, default=str)
+
+    def invalidate(self, collection):
+        with self._lock:
+            for key in [k for k in self._store if k[0] == collection]:
+                del self._store[key]
+
+    def seed(self, key, value):
+        future = Future()
+        future.set_result(value)
+        with self._lock:
+            self._store[key] = future
+
+    def call(self, resource, method='get', **kwargs):
+        if method.lower() != 'get':
+            collection = self.get_collection(resource)
+            try:
+                body = call_ssm(resource=resource, method=method, correlation_id=self.correlation_id, **kwargs)
+            finally:
+                self.invalidate(collection)
+            if isinstance(body, dict) and 'id' in body:
+                self.seed(self.get_key('{}{}/'.format(collection, body['id'])), body)
+                if method.lower() in ['upsert', 'answer_set'] and kwargs.get('lookup'):
+                    # the written object is the one found by the lookup params
+                    self.seed(self.get_key(collection, params=kwargs['lookup']), [body])
+            return body
+
+        options = {k: kwargs[k] for k in ['first', 'limit', 'fields'] if k in kwargs}
+        if options and not set(kwargs) & {'paginate', 'cursor'}:
+            base_key = self.get_key(resource, **{k: v for k, v in kwargs.items() if k not in options})
+            with self._lock:
+                base = self._store.get(base_key)
+            if base is not None and base.done() and base.exception() is None and isinstance(base.result(), list):
+                with self._lock:
+                    self.hits += 1
+                return apply_list_options(copy.deepcopy(base.result()), **options)
+
+        key = self.get_key(resource, **kwargs)
+        with self._lock:
+            future = self._store.get(key)
+            owner = future is None
+            if owner:
+                future = self._store[key] = Future()
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        if owner:
+            try:
+                future.set_result(call_ssm(resource=resource, method=method, correlation_id=self.correlation_id,
+                                           **kwargs))
+            except Exception as e:
+                with self._lock:
+                    if self._store.get(key) is future:
+                        del self._store[key]
+                future.set_exception(e)
+
+        # the handlers may modify the result
+        return copy.deepcopy(future.result())
+
+
+class FleetSnapshot(object):
+    """
+    The snapshot of the collections of the SSM API, fetched in bulk for the reconciliation.
+
+    The lists are filtered the same as the SSM API does, by the exact match of the query params, including
+    the `<fk>__<field>` lookups through the foreign keys. The objects created in the dry run get the
+    negative ids, so they can be referred before they exist.
+    """
+
+    collections = [
+        '/domain/nameserver/',
+        '/domain/domain/',
+        '/domain/record/',
+        '/shadowsocks/node/',
+        '/shadowsocks/ssmanager/',
+    ]
+    relations = {
+        'nameserver': '/domain/nameserver/',
+        'domain': '/domain/domain/',
+        'record': '/domain/record/',
+        'node': '/shadowsocks/node/',
+    }
+
+    def __init__(self, data):
+        self.data = data
+        self.lock = threading.RLock()
+        self._next_fake_id = -1
+
+    @classmethod
+    def fetch(cls, correlation_id=None):
+        # all the pages of all the collections in a single invoke
+        bodies = call_ssm_batch(*[dict(resource=c, method='get', limit=None) for c in cls.collections],
+                                correlation_id=correlation_id)
+        return cls(dict(zip(cls.collections, bodies)))
+
+    def _get_value(self, obj, lookup):
+        field, _, rest = lookup.partition('__')
+        value = obj.get(field)
+        if rest and field in self.relations:
+            related = self.get(self.relations[field], value)
+            return self._get_value(related, rest) if related else None
+        return value
+
+    def filter(self, collection, params):
+        return [obj for obj in self.data.setdefault(collection, [])
+                if all(str(self._get_value(obj, k)) == str(v) for k, v in params.items())]
+
+    def get(self, collection, obj_id):
+        found = [obj for obj in self.data.setdefault(collection, []) if obj['id'] == obj_id]
+        return found[0] if found else None
+
+    def save(self, collection, obj):
+        if obj.get('id') is None:
+            obj['id'] = self._next_fake_id
+            self._next_fake_id -= 1
+        objs = self.data.setdefault(collection, [])
+        objs[:] = [o for o in objs if o['id'] != obj['id']] + [obj]
+        return obj
+
+    def remove(self, collection, obj_id):
+        self.data[collection] = [o for o in self.data.setdefault(collection, []) if o['id'] != obj_id]
+
+
+class ReconcileCache(SsmCache):
+    """
+    The cache of the handlers in the reconciliation, which serves the GETs from the fleet snapshot, and
+    skips the writes that change nothing of the snapshot, so only the minimal set of writes is made.
+
+    The other writes are recorded in the plan with the changed fields. In the dry run, they are applied
+    to the snapshot only, otherwise they are made with the SSM API and the snapshot is updated with the
+    responses. The snapshot is shared by the caches of all the instances.
+    """
+
+    def __init__(self, snapshot, dry_run=False, resource_id=None, correlation_id=None):
+        super().__init__(correlation_id)
+        self.snapshot = snapshot
+        self.dry_run = dry_run
+        self.resource_id = resource_id
+        self.plan = []
+
+    def call(self, resource, method='get', **kwargs):
+        method = method.lower()
+        path = '/{}/'.format(resource.strip('/'))
+        collection = self.get_collection(path)
+        obj_id = int(path.strip('/').rsplit('/', 1)[-1]) if path != collection else None
+
+        with self.snapshot.lock:
+            if method == 'get':
+                self.hits += 1
+                if obj_id is not None:
+                    obj = self.snapshot.get(collection, obj_id)
+                    if obj is None:
+                        raise Exception('Failed to call the SSM API. Not found: {}'.format(path))
+                    return copy.deepcopy(obj)
+                options = {k: kwargs[k] for k in ['first', 'limit', 'fields'] if k in kwargs}
+                objs = copy.deepcopy(self.snapshot.filter(collection, kwargs.get('params') or {}))
+                return apply_list_options(objs, **options)
+
+            if obj_id is not None:
+                existing = self.snapshot.get(collection, obj_id)
+            elif method in ['upsert', 'answer_set']:
+                found = self.snapshot.filter(collection, kwargs.get('lookup') or {})
+                existing = found[0] if found else None
+            else:
+                existing = None
+
+            # the write in effect, the answer set is resolved against the snapshot
+            effective = method
+            data = kwargs.get('json') or kwargs.get('data') or {}
+            if method == 'answer_set':
+                field = kwargs.get('field', 'answer')
+                old = split_members(existing.get(field)) if existing else []
+                remove = split_members(','.join(kwargs.get('remove') or []))
+                members = [m for m in old if m not in remove]
+                members += [m for m in split_members(','.join(kwargs.get('add') or [])) if m not in members]
+                if members == old:
+                    return copy.deepcopy(existing)
+                if existing is not None and not members and kwargs.get('delete_empty'):
+                    effective, obj_id, data = 'delete', existing['id'], {}
+                else:
+                    data = dict({} if existing else kwargs.get('json') or {}, **{field: ','.join(members)})
+
+            changes = {k: [existing.get(k) if existing else None, v] for k, v in data.items()
+                       if existing is None or existing.get(k) != v}
+            if existing is not None and effective != 'delete' and not changes:
+                return copy.deepcopy(existing)
+
+            action = 'delete' if effective == 'delete' else 'update' if existing is not None else 'create'
+            entry = dict(instance=self.resource_id, action=action, resource=path, changes=changes)
+            if existing is not None:
+                entry['id'] = existing['id']
+            self.plan.append(entry)
+            logger.info('Reconcile plan: %s', LazyJson(entry))
+
+            if self.dry_run:
+                if effective == 'delete':
+                    self.snapshot.remove(collection, obj_id)
+                    return None
+                obj = self.snapshot.save(collection, dict(copy.deepcopy(existing or {}), **copy.deepcopy(data)))
+                return copy.deepcopy(obj)
+
+        body = call_ssm(resource=resource, method=method, correlation_id=self.correlation_id, **kwargs)
+        with self.snapshot.lock:
+            if effective == 'delete':
+                self.snapshot.remove(collection, obj_id)
+            elif isinstance(body, dict) and 'id' in body:
+                self.snapshot.save(collection, copy.deepcopy(body))
+        return body
+
+
+@profiled
 def lambda_handler(event, context):
+    correlation_id = getattr(context, 'aws_request_id', None) or str(uuid.uuid4())
+
+    records = []
+    for record in event['Records']:
+        try:
+            subject = record['Sns']['Subject']
+            message = record['Sns']['Message']
+            records.append((subject, CICN(json.loads(message), correlation_id=correlation_id)))
+        except ValueError as e:
+            logger.info('skip this record: %s', e)
+
+    # coalesce the notifications of the same resource, only the latest one is processed, in the order of
+    # the capture time, so the previous values are taken from the earliest one of the batch
+    cicns = {}
+    for subject, cicn_inst in sorted(records, key=lambda r: r[1].capture_time):
+        if cicn_inst.resource_id in cicns:
+            cicn_inst = cicn_inst.coalesce(cicns[cicn_inst.resource_id])
+        cicns[cicn_inst.resource_id] = cicn_inst
+        if cicn_inst.change_type != 'DELETE':
+            logger.info('SNS subject: %s', subject)
+            logger.debug('SNS message: %s', LazyJson(cicn_inst.body))
+
+    cicn_insts = []
+    for cicn_inst in cicns.values():
+        if cicn_inst.change_type == 'DELETE':
+            logger.info('skip this event: DELETE %s', cicn_inst.resource_id)
+        else:
+            cicn_insts.append(cicn_inst)
+
     try:
-        subject = event['Records'][0]['Sns']['Subject']
-        message = event['Records'][0]['Sns']['Message']
-        cicn_inst = CICN(json.loads(message))
+        process_cicns(cicn_insts)
+    except CircuitOpenError as e:
+        # fail fast, the asynchronous invocation retries the event later, and then sends it to the
+        # on-failure destination if configured
+        logger.error('The SSM API is unavailable, leave the event to the retry: %s', e)
+        raise
+
+
+class EventJournal(ABC):
+    """
+    The journal of the configuration items applied to the SSM, a record per resource:
+
+        * state_id: the configurationStateId of the latest item seen of the resource.
+        * capture_time: the configurationItemCaptureTime of the item, which orders the items.
+        * handlers: the names of the handlers succeeded for the item.
+        * applied: whether all the handlers succeeded for the item.
+
+    The record is replaced by a newer item only, conditionally in the backend, so the concurrent
+    invocations never step back.
+    """
+
+    def begin(self, resource_id, state_id, capture_time):
+        """
+        Start applying the item, return the names of the handlers already succeeded for it, or None if
+        the item is already applied or superseded, which should be skipped.
+        """
+        record = self.get(resource_id)
+        if record and record['state_id'] == state_id:
+            if record['applied']:
+                logger.info('skip the item already applied: %s %s', resource_id, state_id)
+                return None
+            return set(record['handlers'])
+        if record and record['capture_time'] >= capture_time:
+            logger.info('skip the item superseded by: %s %s', resource_id, record['state_id'])
+            return None
+        if not self.start(resource_id, state_id, capture_time):
+            logger.info('skip the item superseded concurrently: %s %s', resource_id, state_id)
+            return None
+        return set()
 
-        if cicn_inst.change_type == 'DELETE':
-            print('skip this event: ' + subject)
-            return
+    @abstractmethod
+    def get(self, resource_id):
+        pass
 
-        print('Received event: ' + json.dumps(event))
-        print('SNS subject: ' + subject)
-        print('SNS message: ' + message)
-    except ValueError as e:
-        print('skip this event: ' + str(e))
-        return
+    @abstractmethod
+    def start(self, resource_id, state_id, capture_time):
+        # replace the record with the item if it's absent or older, return false otherwise
+        pass
+
+    @abstractmethod
+    def add_handler(self, resource_id, state_id, handler):
+        pass
 
-    cicn_inst.process()
+    @abstractmethod
+    def complete(self, resource_id, state_id):
+        pass
 
 
+class DynamoDBJournal(EventJournal):
+    """
+    The journal in the DynamoDB table with the partition key `resource_id` of the type string.
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self.client = get_client('dynamodb')
+
+    def get(self, resource_id):
+        item = self.client.get_item(TableName=self.table, Key={'resource_id': {'S': resource_id}},
+                                    ConsistentRead=True).get('Item')
+        if item:
+            return dict(
+                state_id=item['state_id']['S'],
+                capture_time=item['capture_time']['S'],
+                handlers=item.get('handlers', {}).get('SS', []),
+                applied=item['applied']['BOOL'],
+            )
+
+    def start(self, resource_id, state_id, capture_time):
+        try:
+            self.client.put_item(
+                TableName=self.table,
+                Item={
+                    'resource_id': {'S': resource_id},
+                    'state_id': {'S': state_id},
+                    'capture_time': {'S': capture_time},
+                    'applied': {'BOOL': False},
+                },
+                ConditionExpression='attribute_not_exists(resource_id) OR capture_time < :t',
+                ExpressionAttributeValues={':t': {'S': capture_time}},
+            )
+            return True
+        except self.client.exceptions.ConditionalCheckFailedException:
+            return False
+
+    def _update(self, resource_id, state_id, expression, values):
+        try:
+            self.client.update_item(
+                TableName=self.table,
+                Key={'resource_id': {'S': resource_id}},
+                UpdateExpression=expression,
+                ConditionExpression='state_id = :s',
+                ExpressionAttributeValues=dict(values, **{':s': {'S': state_id}}),
+            )
+        except self.client.exceptions.ConditionalCheckFailedException:
+            logger.info('the item is superseded while being applied: %s %s', resource_id, state_id)
+
+    def add_handler(self, resource_id, state_id, handler):
+        self._update(resource_id, state_id, 'ADD handlers :h', {':h': {'SS': [handler]}})
+
+    def complete(self, resource_id, state_id):
+        self._update(resource_id, state_id, 'SET applied = :a', {':a': {'BOOL': True}})
+
+
+class SQLiteJournal(EventJournal):
+    """
+    The journal in a local SQLite file, for the tests.
+    """
+
+    def __init__(self, path):
+        import sqlite3
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS journal (resource_id TEXT PRIMARY KEY, state_id TEXT, '
+                          'capture_time TEXT, handlers TEXT, applied INTEGER)')
+
+    def get(self, resource_id):
+        with self._lock:
+            row = self.conn.execute('SELECT state_id, capture_time, handlers, applied FROM journal '
+                                    'WHERE resource_id = ?', (resource_id,)).fetchone()
+        if row:
+            return dict(state_id=row[0], capture_time=row[1], handlers=json.loads(row[2]), applied=bool(row[3]))
+
+    def start(self, resource_id, state_id, capture_time):
+        with self._lock:
+            cursor = self.conn.execute(
+                'INSERT INTO journal VALUES (?, ?, ?, ?, 0) ON CONFLICT (resource_id) DO UPDATE SET '
+                'state_id = excluded.state_id, capture_time = excluded.capture_time, handlers = excluded.handlers, '
+                'applied = 0 WHERE journal.capture_time < excluded.capture_time',
+                (resource_id, state_id, capture_time, '[]'))
+            return cursor.rowcount > 0
+
+    def add_handler(self, resource_id, state_id, handler):
+        with self._lock:
+            row = self.conn.execute('SELECT handlers FROM journal WHERE resource_id = ? AND state_id = ?',
+                                    (resource_id, state_id)).fetchone()
+            if row:
+                handlers = sorted(set(json.loads(row[0])) | {handler})
+                self.conn.execute('UPDATE journal SET handlers = ? WHERE resource_id = ? AND state_id = ?',
+                                  (json.dumps(handlers), resource_id, state_id))
+
+    def complete(self, resource_id, state_id):
+        with self._lock:
+            self.conn.execute('UPDATE journal SET applied = 1 WHERE resource_id = ? AND state_id = ?',
+                              (resource_id, state_id))
+
+
+_journal = {}
+
+
+def get_journal():
+    """
+    Get the event journal configured by the env, None if not configured.
+    """
+    if 'journal' not in _journal:
+        if os.getenv('EVENT_JOURNAL_TABLE'):
+            _journal['journal'] = DynamoDBJournal(os.getenv('EVENT_JOURNAL_TABLE'))
+        elif os.getenv('EVENT_JOURNAL_SQLITE'):
+            _journal['journal'] = SQLiteJournal(os.getenv('EVENT_JOURNAL_SQLITE'))
+        else:
+            _journal['journal'] = None
+    return _journal['journal']
+
+
+def process_cicn(cicn_inst):
+    """
+    Process the notification through the event journal if configured.
+    """
+    journal = get_journal()
+    if journal is None or not cicn_inst.state_id:
+        return cicn_inst.process()
+
+    resource_id, state_id = cicn_inst.resource_id, cicn_inst.state_id
+    done = journal.begin(resource_id, state_id, cicn_inst.capture_time)
+    if done is None:
+        return []
+    results = cicn_inst.process(done=done, on_success=lambda handler: journal.add_handler(resource_id, state_id, handler))
+    journal.complete(resource_id, state_id)
+    return results
+
+
+def process_cicns(cicn_insts):
+    if len(cicn_insts) <= 1:
+        for cicn_inst in cicn_insts:
+            process_cicn(cicn_inst)
+        return
+
+    # the different resources are processed concurrently
+    max_workers = int(os.getenv('RESOURCE_MAX_WORKERS', 4))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(process_cicn, cicn_inst) for cicn_inst in cicn_insts]
+    errors = [future.exception() for future in futures if future.exception()]
+    if errors:
+        raise errors[0]
+
+
+def list_instances(regions):
+    """
+    Yield the region and the instance of the instances with the tag `ConfigHandlerClass` in the regions,
+    the terminated ones are excluded.
+    """
+    filters = [
+        {'Name': 'tag-key', 'Values': ['ConfigHandlerClass']},
+        {'Name': 'instance-state-name', 'Values': ['pending', 'running', 'stopping', 'stopped']},
+    ]
+    for region in regions:
+        paginator = get_client('ec2', region).get_paginator('describe_instances')
+        for page in paginator.paginate(Filters=filters):
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    yield region, instance
+
+
+@profiled
+def reconcile_handler(event, context):
+    """
+    Sync the whole fleet with the SSM in a single pass, which recovers from the lost or failed notifications.
+
+    The instances with the tag `ConfigHandlerClass` are listed in the regions, each one becomes a synthetic
+    CREATE notification processed by the same handlers, but through a ReconcileCache: the GETs are served
+    from the snapshot of all the collections fetched in bulk, and only the writes changing something are
+    made. The active nodes of the regions and the account but not found in the fleet are deactivated. At
+    last, the IPs of no active node are removed from the shared records, see get_stale_answers, so list
+    all the regions of the nodes sharing a domain in `regions`. The nodes of the other accounts are never
+    deactivated, and the records shared with them are left as is.
+
+    Parameters
+    ----------
+    event : dict
+        dry_run : bool
+            Only compute and return the plan, default: false.
+        regions : list
+            The regions to list the instances, default: the env RECONCILE_REGIONS (comma separated), or
+            the region of the Lambda.
+
+    Returns
+    -------
+    dict
+        The plan of the writes: `instance`, `action` (create, update or delete), `resource`, `id` and the
+        `changes` of the fields in [old, new], as well as the number of the instances and the errors.
+    """
+    event = event or {}
+    correlation_id = getattr(context, 'aws_request_id', None) or str(uuid.uuid4())
+    dry_run = bool(event.get('dry_run'))
+    regions = event.get('regions') or [
+        r.strip() for r in (os.getenv('RECONCILE_REGIONS') or os.getenv('AWS_REGION', '')).split(',') if r.strip()]
+
+    snapshot = FleetSnapshot.fetch(correlation_id)
+    cicn_insts = []
+    for region, instance in list_instances(regions):
+        cicn_inst = CICN.from_instance(region, instance, correlation_id=correlation_id)
+        cicn_inst.ssm_cache = ReconcileCache(snapshot, dry_run=dry_run, resource_id=cicn_inst.resource_id,
+                                             correlation_id=correlation_id)
+        cicn_insts.append(cicn_inst)
+    logger.info('Reconciling %s instances in the regions: %s, dry run: %s', len(cicn_insts), regions, dry_run)
+
+    max_workers = int(os.getenv('RECONCILE_MAX_WORKERS', 4))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {cicn_inst.resource_id: executor.submit(cicn_inst.process) for cicn_inst in cicn_insts}
+    errors = [dict(instance=resource_id, error=str(future.exception()))
+              for resource_id, future in futures.items() if future.exception()]
+
+    # the nodes of the reconciled regions and account that are no longer in the fleet
+    names = {cicn_inst.tags.get('Name') for cicn_inst in cicn_insts if NodeHandler in (cicn_inst.handlers or [])}
+    locations = {get_long_region_name(region) for region in regions}
+    account_id = get_account_id()
+    cache = ReconcileCache(snapshot, dry_run=dry_run, correlation_id=correlation_id)
+    for node in copy.deepcopy(snapshot.filter(NodeHandler.api_path, {})):
+        if node.get('is_active') and is_reconciled(node, locations, account_id) and node.get('name') not in names:
+            try:
+                cache.call(resource='{}{}/'.format(NodeHandler.api_path, node['id']), method='put',
+                           json=dict(node, is_active=False))
+            except Exception as e:
+                errors.append(dict(instance=None, error=str(e)))
+
+    # the instances only add their IPs to the shared records, remove the IPs of no active node
+    for (fqdn, record_type), stale in get_stale_answers(snapshot, locations, account_id).items():
+        try:
+            cache.call(resource=RecordHandler.api_path, method='answer_set', lookup=dict(fqdn=fqdn, type=record_type),
+                       remove=stale, delete_empty=True)
+        except Exception as e:
+            errors.append(dict(instance=None, error=str(e)))
+
+    plan = [entry for cicn_inst in cicn_insts for entry in cicn_inst.ssm_cache.plan] + cache.plan
+    logger.info('Reconciled %s instances, planned writes: %s, errors: %s', len(cicn_insts), len(plan), len(errors))
+    return dict(dry_run=dry_run, regions=regions, instances=len(cicn_insts), plan=plan, errors=errors)
+
+
+def get_account_id():
+    # the account of the instances listed by describe_instances
+    return get_client('sts').get_caller_identity()['Account']
+
+
+def is_reconciled(node, locations, account_id):
+    """
+    Tell whether the node is covered by the reconciliation: located in one of the reconciled regions,
+    and owned by the reconciled account, by the account id in the ARN of its SNS endpoint. The node stacks
+    in the other accounts are not listed by describe_instances, so their nodes are never touched.
+    """
+    arn = (node.get('sns_endpoint') or '').split(':')
+    return node.get('location') in locations and len(arn) > 4 and arn[4] == account_id
+
+
+def get_stale_answers(snapshot, locations, account_id):
+    """
+    Get the dict of the (fqdn, type) of the shared records to the IPs in their answers that are not the
+    public IP of any active node using the record, such as the IP left by a lost rotation.
+
+    Only the records all the nodes of which are reconciled are checked, see is_reconciled, the IPs of the
+    nodes of the other regions or accounts are not known for sure.
+    """
+    with snapshot.lock:
+        nodes = copy.deepcopy(snapshot.filter(NodeHandler.api_path, {}))
+        records = copy.deepcopy(snapshot.filter(RecordHandler.api_path, {}))
+
+    stale_answers = {}
+    for record in records:
+        users = [node for node in nodes if node.get('record') == record['id']]
+        if not users or not all(is_reconciled(node, locations, account_id) for node in users):
+            continue
+        active = {node.get('public_ip') for node in users if node.get('is_active')}
+        stale = [answer for answer in split_members(record.get('answer')) if answer not in active]
+        if stale:
+            stale_answers[(record['fqdn'], record['type'])] = stale
+    return stale_answers
+
+
+@functools.lru_cache(maxsize=None)
 def get_long_region_name(region):
     # get the long name of AWS region
-    client = boto3.client('ssm')
+    if region in REGION_LONG_NAMES:
+        return REGION_LONG_NAMES[region]
+
+    client = get_client('ssm')
     resp = client.get_parameter(
         Name='/aws/service/global-infrastructure/regions/{region}/longName'.format(region=region))
     return resp['Parameter']['Value']
 
 
+def trim_configuration(configuration):
+    return {k: v for k, v in (configuration or {}).items() if k in CONFIGURATION_FIELDS}
+
+
+def get_oversized_body(body):
+    """
+    Get the notification of the oversized item from S3, which is the same as the notification delivered
+    by SNS otherwise, with the configurations trimmed to CONFIGURATION_FIELDS.
+
+    The object is decompressed while being read from the stream, so the compressed object is not held
+    in memory, but json.load reads the decompressed document as a whole before parsing it, the memory
+    peaks at about the decompressed size plus the parsed objects. Only the trimmed item is kept after.
+    """
+    delivery = body.get('s3DeliverySummary') or {}
+    if delivery.get('errorCode') or not delivery.get('s3BucketLocation'):
+        raise ValueError('the oversized item is not delivered to S3: {}: {}.'.format(
+            delivery.get('errorCode'), delivery.get('errorMessage')))
+
+    bucket, _, key = delivery['s3BucketLocation'].partition('/')
+    region = (body.get('configurationItemSummary') or {}).get('awsRegion')
+    stream = get_client('s3', region_name=region).get_object(Bucket=bucket, Key=key)['Body']
+    if key.endswith('.gz'):
+        stream = gzip.GzipFile(fileobj=stream)
+    try:
+        full = json.load(stream)
+    finally:
+        stream.close()
+
+    item = dict(full['configurationItem'])
+    item['configuration'] = trim_configuration(item.get('configuration'))
+    item['supplementaryConfiguration'] = {
+        k: v for k, v in (item.get('supplementaryConfiguration') or {}).items() if k == 'Tags'}
+    item.pop('relationships', None)
+    diff_item = full['configurationItemDiff']
+    prop = diff_item['changedProperties'].get('Configuration')
+    if prop and 'previousValue' in prop:
+        changed_properties = dict(diff_item['changedProperties'], Configuration=dict(
+            prop, previousValue=trim_configuration(prop['previousValue'])))
+        diff_item = dict(diff_item, changedProperties=changed_properties)
+    return dict(full, configurationItem=item, configurationItemDiff=diff_item)
+
+
 class CICN(object):
     # Configuration Item Change Notification
     type = 'ConfigurationItemChangeNotification'
+    oversized_type = 'OversizedConfigurationItemChangeNotification'
+
+    # the handlers read the properties many times, which are computed once and kept in `_memo`,
+    # `_memo` is cleared when the diff is changed by coalesce
+    __slots__ = ('body', 'diff_item', 'item', 'change_type', 'resource_type', 'resource_id', 'correlation_id',
+                 'ssm_cache', '_memo')
 
-    def __init__(self, body):
+    def __init__(self, body, correlation_id=None):
         if not isinstance(body, dict):
             raise ValueError('expect: {} for body, found: {}.'.format(dict, type(body)))
 
+        if body.get('messageType') == self.oversized_type:
+            body = get_oversized_body(body)
         self.body = body
         if self.type != body.get('messageType'):
             raise ValueError('expect message type: {}, found: {}.'.format(self.type, body.get('messageType')))
@@ -76,41 +840,253 @@ class CICN(object):
         self.item = body['configurationItem']
         self.change_type = self.diff_item['changeType']
         self.resource_type = self.item['resourceType']
-        self.resource = self._resource
+        self.resource_id = self.item['resourceId']
+        self.correlation_id = correlation_id or str(uuid.uuid4())
+        self.ssm_cache = SsmCache(self.correlation_id)
+        self._memo = {}
+
+    def _memoize(self, name, func):
+        if name not in self._memo:
+            self._memo[name] = func()
+        return self._memo[name]
+
+    @classmethod
+    def from_instance(cls, region, instance, correlation_id=None):
+        """
+        Build a CREATE notification of the instance from the output of EC2 describe_instances.
+        """
+        return cls({
+            'messageType': cls.type,
+            'configurationItemDiff': {'changeType': 'CREATE', 'changedProperties': {}},
+            'configurationItem': {
+                'resourceType': 'AWS::EC2::Instance',
+                'resourceId': instance['InstanceId'],
+                'awsRegion': region,
+                'configurationItemCaptureTime': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime()),
+                'configuration': {
+                    'instanceId': instance['InstanceId'],
+                    'publicIpAddress': instance.get('PublicIpAddress'),
+                    'privateIpAddress': instance.get('PrivateIpAddress'),
+                    'state': {'name': instance['State']['Name']},
+                    'tags': [{'key': t['Key'], 'value': t['Value']} for t in instance.get('Tags', [])],
+                },
+            },
+        }, correlation_id=correlation_id)
+
+    @property
+    def state_id(self):
+        # a JSON number in the notifications of AWS Config, the journal keeps it as a string
+        state_id = self.item.get('configurationStateId')
+        return None if state_id is None else str(state_id)
+
+    @property
+    def capture_time(self):
+        # in the ISO 8601 format of the same timezone, comparable as the string
+        return self.item.get('configurationItemCaptureTime') or ''
+
+    def coalesce(self, other):
+        """
+        Coalesce with the other notification of the same resource, return the latest one of the two,
+        with the changed properties of both merged, so no change is lost by skipping the earlier one.
+        The notifications are coalesced in the order of the capture time, the previous values of the
+        merged ones are taken from the earlier one.
+        """
+        latest, earlier = (self, other) if self.capture_time >= other.capture_time else (other, self)
+
+        changed_properties = dict(earlier.diff_item['changedProperties'])
+        for name, prop in latest.diff_item['changedProperties'].items():
+            if name in changed_properties and 'previousValue' in changed_properties[name]:
+                prop = dict(prop, previousValue=changed_properties[name]['previousValue'])
+            changed_properties[name] = prop
+        latest.diff_item = dict(latest.diff_item, changedProperties=changed_properties)
+
+        # the resource created in the same batch needs a full sync
+        if earlier.change_type == 'CREATE' and latest.change_type == 'UPDATE':
+            latest.change_type = 'CREATE'
+        latest._memo.clear()
+        return latest
 
     @property
     def handlers(self):
-        cls_name = self.tags.get('ConfigHandlerClass')
-        if cls_name:
-            return [globals().get(name) for name in cls_name.split(',')]
+        def get_handlers():
+            cls_name = self.tags.get('ConfigHandlerClass')
+            if cls_name:
+                return [globals().get(name) for name in cls_name.split(',')]
+        return self._memoize('handlers', get_handlers)
 
     @property
-    def _resource(self):
-        if self.change_type in ['CREATE', 'UPDATE']:
-            result = self.item['configuration']
-            result.update(self.item.get('supplementaryConfiguration', {}))
-            return result
-        elif self.change_type == 'DELETE':
-            result = self.diff_item['changedProperties']['Configuration']['previousValue']
-            result.update(
-                self.diff_item['changedProperties'].get('SupplementaryConfiguration.Tags', {}).get('previousValue', {}))
-            return result
-        else:
-            return
+    def resource(self):
+        """
+        The configuration merged with the supplementary configuration, a new dict leaving the payload intact.
+        """
+        def get_resource():
+            if self.change_type in ['CREATE', 'UPDATE']:
+                result = dict(self.item['configuration'])
+                result.update(self.item.get('supplementaryConfiguration', {}))
+                return result
+            elif self.change_type == 'DELETE':
+                changed_properties = self.diff_item['changedProperties']
+                result = dict(changed_properties['Configuration']['previousValue'])
+                result.update(changed_properties.get('SupplementaryConfiguration.Tags', {}).get('previousValue', {}))
+                return result
+        return self._memoize('resource', get_resource)
 
     @property
     def tags(self):
-        tags = self.resource.get('tags') or self.resource.get('Tags')
-        return {item['key']: item['value'] for item in tags or []}
+        def get_tags():
+            tags = self.resource.get('tags') or self.resource.get('Tags')
+            return {item['key']: item['value'] for item in tags or []}
+        return self._memoize('tags', get_tags)
 
     def is_changed(self, name):
         return self.diff_item['changedProperties'].get(name, {}).get('changeType') == 'UPDATE'
 
-    def process(self):
-        for handler_cls in self.handlers or []:
-            handler_inst = handler_cls(self)
-            result = getattr(handler_inst, self.change_type.lower())()
-            print(self.change_type, handler_cls, result)
+    @property
+    def changed_paths(self):
+        """
+        The lowercase paths of the changed properties relative to the configuration, the tags are excluded.
+
+        'Configuration.State.Name' -> 'state.name', 'Configuration' -> ''
+        """
+        def get_paths():
+            paths = set()
+            for name in self.diff_item['changedProperties']:
+                path = name.lower()
+                for prefix in ['configuration', 'supplementaryconfiguration']:
+                    if path == prefix or path.startswith(prefix + '.'):
+                        path = path[len(prefix) + 1:]
+                        break
+                if path.split('.')[0] != 'tags':
+                    paths.add(path)
+            return paths
+        return self._memoize('changed_paths', get_paths)
+
+    @property
+    def changed_tag_keys(self):
+        """
+        The keys of the changed tags, contains '*' if the changed keys can't be told from the diff.
+        """
+        def get_keys(value):
+            if isinstance(value, dict) and 'key' in value:
+                return {value['key']}
+            elif isinstance(value, dict):
+                return set(value)
+            elif isinstance(value, list):
+                return {item['key'] for item in value if isinstance(item, dict) and 'key' in item}
+            return set()
+
+        def get_changed_keys():
+            keys = set()
+            for name, prop in self.diff_item['changedProperties'].items():
+                if name.lower() in ['configuration', 'supplementaryconfiguration']:
+                    # the tags are a part of the whole configuration changed
+                    keys.add('*')
+                    continue
+                if name.lower().split('.')[-1].isdigit():
+                    name = name.rsplit('.', 1)[0]
+                if name.lower().split('.')[-1] != 'tags':
+                    continue
+                changed = get_keys(prop.get('previousValue')) | get_keys(prop.get('updatedValue'))
+                keys |= changed or {'*'}
+            return keys
+        return self._memoize('changed_tag_keys', get_changed_keys)
+
+    def is_affected(self, handler_cls):
+        """
+        Tell whether the inputs of the handler are changed by this event, always true except for UPDATE.
+        """
+        if self.change_type != 'UPDATE':
+            return True
+        if not handler_cls.config_paths and not handler_cls.tag_keys:
+            return True
+
+        changed_paths = self.changed_paths
+        for path in (p.lower() for p in handler_cls.config_paths):
+            for changed in changed_paths:
+                # the whole configuration, the path itself, a child or a parent of the path is changed
+                if not changed or changed == path or changed.startswith(path + '.') or path.startswith(changed + '.'):
+                    return True
+
+        changed_tag_keys = self.changed_tag_keys
+        return bool(changed_tag_keys & ({'*', 'ConfigHandlerClass'} | set(handler_cls.tag_keys)))
+
+    def process(self, max_workers=None, done=(), on_success=None):
+        """
+        Run the handlers, the independent ones run concurrently, the dependent ones run after their dependencies.
+
+        The handlers named in `done` are skipped as succeeded, `on_success` is called with the name of each
+        handler succeeded.
+
+        Returns
+        -------
+        list
+            The dict of handler, result, error and elapsed seconds for each handler, in the scheduled order.
+        """
+        max_workers = max_workers or int(os.getenv('HANDLER_MAX_WORKERS', 4))
+        action = self.change_type.lower()
+        handler_classes = [cls for cls in self.handlers or [] if self.is_affected(cls)]
+        skipped = [cls.__name__ for cls in self.handlers or [] if cls not in handler_classes]
+        if skipped:
+            logger.info('skip the handlers whose inputs are not changed: %s', skipped)
+        if done:
+            logger.info('skip the handlers already succeeded: %s', sorted(done))
+            handler_classes = [cls for cls in handler_classes if cls.__name__ not in done]
+        handler_classes = sort_handlers(handler_classes)
+        futures = {}
+
+        def run(handler_cls):
+            for dep in handler_cls.depends_on:
+                if dep in futures and futures[dep].result()['error']:
+                    error = 'skipped due to the failure of the dependency: {}'.format(dep)
+                    logger.warning('%s %s %s', self.change_type, handler_cls.__name__, error)
+                    return dict(handler=handler_cls.__name__, result=None, error=error, elapsed=0)
+
+            start = time.time()
+            try:
+                with span('handler', self.correlation_id, Handler=handler_cls.__name__, Action=action):
+                    result, error = getattr(handler_cls(self), action)(), None
+            except Exception as e:
+                result, error = None, e
+            elapsed = time.time() - start
+            logger.info('%s %s error: %s, %.3fs', self.change_type, handler_cls.__name__, error, elapsed)
+            logger.debug('%s %s result: %s', self.change_type, handler_cls.__name__, LazyJson(result))
+            if error is None and on_success:
+                on_success(handler_cls.__name__)
+            return dict(handler=handler_cls.__name__, result=result, error=error, elapsed=elapsed)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # the handlers are submitted in the topological order, so the dependencies are always
+            # taken by the workers before the dependents, the bounded pool never deadlocks
+            for handler_cls in handler_classes:
+                futures[handler_cls.__name__] = executor.submit(run, handler_cls)
+            results = [future.result() for future in futures.values()]
+        logger.info('SSM cache: hits=%s, misses=%s', self.ssm_cache.hits, self.ssm_cache.misses)
+
+        errors = [r['error'] for r in results if isinstance(r['error'], Exception)]
+        if errors:
+            raise errors[0]
+        return results
+
+
+def sort_handlers(handler_classes):
+    """
+    Sort the handler classes in the topological order of their dependencies, keep the original order otherwise.
+
+    The dependencies which are not in the list are ignored.
+    """
+    pending = list(handler_classes)
+    names = {cls.__name__ for cls in pending}
+    done, result = set(), []
+    while pending:
+        for cls in pending:
+            if all(dep in done or dep not in names for dep in cls.depends_on):
+                pending.remove(cls)
+                done.add(cls.__name__)
+                result.append(cls)
+                break
+        else:
+            raise RuntimeError('found circular dependencies in the handlers: {}'.format(pending))
+    return result
 
 
 class Handler(ABC):
@@ -118,6 +1094,12 @@ class Handler(ABC):
     api_path = None
     # limit the resource type to the specific type for the handler
     resource_type = 'AWS::EC2::Instance'
+    # the names of the handler classes that must run before this handler if they are enabled
+    depends_on = ()
+    # the configuration paths and the tag keys that the handler depends on, the handler is skipped for
+    # the UPDATE events that change none of them, it's never skipped if both are empty
+    config_paths = ()
+    tag_keys = ()
 
     def __init__(self, cicn):
         if self.resource_type != cicn.resource_type:
@@ -125,6 +1107,10 @@ class Handler(ABC):
 
         self.cicn = cicn
 
+    def call_ssm(self, **kwargs):
+        # call the SSM API through the cache of the event
+        return self.cicn.ssm_cache.call(**kwargs)
+
     @abstractmethod
     def create(self):
         pass
@@ -151,14 +1137,12 @@ class NSHandler(Handler):
 
     def create(self):
         data = dict(name=self.name, env=self.env)
-        nameservers = call_ssm(resource=self.api_path, method='get', params=dict(name=self.name))
-        if nameservers:
-            return call_ssm(resource='{}{}/'.format(self.api_path, nameservers[0]['id']), method='put', json=data)
-        else:
-            return call_ssm(resource=self.api_path, method='post', json=data)
+        return self.call_ssm(resource=self.api_path, method='upsert', lookup=dict(name=self.name), json=data)
 
 
 class NameServerHandler(NSHandler):
+    tag_keys = ('DomainNameServerEnv',)
+
     @property
     def name(self):
         return 'nameserver'
@@ -169,6 +1153,8 @@ class NameServerHandler(NSHandler):
 
 
 class SsmNameServerHandler(NSHandler):
+    tag_keys = ('SSMDomainNameServerEnv',)
+
     @property
     def name(self):
         return 'ssm-nameserver'
@@ -179,6 +1165,8 @@ class SsmNameServerHandler(NSHandler):
     
 
 class SsnNameServerHandler(NSHandler):
+    tag_keys = ('SSDomainNameServerEnv',)
+
     @property
     def name(self):
         return 'ss-nameserver'
@@ -189,6 +1177,8 @@ class SsnNameServerHandler(NSHandler):
     
 
 class L2tpNameServerHandler(NSHandler):
+    tag_keys = ('L2TPDomainNameServerEnv',)
+
     @property
     def name(self):
         return 'l2tp-nameserver'
@@ -202,6 +1192,7 @@ class DomainHandler(Handler):
     api_path = '/domain/domain/'
     # the name of the nameserver that the domain will be associated with, try them in order
     nameserver_try_list = ['nameserver']
+    depends_on = ('NameServerHandler',)
 
     @property
     @abstractmethod
@@ -212,20 +1203,19 @@ class DomainHandler(Handler):
         data = dict(name=self.name)
 
         for ns_name in self.nameserver_try_list:
-            nameservers = call_ssm(resource=NSHandler.api_path, method='get', params=dict(name=ns_name))
-            if nameservers:
-                data['nameserver'] = nameservers[0]['id']
+            nameserver = self.call_ssm(resource=NSHandler.api_path, method='get', params=dict(name=ns_name),
+                                       first=True, fields=['id'])
+            if nameserver:
+                data['nameserver'] = nameserver['id']
                 break
 
-        domains = call_ssm(resource=self.api_path, method='get', params=dict(name=self.name))
-        if domains:
-            return call_ssm(resource='{}{}/'.format(self.api_path, domains[0]['id']), method='put', json=data)
-        else:
-            return call_ssm(resource=self.api_path, method='post', json=data)
+        return self.call_ssm(resource=self.api_path, method='upsert', lookup=dict(name=self.name), json=data)
 
 
 class SsmDomainHandler(DomainHandler):
     nameserver_try_list = ['ssm-nameserver', 'nameserver']
+    depends_on = ('SsmNameServerHandler', 'NameServerHandler')
+    tag_keys = ('SSMDomain', 'SSMDomainNameServerEnv', 'DomainNameServerEnv')
 
     @property
     def name(self):
@@ -234,6 +1224,8 @@ class SsmDomainHandler(DomainHandler):
 
 class SsnDomainHandler(DomainHandler):
     nameserver_try_list = ['ss-nameserver', 'nameserver']
+    depends_on = ('SsnNameServerHandler', 'NameServerHandler')
+    tag_keys = ('SSDomain', 'SSDomainNameServerEnv', 'DomainNameServerEnv')
 
     @property
     def name(self):
@@ -242,6 +1234,8 @@ class SsnDomainHandler(DomainHandler):
 
 class L2tpDomainHandler(DomainHandler):
     nameserver_try_list = ['l2tp-nameserver', 'nameserver']
+    depends_on = ('L2tpNameServerHandler', 'NameServerHandler')
+    tag_keys = ('L2TPDomain', 'L2TPDomainNameServerEnv', 'DomainNameServerEnv')
 
     @property
     def name(self):
@@ -252,10 +1246,12 @@ class RecordHandler(Handler):
     api_path = '/domain/record/'
     # record type
     type = 'A'
-    # append the answer to the existing record
+    # the answer is a set of the IPs shared by the nodes, which is added to and removed from by each node,
+    # instead of being replaced as a whole
     append = False
     # associate the record with a Django Site ID
     site = None
+    config_paths = ('publicIpAddress',)
 
     @property
     @abstractmethod
@@ -266,8 +1262,14 @@ class RecordHandler(Handler):
     def answer(self):
         return self.cicn.resource['publicIpAddress']
 
-    def create(self):
-        data = dict(
+    @property
+    def previous_answer(self):
+        # the public IP before the change, only for UPDATE
+        prop = self.cicn.diff_item['changedProperties'].get('Configuration.PublicIpAddress') or {}
+        return prop.get('previousValue')
+
+    def get_data(self):
+        return dict(
             fqdn=self.fqdn,
             host=None,
             domain=None,
@@ -276,32 +1278,36 @@ class RecordHandler(Handler):
             site=self.site,
         )
 
-        records = call_ssm(resource=self.api_path, method='get', params=dict(fqdn=self.fqdn, type=self.type))
-        if records:
-            record = records[0]
-            if self.append:
-                old_set = set(record['answer'].lower().split(','))
-                new_set = set(data['answer'].lower().split(','))
-                if old_set not in new_set:
-                    data['answer'] = ','.join(new_set.union(old_set))
-            return call_ssm(resource='{}{}/'.format(self.api_path, record['id']), method='put', json=data)
-        else:
-            return call_ssm(resource=self.api_path, method='post', json=data)
+    def update_answers(self, add=(), remove=(), delete_empty=False):
+        # add and remove the IPs of the shared record in a single conditional write of the SSM API
+        return self.call_ssm(resource=self.api_path, method='answer_set', lookup=dict(fqdn=self.fqdn, type=self.type),
+                             add=[a for a in add if a], remove=[r for r in remove if r], json=self.get_data(),
+                             delete_empty=delete_empty)
 
+    def create(self):
+        if not self.append:
+            lookup = dict(fqdn=self.fqdn, type=self.type)
+            return self.call_ssm(resource=self.api_path, method='upsert', lookup=lookup, json=self.get_data())
+        return self.update_answers(add=[self.answer])
 
     def update(self):
-        return self.create()
+        if not self.append:
+            return self.create()
+        # replace the old IP with the new one, so the rotated IP is not left in the shared record
+        previous = self.previous_answer
+        return self.update_answers(add=[self.answer], remove=[previous] if previous != self.answer else [])
 
     def delete(self):
-        records = call_ssm(resource=self.api_path, method='get', params=dict(fqdn=self.fqdn, type=self.type, answer=self.answer))
-        if records:
-            return call_ssm(resource='{}{}/'.format(self.api_path, records[0]['id']), method='delete')
+        # the record is deleted with its last IP
+        return self.update_answers(remove=[self.answer], delete_empty=True)
 
 
 class SsmRecordHandler(RecordHandler):
     # associate a site id here, so the domain will be added to ALLOWED_HOSTS.
     # make sure the site id is the same as the Django settings.SITE_ID.
     site = 1
+    depends_on = ('SsmDomainHandler',)
+    tag_keys = ('SSMDomain',)
 
     @property
     def fqdn(self):
@@ -311,6 +1317,8 @@ class SsmRecordHandler(RecordHandler):
 class SsnRecordHandler(RecordHandler):
     # node cluster shares the same domain, so append the answer to the existing record
     append = True
+    depends_on = ('SsnDomainHandler',)
+    tag_keys = ('SSDomain',)
 
     @property
     def fqdn(self):
@@ -318,6 +1326,9 @@ class SsnRecordHandler(RecordHandler):
 
 
 class L2tpRecordHandler(RecordHandler):
+    depends_on = ('L2tpDomainHandler',)
+    tag_keys = ('L2TPDomain',)
+
     @property
     def fqdn(self):
         return self.cicn.tags['L2TPDomain']
@@ -325,6 +1336,10 @@ class L2tpRecordHandler(RecordHandler):
 
 class NodeHandler(Handler):
     api_path = '/shadowsocks/node/'
+    # the node is associated with the record of the SSDomain
+    depends_on = ('SsnRecordHandler',)
+    config_paths = ('publicIpAddress', 'privateIpAddress', 'state.name')
+    tag_keys = ('Name', 'SSDomain', 'SnsTopicArn', 'AccessKeyForUserSnsPublisher', 'SecretKeyForUserSnsPublisher')
 
     @property
     def record(self):
@@ -347,33 +1362,31 @@ class NodeHandler(Handler):
         )
 
         # lookup existing DNS records which must exist
-        records = call_ssm(resource=RecordHandler.api_path, method='get', params=dict(fqdn=self.record, type=RecordHandler.type))
-        if records:
-            data['record'] = records[0]['id']
+        record = self.call_ssm(resource=RecordHandler.api_path, method='get', params=dict(fqdn=self.record, type=RecordHandler.type),
+                               first=True, fields=['id'])
+        if record:
+            data['record'] = record['id']
         else:
-            print('not found the instance of Record: {} for creating the node: {}'.format(self.record, self.name))
+            logger.warning('not found the instance of Record: %s for creating the node: %s', self.record, self.name)
             return
 
-        # lookup existing nodes with the same name
-        nodes = call_ssm(resource=self.api_path, method='get', params=dict(name=self.name))
-        if nodes:
-            return call_ssm(resource='{}{}/'.format(self.api_path, nodes[0]['id']), method='put', json=data)
-        else:
-            return call_ssm(resource=self.api_path, method='post', json=data)
+        # update the existing node with the same name, or create one
+        return self.call_ssm(resource=self.api_path, method='upsert', lookup=dict(name=self.name), json=data)
 
     def update(self):
         return self.create()
 
     def delete(self):
-        nodes = call_ssm(resource=self.api_path, method='get', params=dict(name=self.name))
-        if nodes:
-            node = nodes[0]
+        node = self.call_ssm(resource=self.api_path, method='get', params=dict(name=self.name), first=True)
+        if node:
             node['is_active'] = False
-            return call_ssm(resource='{}{}/'.format(self.api_path, node['id']), method='put', json=node)
+            return self.call_ssm(resource='{}{}/'.format(self.api_path, node['id']), method='put', json=node)
 
 
 class SSManagerHandler(Handler):
     api_path = '/shadowsocks/ssmanager/'
+    depends_on = ('NodeHandler',)
+    tag_keys = ('Name', 'SSManager')
 
     @property
     def node_name(self):
@@ -386,17 +1399,15 @@ class SSManagerHandler(Handler):
     def create(self):
         data = json.loads(self.ssmanager)
 
-        ssmanagers = call_ssm(resource=self.api_path, method='get', params=dict(node__name=self.node_name))
-        if ssmanagers:
-            return call_ssm(resource='{}{}/'.format(self.api_path, ssmanagers[0]['id']), method='put', json=data)
+        node = self.call_ssm(resource=NodeHandler.api_path, params=dict(name=self.node_name), method='get',
+                             first=True, fields=['id'])
+        if node:
+            data['node'] = node['id']
         else:
-            nodes = call_ssm(resource=NodeHandler.api_path, params=dict(name=self.node_name), method='get')
-            if nodes:
-                data['node'] = nodes[0]['id']
-                return call_ssm(resource=self.api_path, method='post', json=data)
-            else:
-                print('not found the instance of Node: {} for creating the ssmanager'.format(self.node_name))
-                return
+            logger.warning('not found the instance of Node: %s for creating the ssmanager', self.node_name)
+            return
+
+        return self.call_ssm(resource=self.api_path, method='upsert', lookup=dict(node__name=self.node_name), json=data)
 
     def update(self):
         return self.create()
@@ -11,10 +11,12 @@ resp = client.invoke(
     FunctionName='<ARN-of-the-Lambda>',         # REQUIRED
     Payload=json.dumps(dict(                    # REQUIRED
         resource=/path/to/resource/',           # REQUIRED
-        method='get|post|put|patch|delete',     # REQUIRED
+        method='get|post|put|patch|delete|upsert|answer_set',  # REQUIRED
         params=dict(name=value, ...),           # OPTIONAL
         json=dict(name=value, ...),             # OPTIONAL
         data=dict(name=value, ...),             # OPTIONAL
+        lookup=dict(name=value, ...),           # OPTIONAL, only for upsert and answer_set
+        correlation_id='<id>',                  # OPTIONAL, printed with the metrics
     ))
 )
 if resp['StatusCode'] == 200:
@@ -24,25 +26,246 @@ if resp['StatusCode'] == 200:
         print('Error: {}'.format(resp['Payload']['body']))
 else:
     print('Error: {}'.format(resp['Payload']))
+
+Upsert Example:
+
+The method `upsert` looks up the collection `resource` with the `lookup` params, updates the first
+found object with `json`, or creates a new one if nothing found. The response has an extra key
+`action` with the value `created` or `updated`.
+
+resp = client.invoke(
+    FunctionName='<ARN-of-the-Lambda>',
+    Payload=json.dumps(dict(
+        resource='/shadowsocks/node/',
+        method='upsert',
+        lookup=dict(name='node-1'),
+        json=dict(name='node-1', public_ip='1.2.3.4', ...),
+    ))
+)
+
+Answer Set Example:
+
+The method `answer_set` adds and removes the members of the comma separated set in the `field`
+(default: answer) of the first object found by the `lookup` params, in a single conditional write
+which is retried on the concurrent changes, so the nodes sharing a record never clobber each other.
+The object is created with `json` if not found, and deleted if the set becomes empty and
+`delete_empty` is true. The response has an extra key `action` with the value `created`, `updated`,
+`deleted` or `unchanged`.
+
+resp = client.invoke(
+    FunctionName='<ARN-of-the-Lambda>',
+    Payload=json.dumps(dict(
+        resource='/domain/record/',
+        method='answer_set',
+        lookup=dict(fqdn='ss.example.com', type='A'),
+        add=['5.6.7.8'],
+        remove=['1.2.3.4'],
+        json=dict(fqdn='ss.example.com', type='A'),
+    ))
+)
+
+List Example:
+
+The GET of a collection accepts the list options, the DRF pagination (the `next` links of the
+page number or limit/offset pagination) is followed transparently, and the list stops fetching
+the pages as soon as enough objects are got.
+
+resp = client.invoke(
+    FunctionName='<ARN-of-the-Lambda>',
+    Payload=json.dumps(dict(
+        resource='/shadowsocks/node/',
+        method='get',
+        params=dict(name='node-1'),
+        first=True,                             # OPTIONAL, return the first object or None
+        limit=10,                               # OPTIONAL, return at most the number of objects, None for all
+        fields=['id', 'name'],                  # OPTIONAL, return only the fields of the objects
+        paginate=True,                          # OPTIONAL, return a page: {'results': [...], 'next': <cursor>}
+        cursor='<cursor>',                      # OPTIONAL, return the page of the cursor of the last page
+    ))
+)
+
+Batch Example:
+
+The payload can also be a list of the request specs, the independent requests are executed
+concurrently over the shared session. A request can be marked with `depends_on` to run after
+the earlier request(s) of the list, it's skipped with the status code 424 if any of them failed.
+
+resp = client.invoke(
+    FunctionName='<ARN-of-the-Lambda>',
+    Payload=json.dumps([
+        dict(resource='/domain/nameserver/', method='get', params=dict(name='nameserver')),
+        dict(resource='/domain/domain/', method='get', params=dict(name='example.com')),
+        dict(resource='/domain/domain/', method='post', json=dict(name='example.com'),
+             depends_on=[0, 1]),                # OPTIONAL, the index(es) of the earlier requests
+    ])
+)
+for item in json.load(resp['Payload']):         # in the same order of the requests
+    print(item['status_code'], item['body'])
+
+Authentication:
+
+The API is authenticated by the Django admin login by default. With `SSM_AUTH_SCHEME=token` (DRF
+TokenAuthentication) or `SSM_AUTH_SCHEME=jwt` (Simple JWT), the token is obtained once and cached in
+/tmp and in `SSM_TOKEN_STORE` if set (`ssm:<parameter-name>` or `secretsmanager:<secret-id>`), so
+the new containers reuse it without the login. The JWT is refreshed in the background before it
+expires, and the session login is used if the token can't be obtained.
+
+Resilience:
+
+The idempotent requests (GET, PUT) are retried on the connection errors and the 429/502/503/504
+responses with the jittered exponential backoff (`SSM_MAX_RETRIES`). With `SSM_HEDGE=true`, a GET
+not responded after `SSM_HEDGE_DELAY` or the p95 of the recent GETs is duplicated, the first
+response wins. A circuit breaker fails the requests fast with the status code 503 after
+`SSM_BREAKER_THRESHOLD` consecutive failures, for `SSM_BREAKER_RESET_TIMEOUT` seconds.
+
+Profiling:
+
+With `PROFILE=true` or `"profile": true` in the event (not in the requests of a batch), the invocation is
+profiled with cProfile and tracemalloc, the top `PROFILE_TOP_N` functions and allocations are logged, and
+the full profile is saved to `PROFILE_OUTPUT` if set, a local directory or `s3://<bucket>/<prefix>`.
 """
 
 import os
+import base64
+import collections
+import copy
+import hashlib
 import json
+import random
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from http.client import responses as http_reasons
 from urllib.parse import urljoin
 # Lambda (since python3.8) does not have the `requests` module, so it needs to be included
 #  in the deployment package or the Lambda layer
 import requests
 
+import vpn_common
+from vpn_common import CircuitBreaker, CircuitOpenError, LazyJson, get_client, normalize_path, profiled, split_members
+
 print('Loading function')
 
+# LOG_LEVEL: INFO logs the summaries, DEBUG logs the full payloads
+logger = logging.getLogger()
+logger.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+
+# the API clients are cached across the warm invocations, keyed by the connection settings
+_api_clients = {}
+_api_clients_lock = threading.Lock()
+
+# the service dimension of the metrics printed by vpn_common.span
+METRICS_SERVICE = 'LambdaSsmApi'
+
+# the context of the request being processed in the current thread
+_context = threading.local()
+
+
+def span(name, **dimensions):
+    # tagged with the correlation id of the request being processed in the current thread
+    return vpn_common.span(METRICS_SERVICE, name, getattr(_context, 'correlation_id', None), **dimensions)
+
+
+def get_jwt_expiry(token):
+    # the `exp` claim of the JWT, the signature is verified by the server, not here
+    try:
+        payload = token.split('.')[1]
+        return json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))['exp']
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+class TokenCache:
+    """
+    The cache of the API token, so a new container skips obtaining the token with the password.
+
+    The token is cached in a file in /tmp, which survives the re-initialization of the container, and
+    optionally in a shared store that survives the cold starts, given as `<service>:<name>`:
+
+        * ssm:/path/to/parameter: a SecureString parameter of the SSM Parameter Store.
+        * secretsmanager:<secret-id>: an existing secret of the Secrets Manager.
+
+    The token is a dict of `access`, `refresh` (None for the DRF token) and `expires` (None if unknown).
+    """
+
+    def __init__(self, key, store=None):
+        self.path = os.path.join('/tmp', 'ssm-api-token-{}.json'.format(key))
+        self.service, _, self.name = (store or '').partition(':')
+
+    @staticmethod
+    def is_valid(token, margin=0):
+        return bool(token and token.get('access')) and (
+            token.get('expires') is None or token['expires'] > time.time() + margin)
+
+    def load(self):
+        for load in [self._load_file, self._load_store]:
+            try:
+                token = load()
+            except Exception as e:
+                logger.warning('Failed to load the cached token: %s', e)
+                continue
+            if self.is_valid(token):
+                return token
+
+    def save(self, token):
+        try:
+            self._save_file(token)
+            self._save_store(token)
+        except Exception as e:
+            logger.warning('Failed to cache the token: %s', e)
+
+    def _load_file(self):
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                return json.load(f)
+
+    def _save_file(self, token):
+        # the token is a credential, keep it readable by the owner only
+        fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(token, f)
+
+    def _load_store(self):
+        if self.service == 'ssm':
+            resp = get_client('ssm').get_parameter(Name=self.name, WithDecryption=True)
+            return json.loads(resp['Parameter']['Value'])
+        if self.service == 'secretsmanager':
+            resp = get_client('secretsmanager').get_secret_value(SecretId=self.name)
+            return json.loads(resp['SecretString'])
+
+    def _save_store(self, token):
+        if self.service == 'ssm':
+            get_client('ssm').put_parameter(Name=self.name, Value=json.dumps(token), Type='SecureString',
+                                            Overwrite=True)
+        elif self.service == 'secretsmanager':
+            get_client('secretsmanager').put_secret_value(SecretId=self.name, SecretString=json.dumps(token))
+
 
 class DRFAPI:
     """
     A class used to interact with a Django Rest Framework API.
     """
 
+    # the status codes that indicate the session is no longer authenticated
+    reauth_status_codes = (401, 403)
+
+    # the auth schemes: the path to obtain the token, the path to refresh it, and the keyword of the header
+    auth_schemes = {
+        'token': ('/api-token-auth/', None, 'Token'),
+        'jwt': ('/api/token/', '/api/token/refresh/', 'Bearer'),
+    }
+
+    # the methods retried on the transient errors, and the status codes of the transient errors
+    idempotent_methods = ('get', 'head', 'options', 'put')
+    retry_status_codes = (429, 502, 503, 504)
+
     def __init__(self, scheme='http', host='localhost', username='admin', password='password',
-                 login_path='/admin/login/', api_base='/', csrf_enabled=False, timeout=30):
+                 login_path='/admin/login/', api_base='/', csrf_enabled=False, timeout=30,
+                 session_cookie_name='sessionid', limit_param='limit', auth_scheme='session',
+                 token_path=None, token_refresh_path=None, token_store=None, token_ttl=None,
+                 token_refresh_margin=60, max_retries=2, backoff_base=0.2, backoff_cap=5,
+                 hedge=False, hedge_delay=None, breaker_threshold=5, breaker_reset_timeout=30):
         self.scheme = scheme
         self.host = host
         self.username = username
@@ -51,54 +274,633 @@ class DRFAPI:
         self.api_base = api_base
         self.csrf_enabled = csrf_enabled
         self.timeout = timeout
+        self.session_cookie_name = session_cookie_name
+        # the query param of the page size, it's ignored by the server if the pagination is disabled
+        self.limit_param = limit_param
+
+        # the token auth is used if the auth scheme is `token` or `jwt`, it falls back to the session login
+        # if the token can't be obtained
+        self.auth_scheme = auth_scheme
+        default_path, default_refresh_path, self.token_keyword = self.auth_schemes.get(auth_scheme, (None, None, None))
+        self.token_path = token_path or default_path
+        self.token_refresh_path = token_refresh_path or default_refresh_path
+        # the lifetime of the DRF token which never expires by itself, None to use it until it's rejected
+        self.token_ttl = token_ttl
+        # the token is refreshed in the background once it expires in the seconds
+        self.token_refresh_margin = token_refresh_margin
+        key = hashlib.sha256('{}|{}|{}|{}'.format(scheme, host, username, auth_scheme).encode()).hexdigest()[:16]
+        self.token_cache = TokenCache(key, store=token_store) if self.token_keyword else None
+        self.token = None
+
+        # the idempotent requests are retried with the exponential backoff with the full jitter
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        # the slow GET is duplicated after the delay, or the p95 of the recent GETs if not given,
+        # and the first response wins
+        self.hedge = hedge
+        self.hedge_delay = hedge_delay
+        self._get_latencies = collections.deque(maxlen=100)
+        self._hedge_executor = None
+        self._hedge_lock = threading.Lock()
+        self.breaker = CircuitBreaker(host, threshold=breaker_threshold, reset_timeout=breaker_reset_timeout)
 
         self.session = requests.Session()
         self.authenticated = False
         self.csrf_token = None
+        self._auth_lock = threading.Lock()
+        self._refresh_thread = None
 
     def get_url(self, resource):
         base_url = '{scheme}://{host}{base}'.format(scheme=self.scheme, host=self.host, base=self.api_base)
         return urljoin(base_url, resource.lstrip('/'))
 
     def authenticate(self):
-        print('Authenticating ...')
-        response = self.call(self.login_path, auth=False, method='get')
-        response.raise_for_status()
-        response = self.call(self.login_path, auth=False, method='post', data={
+        if self.token_keyword:
+            try:
+                self.authenticate_token()
+                return
+            except (requests.RequestException, KeyError, ValueError) as e:
+                logger.warning('Failed to authenticate with the %s, falling back to the session login: %s',
+                               self.auth_scheme, e)
+                self.set_token(None)
+
+        logger.info('Authenticating ...')
+        with span('authenticate'):
+            response = self.call(self.login_path, auth=False, method='get')
+            response.raise_for_status()
+            response = self.call(self.login_path, auth=False, method='post', data={
+                'username': self.username,
+                'password': self.password,
+                'next': '/',
+            })
+            response.raise_for_status()
+        self.authenticated = True
+
+    def authenticate_token(self):
+        """
+        Authenticate with the cached token, or obtain a new one and cache it.
+
+        A cached token the same as the current one is skipped, since it has just been rejected by the server.
+        """
+        token = self.token_cache.load()
+        if token is None or token == self.token:
+            logger.info('Obtaining the %s ...', self.auth_scheme)
+            with span('authenticate', Scheme=self.auth_scheme):
+                token = self.obtain_token()
+            self.token_cache.save(token)
+        self.set_token(token)
+        self.authenticated = True
+
+    def obtain_token(self):
+        response = self.call(self.token_path, auth=False, method='post', json={
             'username': self.username,
             'password': self.password,
-            'next': '/',
         })
-        response.raise_for_status()
-        self.authenticated = True
+        body = response.json()
+        if self.auth_scheme == 'jwt':
+            return dict(access=body['access'], refresh=body.get('refresh'), expires=get_jwt_expiry(body['access']))
+        return dict(access=body['token'], refresh=None,
+                    expires=time.time() + self.token_ttl if self.token_ttl else None)
+
+    def refresh_token(self):
+        """
+        Refresh the JWT with the refresh token, or obtain a new token if it can't be refreshed.
+        """
+        token = self.token
+        if self.token_refresh_path and token and token.get('refresh'):
+            response = self.call(self.token_refresh_path, auth=False, method='post',
+                                 json={'refresh': token['refresh']})
+            body = response.json()
+            # the refresh token is rotated if the server is configured to
+            token = dict(access=body['access'], refresh=body.get('refresh', token['refresh']),
+                         expires=get_jwt_expiry(body['access']))
+        else:
+            token = self.obtain_token()
+        self.token_cache.save(token)
+        with self._auth_lock:
+            self.set_token(token)
+
+    def _refresh_token_in_background(self):
+        try:
+            self.refresh_token()
+        except Exception as e:
+            # the current token is still used, it's obtained again once it's rejected or expired
+            logger.warning('Failed to refresh the %s: %s', self.auth_scheme, e)
+
+    def set_token(self, token):
+        self.token = token
+        if token:
+            self.session.headers['Authorization'] = '{} {}'.format(self.token_keyword, token['access'])
+        else:
+            self.session.headers.pop('Authorization', None)
+
+    def request(self, resource, **kwargs):
+        method = kwargs.get('method', '').lower()
+        start = time.time()
+        with span('http', Path=normalize_path(resource), Method=method):
+            response = self.session.request(**kwargs)
+        if method == 'get':
+            self._get_latencies.append(time.time() - start)
+        return response
+
+    def get_hedge_delay(self):
+        if self.hedge_delay is not None:
+            return self.hedge_delay
+        # the p95 is not meaningful until enough GETs are seen
+        latencies = sorted(self._get_latencies)
+        if len(latencies) >= 20:
+            return latencies[int(len(latencies) * 0.95)]
+
+    def request_hedged(self, resource, **kwargs):
+        """
+        Make the GET, and a duplicate one if it's not responded after the hedge delay, return the first
+        successful response.
+        """
+        delay = self.get_hedge_delay()
+        if delay is None:
+            return self.request(resource, **kwargs)
+
+        # the API is shared by the threads of a batch, only one of them creates the executor
+        with self._hedge_lock:
+            if self._hedge_executor is None:
+                self._hedge_executor = ThreadPoolExecutor(max_workers=int(os.getenv('SSM_HEDGE_MAX_WORKERS', 8)))
+        correlation_id = getattr(_context, 'correlation_id', None)
+
+        def run():
+            _context.correlation_id = correlation_id
+            return self.request(resource, **kwargs)
+
+        futures = [self._hedge_executor.submit(run)]
+        done, _ = wait(futures, timeout=delay)
+        if not done:
+            logger.info('Hedging the GET %s not responded in %.3fs', resource, delay)
+            futures.append(self._hedge_executor.submit(run))
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+        return futures[0].result()
+
+    def send(self, resource, **kwargs):
+        """
+        Make the request through the circuit breaker, retry the idempotent request on the transient errors.
+        """
+        method = kwargs.get('method', '').lower()
+        retries = self.max_retries if method in self.idempotent_methods else 0
+        for attempt in range(retries + 1):
+            self.breaker.allow()
+            try:
+                if self.hedge and method == 'get':
+                    response = self.request_hedged(resource, **kwargs)
+                else:
+                    response = self.request(resource, **kwargs)
+            except Exception as e:
+                self.breaker.record_failure()
+                if attempt >= retries or not isinstance(e, (requests.ConnectionError, requests.Timeout)):
+                    raise
+                logger.warning('Failed to %s %s: %s, retrying ...', method, resource, e)
+            else:
+                if response.status_code >= 500:
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.record_success()
+                if attempt >= retries or response.status_code not in self.retry_status_codes:
+                    return response
+                logger.warning('Got %s from %s %s, retrying ...', response.status_code, method, resource)
+            time.sleep(random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt)))
+
+    def set_csrf_header(self):
+        if self.csrf_enabled and self.session.cookies.get('csrftoken'):
+            self.csrf_token = self.session.cookies.get('csrftoken')
+            self.session.headers['X-CSRFToken'] = self.csrf_token
+
+    def is_session_expired(self):
+        # the session cookie is dropped by the cookie jar once it's expired, check the expiry anyway
+        # in case the cookie jar is not cleaned up yet
+        for cookie in self.session.cookies:
+            if cookie.name == self.session_cookie_name:
+                return cookie.expires is not None and cookie.expires <= time.time()
+        return True
+
+    def is_expired(self):
+        if self.token:
+            return not TokenCache.is_valid(self.token)
+        return self.is_session_expired()
+
+    def ensure_authenticated(self, force=False):
+        with self._auth_lock:
+            if force or not self.authenticated or self.is_expired():
+                self.authenticated = False
+                self.authenticate()
+            elif self.token and not TokenCache.is_valid(self.token, margin=self.token_refresh_margin):
+                # refresh the token about to expire without blocking the calls with the current one
+                if self._refresh_thread is None or not self._refresh_thread.is_alive():
+                    self._refresh_thread = threading.Thread(target=self._refresh_token_in_background, daemon=True)
+                    self._refresh_thread.start()
 
     def call(self, resource, auth=True, **kwargs):
-        if not self.authenticated and auth:
-            self.authenticate()
+        if auth:
+            self.ensure_authenticated()
 
         kwargs.setdefault('url', self.get_url(resource))
         kwargs.setdefault('timeout', self.timeout)
 
-        if self.csrf_enabled and self.session.cookies.get('csrftoken'):
-            self.session.headers['X-CSRFToken'] = self.session.cookies.get('csrftoken')
-
-        print('Calling API: {}'.format(kwargs))
-        response = self.session.request(**kwargs)
+        self.set_csrf_header()
+        logger.debug('Calling API: %s', LazyJson(kwargs))
+        response = self.send(resource, **kwargs)
+        if auth and response.status_code in self.reauth_status_codes:
+            # the session may be invalidated at the server side, re-authenticate and try once more
+            logger.warning('Got %s, re-authenticating ...', response.status_code)
+            self.ensure_authenticated(force=True)
+            self.set_csrf_header()
+            response = self.send(resource, **kwargs)
         response.raise_for_status()
         return response
 
+    def upsert(self, resource, lookup=None, json=None, **kwargs):
+        """
+        Update the first object found in the collection with the lookup params, or create one if not found.
+
+        Returns
+        -------
+        tuple
+            The response of the write and the action taken: `created` or `updated`.
+        """
+        obj = next(self.iter_list(resource, params=lookup, limit=1, **kwargs), None)
+        if obj:
+            response = self.call('{}{}/'.format(resource, obj['id']), method='put', json=json, **kwargs)
+            return response, 'updated'
+        else:
+            response = self.call(resource, method='post', json=json, **kwargs)
+            return response, 'created'
+
+    def update_set(self, resource, lookup=None, field='answer', add=None, remove=None, json=None,
+                   delete_empty=False, max_attempts=None, **kwargs):
+        """
+        Add and remove the members of the comma separated set in the field of the first object found by the
+        lookup params, see the Answer Set Example of the module.
+
+        The write is conditional on the field unchanged since it's read: the detail endpoint is filtered by
+        the value read, which DRF applies to the object too, so a concurrent change fails the write with 404,
+        and it's retried with the fresh value after the jittered backoff.
 
+        Returns
+        -------
+        tuple
+            The status code, the body of the object, and the action taken: `created`, `updated`, `deleted`
+            or `unchanged`.
+        """
+        add = split_members(','.join(add or []))
+        remove = split_members(','.join(remove or []))
+        max_attempts = max_attempts or int(os.getenv('SSM_SET_MAX_ATTEMPTS', 5))
+        for attempt in range(max_attempts):
+            if attempt:
+                time.sleep(random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt)))
+
+            obj = next(self.iter_list(resource, params=lookup, limit=1, **kwargs), None)
+            if obj is None:
+                if not add:
+                    return 200, None, 'unchanged'
+                response = self.call(resource, method='post', json=dict(json or {}, **{field: ','.join(add)}), **kwargs)
+                return response.status_code, get_body(response), 'created'
+
+            old = obj.get(field) or ''
+            members = [m for m in split_members(old) if m not in remove]
+            members += [m for m in add if m not in members]
+            if members == split_members(old):
+                return 200, obj, 'unchanged'
+
+            detail = '{}{}/'.format(resource, obj['id'])
+            try:
+                if members or not delete_empty:
+                    response = self.call(detail, method='patch', params={field: old}, json={field: ','.join(members)},
+                                         **kwargs)
+                    return response.status_code, get_body(response), 'updated'
+                response = self.call(detail, method='delete', params={field: old}, **kwargs)
+                return response.status_code, None, 'deleted'
+            except requests.HTTPError as e:
+                if e.response.status_code != 404:
+                    raise
+                logger.warning('The %s of %s is changed concurrently, retrying ...', field, detail)
+
+        raise RuntimeError('Failed to update the {} of {} after {} attempts of the concurrent changes'.format(
+            field, resource, max_attempts))
+
+    def get_page(self, resource, params=None, page_size=None, cursor=None, **kwargs):
+        """
+        Get a page of the list, the cursor is the `next` link of the previous page.
+
+        Returns
+        -------
+        tuple
+            The list of the objects and the cursor of the next page, which is None for the last page
+            or the list not paginated by the server.
+        """
+        if cursor:
+            if not cursor.startswith(self.get_url('/')):
+                raise ValueError('invalid cursor: {}'.format(cursor))
+            response = self.call(resource, method='get', url=cursor, **kwargs)
+        else:
+            params = dict(params or {})
+            if page_size and self.limit_param:
+                params[self.limit_param] = page_size
+            response = self.call(resource, method='get', params=params, **kwargs)
+
+        body = response.json()
+        if isinstance(body, dict) and 'results' in body:
+            return body['results'], body.get('next')
+        return body, None
+
+    def iter_list(self, resource, params=None, limit=None, **kwargs):
+        """
+        Yield the objects of the list page by page, stop fetching the pages once the limit is reached.
+        """
+        count = 0
+        cursor = None
+        while limit is None or count < limit:
+            objs, cursor = self.get_page(resource, params=params, page_size=limit, cursor=cursor, **kwargs)
+            for obj in objs[:None if limit is None else limit - count]:
+                count += 1
+                yield obj
+            if not cursor:
+                break
+
+    def list(self, resource, params=None, first=False, limit=None, fields=None, paginate=False, cursor=None,
+             **kwargs):
+        """
+        Get the list with the list options, see the List Example of the module.
+        """
+        def project(obj):
+            return {k: obj.get(k) for k in fields} if fields else obj
+
+        if paginate or cursor:
+            objs, cursor = self.get_page(resource, params=params, page_size=limit, cursor=cursor, **kwargs)
+            return {'results': [project(obj) for obj in objs], 'next': cursor}
+
+        objs = [project(obj) for obj in self.iter_list(resource, params=params, limit=1 if first else limit, **kwargs)]
+        if first:
+            return objs[0] if objs else None
+        return objs
+
+
+class MemoryAPI(DRFAPI):
+    """
+    An in-memory fake of the DRF APIs for the tests, it serves the requests below the DRFAPI, so the
+    upsert, the list options and the batch behave the same as with the real APIs.
+
+    The data is a dict of the collection path to the list of the objects. The lists are filtered by the
+    exact match of the query params, including the `<fk>__<field>` lookups through the foreign keys in
+    `relations`, and they are not paginated.
+    """
+
+    relations = {
+        'nameserver': '/domain/nameserver/',
+        'domain': '/domain/domain/',
+        'record': '/domain/record/',
+        'node': '/shadowsocks/node/',
+    }
+
+    def __init__(self, data=None, **kwargs):
+        super().__init__(scheme='memory', host='memory', **kwargs)
+        self._data_lock = threading.Lock()
+        self.reset(data)
+
+    def reset(self, data=None):
+        with self._data_lock:
+            self.data = copy.deepcopy(data or {})
+            ids = [obj['id'] for objs in self.data.values() for obj in objs]
+            self.next_id = max(ids, default=0) + 1
+
+    def ensure_authenticated(self, force=False):
+        pass
+
+    def _get_value(self, obj, lookup):
+        field, _, rest = lookup.partition('__')
+        value = obj.get(field)
+        if rest and field in self.relations:
+            related = [o for o in self.data.get(self.relations[field], []) if o['id'] == value]
+            return self._get_value(related[0], rest) if related else None
+        return value
+
+    def _respond(self, url, status_code, body=None):
+        response = requests.Response()
+        response.url = url
+        response.status_code = status_code
+        response.reason = http_reasons.get(status_code)
+        response._content = b'' if body is None else json.dumps(body).encode()
+        return response
+
+    def send(self, resource, **kwargs):
+        method = kwargs.get('method', '').lower()
+        path = '/{}/'.format(resource.strip('/'))
+        collection, obj_id = path, None
+        head, _, tail = path.rstrip('/').rpartition('/')
+        if tail.isdigit():
+            collection, obj_id = head + '/', int(tail)
+        body = kwargs.get('json') or kwargs.get('data') or {}
+
+        with self._data_lock:
+            objs = self.data.setdefault(collection, [])
+            if obj_id is None:
+                if method == 'get':
+                    params = {k: v for k, v in (kwargs.get('params') or {}).items() if k not in [self.limit_param, 'offset']}
+                    found = [obj for obj in objs
+                             if all(str(self._get_value(obj, k)) == str(v) for k, v in params.items())]
+                    return self._respond(kwargs['url'], 200, copy.deepcopy(found))
+                if method == 'post':
+                    obj = dict(copy.deepcopy(body), id=self.next_id)
+                    self.next_id += 1
+                    objs.append(obj)
+                    return self._respond(kwargs['url'], 201, copy.deepcopy(obj))
+                return self._respond(kwargs['url'], 405, {'detail': 'Method "{}" not allowed.'.format(method.upper())})
+
+            # DRF filters the object of the detail endpoint by the query params too
+            params = kwargs.get('params') or {}
+            found = [obj for obj in objs if obj['id'] == obj_id
+                     and all(str(self._get_value(obj, k)) == str(v) for k, v in params.items())]
+            if not found:
+                return self._respond(kwargs['url'], 404, {'detail': 'Not found.'})
+            obj = found[0]
+            if method == 'get':
+                return self._respond(kwargs['url'], 200, copy.deepcopy(obj))
+            if method in ['put', 'patch']:
+                obj.update(copy.deepcopy(body), id=obj_id)
+                return self._respond(kwargs['url'], 200, copy.deepcopy(obj))
+            if method == 'delete':
+                objs.remove(obj)
+                return self._respond(kwargs['url'], 204)
+            return self._respond(kwargs['url'], 405, {'detail': 'Method "{}" not allowed.'.format(method.upper())})
+
+
+_memory_api = None
+
+
+def get_memory_api():
+    """
+    Get the shared MemoryAPI instance of the in-memory transport of the callers.
+    """
+    global _memory_api
+    with _api_clients_lock:
+        if _memory_api is None:
+            _memory_api = MemoryAPI()
+    return _memory_api
+
+
+def get_api_params():
+    api_params = {
+        'scheme': os.getenv('SSM_SCHEME'),
+        'host': os.getenv('SSM_HOST'),
+        'username': os.getenv('SSM_ADMIN_USERNAME'),
+        'password': os.getenv('SSM_ADMIN_PASSWORD'),
+        'login_path': os.getenv('SSM_LOGIN_PATH'),
+        'api_base': os.getenv('SSM_API_BASE'),
+        'csrf_enabled': os.getenv('SSM_CSRF_ENABLED', '').lower() in ['true', '1'] if os.getenv('SSM_CSRF_ENABLED') else None,
+        'timeout': float(os.getenv('SSM_TIMEOUT')) if os.getenv('SSM_TIMEOUT') else None,
+        'limit_param': os.getenv('SSM_LIMIT_PARAM'),
+        'auth_scheme': os.getenv('SSM_AUTH_SCHEME'),
+        'token_path': os.getenv('SSM_TOKEN_PATH'),
+        'token_refresh_path': os.getenv('SSM_TOKEN_REFRESH_PATH'),
+        'token_store': os.getenv('SSM_TOKEN_STORE'),
+        'token_ttl': float(os.getenv('SSM_TOKEN_TTL')) if os.getenv('SSM_TOKEN_TTL') else None,
+        'max_retries': int(os.getenv('SSM_MAX_RETRIES')) if os.getenv('SSM_MAX_RETRIES') else None,
+        'hedge': os.getenv('SSM_HEDGE', '').lower() in ['true', '1'] if os.getenv('SSM_HEDGE') else None,
+        'hedge_delay': float(os.getenv('SSM_HEDGE_DELAY')) if os.getenv('SSM_HEDGE_DELAY') else None,
+        'breaker_threshold': int(os.getenv('SSM_BREAKER_THRESHOLD')) if os.getenv('SSM_BREAKER_THRESHOLD') else None,
+        'breaker_reset_timeout': float(os.getenv('SSM_BREAKER_RESET_TIMEOUT')) if os.getenv('SSM_BREAKER_RESET_TIMEOUT') else None,
+    }
+    return {k: v for k, v in api_params.items() if v is not None}
+
+
+def get_api(**api_params):
+    """
+    Get the cached DRFAPI instance for the connection settings, build it at the first use.
+
+    The instance keeps the session, cookies and CSRF token, so the warm invocations skip the login.
+    """
+    key = tuple(sorted(api_params.items()))
+    with _api_clients_lock:
+        api = _api_clients.get(key)
+        if api is None:
+            api = _api_clients[key] = DRFAPI(**api_params)
+    return api
+
+
+def get_body(response):
+    # the response of DELETE has no content
+    return response.json() if response.content else None
+
+
+# the options of the GET of a collection, see the List Example of the module
+LIST_OPTIONS = ['first', 'limit', 'fields', 'paginate', 'cursor']
+
+
+def process_request(api, request):
+    """
+    Make a single request with the API, return the dict of the status code and body.
+    """
+    # the correlation id is passed by the caller to correlate the metrics across the Lambdas
+    request = dict(request)
+    _context.correlation_id = request.pop('correlation_id', None)
+    # the profile flag is taken by vpn_common.profiled, never passed to requests.Session.request
+    request.pop('profile', None)
+
+    method = request.get('method', '').lower()
+    result = {}
+    try:
+        if method == 'upsert':
+            request = {k: v for k, v in request.items() if k != 'method'}
+            response, result['action'] = api.upsert(**request)
+            status_code, body = response.status_code, get_body(response)
+        elif method == 'answer_set':
+            request = {k: v for k, v in request.items() if k != 'method'}
+            status_code, body, result['action'] = api.update_set(**request)
+        elif method == 'get' and any(k in request for k in LIST_OPTIONS):
+            request = {k: v for k, v in request.items() if k != 'method'}
+            status_code, body = 200, api.list(**request)
+        else:
+            response = api.call(**request)
+            status_code, body = response.status_code, get_body(response)
+        logger.info('Response: %s %s %s', method, request.get('resource'), status_code)
+        logger.debug('Response body: %s', LazyJson(body))
+    except requests.HTTPError as e:
+        logger.error('Error: %s', e)
+        return {'status_code': e.response.status_code, 'body': str(e)}
+    except CircuitOpenError as e:
+        # the caller can tell it from the other errors, and retry it later
+        logger.error('Error: %s', e)
+        return {'status_code': 503, 'body': str(e)}
+    except Exception as e:
+        logger.error('Error: %s', e)
+        return {'status_code': 500, 'body': str(e)}
+
+    result.update({
+        'status_code': status_code,
+        'body': body
+    })
+    return result
+
+
+def process_batch(api, batch, max_workers=None):
+    """
+    Make the batch of requests concurrently, return the results in the same order of the requests.
+
+    A request runs after the requests listed in its `depends_on`, which must be the indexes of the earlier
+    requests. Because the requests are submitted in order, a worker only waits for the requests already
+    taken by the other workers, so the bounded pool never deadlocks.
+    """
+    max_workers = max_workers or int(os.getenv('SSM_BATCH_MAX_WORKERS', 4))
+    futures = []
+
+    def run(index, request):
+        depends_on = request.pop('depends_on', None)
+        if depends_on is None:
+            depends_on = []
+        elif isinstance(depends_on, int):
+            depends_on = [depends_on]
+
+        for i in depends_on:
+            if not isinstance(i, int) or not 0 <= i < index:
+                return {'status_code': 400, 'body': 'invalid depends_on: {}, expect the index of an earlier request.'.format(i)}
+            if futures[i].result()['status_code'] >= 400:
+                return {'status_code': 424, 'body': 'skipped due to the failure of the request: {}'.format(i)}
+
+        return process_request(api, request)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for index, request in enumerate(batch):
+            futures.append(executor.submit(run, index, dict(request)))
+        return [future.result() for future in futures]
+
+
+@profiled
 def lambda_handler(event, context):
     """
     Handles an AWS Lambda event by making a request to a Django Rest Framework API.
 
     Parameters
     ----------
-    event : dict
-        The event data.
+    event : dict | list
+        The event data, or a list of them to make a batch of requests.
 
         resource : str
             The path to the resource.
+        method : str
+            The HTTP method, or `upsert` to update or create the object found by `lookup`.
+        lookup : dict
+            Only for upsert and answer_set, the params to look up the existing object in the collection.
+        field, add, remove, delete_empty :
+            Only for answer_set, see the Answer Set Example of the module.
+        first, limit, fields, paginate, cursor :
+            Only for the GET of a collection, see the List Example of the module.
+        depends_on : [int | list]
+            Only for the batch, the index(es) of the earlier requests to wait for.
+        correlation_id : str
+            The id to correlate the metrics of the request with the caller's.
+        profile : bool
+            Profile the invocation, see vpn_common.profiled, it's never passed to the API.
         **kwargs : dict
             The keyword arguments to pass to requests.Session.request.
 
@@ -107,41 +909,27 @@ def lambda_handler(event, context):
 
     Returns
     -------
-    dict
-        A dictionary containing the status code and body of the API response.
+    dict | list
+        A dictionary containing the status code and body of the API response, or a list of them
+        in the same order of the batch.
         
         status_code : int
             The status code of the API response.
         body : [dict | list | str]
             The body of the API response.
+        action : str
+            Only for upsert and answer_set, `created`, `updated`, `deleted` or `unchanged`.
     """
 
-    print('Received event: ' + json.dumps(event))
+    logger.debug('Received event: %s', LazyJson(event))
 
-    api_params = {
-        'scheme': os.getenv('SSM_SCHEME'),
-        'host': os.getenv('SSM_HOST'),
-        'username': os.getenv('SSM_ADMIN_USERNAME'),
-        'password': os.getenv('SSM_ADMIN_PASSWORD'),
-        'login_path': os.getenv('SSM_LOGIN_PATH'),
-        'api_base': os.getenv('SSM_API_BASE'),
-        'csrf_enabled': lambda x: x.lower() in ['true', '1'] if os.getenv('SSM_CSRF_ENABLED') else None,
-        'timeout': os.getenv('SSM_TIMEOUT'),
-    }
-    api_params = {k: v for k, v in api_params.items() if v is not None}
+    return process_event(get_api(**get_api_params()), event)
 
-    try:
-        api = DRFAPI(**api_params)
-        response = api.call(**event)
-        print('Response: {} {}'.format(response.status_code, response.json()))
-    except requests.HTTPError as e:
-        print('Error: {}'.format(e))
-        return {'status_code': e.response.status_code, 'body': str(e)}
-    except Exception as e:
-        print('Error: {}'.format(e))
-        return {'status_code': 500, 'body': str(e)}
 
-    return {
-        'status_code': response.status_code,
-        'body': response.json()
-    }
\ No newline at end of file
+def process_event(api, event):
+    """
+    Make the request or the batch of requests of the event with the API, see `lambda_handler`.
+    """
+    if isinstance(event, list):
+        return process_batch(api, event)
+    return process_request(api, event)
@@ -6,14 +6,106 @@ Supported action:
 1. Change the node IP:
   * Message body: 'changeip'
 
+All the records of the event are processed, the duplicate 'changeip' messages are coalesced into
+a single change of the IP. A change is skipped if the stack is being updated, or the IP has been
+changed in the last CHANGE_IP_DEBOUNCE_SECONDS seconds. The time of the last change is recorded in
+the SSM parameter CHANGE_IP_MARKER_PARAMETER, so the concurrent invocations can see each other, the
+marker is claimed under a lock parameter, see claim_marker.
+
+The IP is changed in the way of CHANGE_IP_MODE:
+  * stack: update the stack with the switched parameter EipDomain, which replaces the EIP of the stack.
+  * eip: allocate a new EIP and associate it with the instance through the EC2 API, which takes seconds
+    instead of minutes. The EIP of the stack is left allocated, only the EIPs allocated by the previous
+    changes are released, so the stack never loses track of its own. It falls back to the stack update
+    on any failure.
+The new IP is synced to the Node and Record of shadowsocks-manager by the AWS Config notification of
+the instance, the same in both ways.
 """
 
 import os
 import json
-import boto3
+import time
+import uuid
+from vpn_common import get_client
 
 print('Loading function')
 
+# the IP is changed at most once in the window
+CHANGE_IP_DEBOUNCE_SECONDS = int(os.getenv('CHANGE_IP_DEBOUNCE_SECONDS', 60))
+
+# the tag of the EIPs allocated by this Lambda, the value is the stack id
+EIP_TAG_KEY = 'aws-cfn-vpn:stack-id'
+# the logical id of the instance in the stack
+INSTANCE_LOGICAL_ID = 'VPNServerInstance'
+
+
+def normalize_message(message):
+    # convert to lower and remove any [_- \t]
+    return message.lower().translate({ord(i): None for i in ['_', '-', ' ', '\t']})
+
+
+def get_marker_name(stack):
+    return os.getenv('CHANGE_IP_MARKER_PARAMETER') or '/aws-cfn-vpn/{}/change-ip'.format(stack.stack_name)
+
+
+def get_marker(ssm, name):
+    try:
+        return json.loads(ssm.get_parameter(Name=name)['Parameter']['Value'])
+    except ssm.exceptions.ParameterNotFound:
+        return None
+
+
+def claim_marker(ssm, name):
+    """
+    Record the time of the change in the marker, return the claim if it's not changed in the window,
+    otherwise None.
+
+    The SSM parameter has no compare-and-set, so the check and the write of the marker are serialized
+    by the lock parameter `<marker>-lock`, which is created without overwrite, SSM fails the creation
+    with ParameterAlreadyExists while another invocation holds it. Only one of the concurrent
+    invocations claims, the later ones see its marker. The lock is held for the check and the write
+    only, the IP is changed after it's released. A lock left by a crashed invocation is removed once
+    it's older than the window, the request removing it is skipped.
+    """
+    import botocore.exceptions
+
+    lock = '{}-lock'.format(name)
+    claim = {'time': time.time(), 'id': str(uuid.uuid4())}
+    try:
+        ssm.put_parameter(Name=lock, Value=json.dumps(claim), Type='String', Overwrite=False)
+    except ssm.exceptions.ParameterAlreadyExists:
+        held = get_marker(ssm, lock)
+        if held and claim['time'] - held['time'] >= CHANGE_IP_DEBOUNCE_SECONDS:
+            print('Remove the stale lock of {:.0f}s ago'.format(claim['time'] - held['time']))
+            ssm.delete_parameter(Name=lock)
+        print('Skip: the IP is being changed by another invocation')
+        return None
+
+    try:
+        marker = get_marker(ssm, name)
+        if marker and claim['time'] - marker['time'] < CHANGE_IP_DEBOUNCE_SECONDS:
+            print('Skip: the IP was changed {:.0f}s ago'.format(claim['time'] - marker['time']))
+            return None
+        ssm.put_parameter(Name=name, Value=json.dumps(claim), Type='String', Overwrite=True)
+        return claim
+    finally:
+        try:
+            ssm.delete_parameter(Name=lock)
+        except botocore.exceptions.ClientError as e:
+            # it's removed as a stale lock after the window
+            print('Failed to release the lock: {}'.format(e))
+
+
+def release_marker(ssm, name, claim):
+    import botocore.exceptions
+
+    # the change failed, let the next request try again without waiting for the window
+    try:
+        if get_marker(ssm, name) == claim:
+            ssm.delete_parameter(Name=name)
+    except botocore.exceptions.ClientError as e:
+        print('Failed to release the marker: {}'.format(e))
+
 
 def change_ip(stack):
     new_param = []
@@ -36,15 +128,92 @@ def change_ip(stack):
     )
 
 
+def change_ip_by_eip(stack):
+    """
+    Associate a newly allocated EIP with the instance, and release the EIPs of the previous changes.
+    """
+    import botocore.exceptions
+
+    ec2 = get_client('ec2')
+    instance_id = stack.Resource(INSTANCE_LOGICAL_ID).physical_resource_id
+    previous = ec2.describe_addresses(
+        Filters=[{'Name': 'tag:{}'.format(EIP_TAG_KEY), 'Values': [stack.stack_id]}])['Addresses']
+
+    address = ec2.allocate_address(Domain='vpc', TagSpecifications=[{
+        'ResourceType': 'elastic-ip',
+        'Tags': [{'Key': EIP_TAG_KEY, 'Value': stack.stack_id}],
+    }])
+    try:
+        # the EIP associated with the instance before is disassociated
+        ec2.associate_address(AllocationId=address['AllocationId'], InstanceId=instance_id, AllowReassociation=True)
+    except Exception:
+        ec2.release_address(AllocationId=address['AllocationId'])
+        raise
+    print('Associated the EIP {} with the instance {}'.format(address['PublicIp'], instance_id))
+
+    released = []
+    for prev in previous:
+        try:
+            ec2.release_address(AllocationId=prev['AllocationId'])
+            released.append(prev['PublicIp'])
+        except botocore.exceptions.ClientError as e:
+            # it's released at the next change
+            print('Failed to release the EIP {}: {}'.format(prev['PublicIp'], e))
+    if released:
+        print('Released the EIPs: {}'.format(released))
+    return {'InstanceId': instance_id, 'PublicIp': address['PublicIp'], 'Released': released}
+
+
+def change_ip_once(stack):
+    """
+    Change the IP unless the stack is being updated or the IP was changed in the debounce window.
+    """
+    import botocore.exceptions
+
+    if stack.stack_status.endswith('_IN_PROGRESS'):
+        print('Skip: the stack is {}'.format(stack.stack_status))
+        return
+
+    ssm = get_client('ssm')
+    name = get_marker_name(stack)
+    claim = claim_marker(ssm, name)
+    if claim is None:
+        return
+
+    if os.getenv('CHANGE_IP_MODE', 'stack') == 'eip':
+        try:
+            return change_ip_by_eip(stack)
+        except Exception as e:
+            print('Failed to change the IP by the EIP, falling back to the stack update: {!r}'.format(e))
+
+    try:
+        return change_ip(stack)
+    except Exception as e:
+        # the marker is released on any failure, so the IP is not left unchangeable for the window
+        release_marker(ssm, name, claim)
+        if isinstance(e, botocore.exceptions.ClientError) and 'IN_PROGRESS' in str(e):
+            print('Skip: the stack is being updated: {}'.format(e))
+            return
+        raise
+
+
 def lambda_handler(event, context):
     print('Received event: ' + json.dumps(event))
-    message = event['Records'][0]['Sns']['Message']
-    print('Message body: ' + message)
 
-    cfn = boto3.resource('cloudformation')
-    stack = cfn.Stack(os.getenv('STACK_ID'))
+    actions = set()
+    for record in event['Records']:
+        message = record['Sns']['Message']
+        print('Message body: ' + message)
+        action = normalize_message(message)
+        if action == 'changeip':
+            actions.add(action)
+        else:
+            print('Skip the unsupported message: {}'.format(message))
 
-    # convert to lower and remove any [_- \t]
-    message = message.lower().translate({ord(i): None for i in ['_', '-', ' ', '\t']})
-    if message == 'changeip':
-        return change_ip(stack)
+    if 'changeip' in actions:
+        # boto3 is imported at the first use to keep it off the cold start of the messages skipped
+        import boto3
+
+        cfn = boto3.resource('cloudformation')
+        stack = cfn.Stack(os.getenv('STACK_ID'))
+        return change_ip_once(stack)
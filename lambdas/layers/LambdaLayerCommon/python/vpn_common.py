@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+
+"""
+The helpers shared by the Lambdas of aws-cfn-vpn, deployed as the Lambda layer LambdaLayerCommon:
+
+    * Logging: `redact` and `LazyJson`, the payloads are serialized only when the record is emitted.
+    * Metrics: `span`, the timing spans in the CloudWatch Embedded Metric Format.
+    * AWS clients: `get_client`, boto3 is imported at the first use.
+    * SSM API: `invoke_ssm`, the call of the shadowsocks-manager API by the transport of SSM_TRANSPORT.
+    * Resilience: `CircuitBreaker`.
+    * Sets: `split_members`, the members of a comma separated set, such as the answer of a DNS record.
+    * Profiling: `profiled`, the opt-in cProfile and tracemalloc of a Lambda handler.
+
+Usage Example:
+
+from vpn_common import LazyJson, span
+
+with span('LambdaFoo', 'call_foo', correlation_id, Method='get'):
+    logger.debug('Response: %s', LazyJson(resp))
+"""
+
+import contextlib
+import functools
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+
+# the root logger, its level is set by the Lambda
+logger = logging.getLogger()
+
+# the max length of the payloads in the log
+LOG_MAX_LENGTH = int(os.getenv('LOG_MAX_LENGTH', 1024))
+
+# the names of the secrets, their values are redacted in the log
+SECRET_PATTERN = re.compile(r'password|secret|token|authorization|cookie|csrf', re.IGNORECASE)
+# the secrets in the strings, such as: 'LEXICON_NAMECOM_AUTH_TOKEN=xxx'
+SECRET_VALUE_PATTERN = re.compile(r'(\w*(?:password|secret|token)\w*\s*[=:]\s*)[^,;&\s]+', re.IGNORECASE)
+
+# the namespace of the metrics printed in the CloudWatch Embedded Metric Format
+METRICS_NAMESPACE = os.getenv('METRICS_NAMESPACE', 'aws-cfn-vpn')
+
+
+def redact(obj):
+    if isinstance(obj, dict):
+        if SECRET_PATTERN.search(str(obj.get('key', ''))) and 'value' in obj:
+            # the tag in the form of {'key': name, 'value': value}
+            return dict(obj, value='******')
+        return {k: '******' if SECRET_PATTERN.search(str(k)) else redact(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [redact(v) for v in obj]
+    if isinstance(obj, str):
+        return SECRET_VALUE_PATTERN.sub(r'\1******', obj)
+    return obj
+
+
+class LazyJson(object):
+    """
+    Serialize the object for the log only when the record is emitted, with the secrets redacted
+    and the output truncated to LOG_MAX_LENGTH.
+    """
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        text = json.dumps(redact(self.obj), default=str)
+        if len(text) > LOG_MAX_LENGTH:
+            text = '{}...({} more chars)'.format(text[:LOG_MAX_LENGTH], len(text) - LOG_MAX_LENGTH)
+        return text
+
+
+def normalize_path(resource):
+    # '/domain/record/12/' -> '/domain/record/{id}/', keep the cardinality of the metric dimensions low
+    return re.sub(r'/\d+(?=/)', '/{id}', '/{}/'.format(resource.strip('/')))
+
+
+@contextlib.contextmanager
+def span(service, name, correlation_id=None, **dimensions):
+    """
+    Time the block and print the duration and error in the CloudWatch Embedded Metric Format,
+    CloudWatch extracts the metrics from the log without any API call.
+    """
+    start = time.time()
+    error = 0
+    try:
+        yield
+    except Exception:
+        error = 1
+        raise
+    finally:
+        dims = dict(Service=service, Span=name, **dimensions)
+        print(json.dumps(dict({
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': [['Service', 'Span']] + ([list(dims)] if dimensions else []),
+                    'Metrics': [{'Name': 'Duration', 'Unit': 'Milliseconds'}, {'Name': 'Error', 'Unit': 'Count'}],
+                }],
+            },
+            'Duration': round((time.time() - start) * 1000, 3),
+            'Error': error,
+            'CorrelationId': correlation_id,
+        }, **dims)))
+
+
+# the boto3 clients are reused across the warm invocations, the clients are thread-safe
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(service_name, region_name=None, config=None):
+    """
+    Get the boto3 client of the service, created at the first use and cached by the service, the region
+    and the config. The config is a dict of the arguments of botocore.config.Config, so boto3 and botocore
+    are imported only by the paths calling AWS.
+
+    Usage Example:
+
+    get_client('lambda', config=dict(read_timeout=15, retries={'mode': 'adaptive', 'max_attempts': 3}))
+    """
+    key = (service_name, region_name, json.dumps(config, sort_keys=True) if config else None)
+    with _clients_lock:
+        if key not in _clients:
+            import boto3
+            import botocore.config
+
+            # botocore updates the retries of the config in place, it's built from a copy
+            _clients[key] = boto3.client(service_name, region_name=region_name,
+                                         config=botocore.config.Config(**json.loads(key[2])) if config else None)
+        return _clients[key]
+
+
+# the config of the client invoking the Lambda of SSM API, the client is reused, so the adaptive
+# retry mode rate-limits the throttled invokes across the calls
+SSM_LAMBDA_CONFIG = dict(read_timeout=int(os.getenv('SSM_READ_TIMEOUT', 15)), connect_timeout=5,
+                         retries={'mode': 'adaptive', 'max_attempts': 3})
+
+
+def invoke_ssm(payload):
+    """
+    Call the SSM API with the transport of SSM_TRANSPORT, all of them return the same dict (or the list
+    of them for a batch) of `status_code` and `body`:
+
+        * lambda: invoke the Lambda of SSM API, the default.
+        * direct: call the DRF APIs in process with LambdaSsmApi, which saves the hop of the invoke. The
+          module must be deployed along with the calling Lambda, with the SSM_* env vars of the Lambda of
+          SSM API and the network access to the SSM host.
+        * memory: call an in-memory fake of the DRF APIs in process with LambdaSsmApi, for the tests.
+    """
+    transport = os.getenv('SSM_TRANSPORT', 'lambda')
+    if transport == 'lambda':
+        return invoke_ssm_lambda(payload)
+    if transport not in ['direct', 'memory']:
+        raise ValueError('Unsupported SSM_TRANSPORT: {}'.format(transport))
+
+    import LambdaSsmApi
+
+    # round trip the JSON as the invoke does, so the caller never shares the objects with the API
+    payload = json.loads(json.dumps(payload))
+    logger.debug('Calling the SSM API in process with: %s', LazyJson(payload))
+    if transport == 'direct':
+        # not by the handler, the profile of the caller covers the calls
+        func_resp = LambdaSsmApi.process_event(LambdaSsmApi.get_api(**LambdaSsmApi.get_api_params()), payload)
+    else:
+        func_resp = LambdaSsmApi.process_event(LambdaSsmApi.get_memory_api(), payload)
+    func_resp = json.loads(json.dumps(func_resp))
+    logger.debug('Response from the SSM API: %s', LazyJson(func_resp))
+    return func_resp
+
+
+def invoke_ssm_lambda(payload):
+    client = get_client('lambda', config=SSM_LAMBDA_CONFIG)
+    logger.debug('Calling the Lambda of SSM API with: %s', LazyJson(payload))
+    resp = client.invoke(
+        FunctionName=os.getenv('LAMBDA_SSM_API_ARN'),
+        Payload=json.dumps(payload)
+    )
+    logger.debug('Response: %s', LazyJson(resp))
+    if resp['StatusCode'] >= 400:
+        raise Exception('Failed to invoke the Lambda of SSM API. Response: {}'.format(resp))
+
+    func_resp = json.load(resp['Payload'])
+    logger.debug('Response from the SSM API: %s', LazyJson(func_resp))
+    return func_resp
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    """
+    Fail fast while the API is unhealthy, instead of burning the timeout of every call.
+
+    * closed: the calls pass, it opens after `threshold` consecutive failures.
+    * open: the calls fail with CircuitOpenError, until `reset_timeout` seconds passed.
+    * half-open: a single trial call passes, it closes on the success, or opens again on the failure.
+
+    The state transitions are logged as warnings.
+    """
+
+    def __init__(self, name, threshold=5, reset_timeout=30):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def _set_state(self, state):
+        if state != self.state:
+            logger.warning('Circuit breaker %s: %s -> %s, consecutive failures: %s',
+                           self.name, self.state, state, self.failures)
+            self.state = state
+
+    def allow(self):
+        with self._lock:
+            if self.state == 'open':
+                remaining = self.opened_at + self.reset_timeout - time.time()
+                if remaining > 0:
+                    raise CircuitOpenError('circuit breaker {} is open, retry in {:.1f}s'.format(self.name, remaining))
+                self._set_state('half-open')
+                self._trial = False
+            if self.state == 'half-open':
+                if self._trial:
+                    raise CircuitOpenError('circuit breaker {} is half-open, a trial call is in progress'.format(self.name))
+                self._trial = True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._trial = False
+            self._set_state('closed')
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial = False
+            if self.state == 'half-open' or self.failures >= self.threshold:
+                self.opened_at = time.time()
+                self._set_state('open')
+
+
+def split_members(value):
+    # '1.2.3.4, 5.6.7.8' -> ['1.2.3.4', '5.6.7.8'], the members of a comma separated set
+    members = []
+    for member in (value or '').lower().split(','):
+        member = member.strip()
+        if member and member not in members:
+            members.append(member)
+    return members
+
+
+def is_profiling(event):
+    """
+    Tell whether to profile the invocation, by the env PROFILE or the flag `profile` of the event.
+    """
+    if os.getenv('PROFILE', '').lower() in ['1', 'true', 'yes']:
+        return True
+    return isinstance(event, dict) and bool(event.get('profile'))
+
+
+def save_profile(prefix, profiler, snapshot):
+    """
+    Save the pstats and the tracemalloc snapshot to PROFILE_OUTPUT, a local directory or `s3://<bucket>/<prefix>`.
+    """
+    output = os.getenv('PROFILE_OUTPUT')
+    if not output:
+        return
+    dumps = {prefix + '.pstats': profiler.dump_stats, prefix + '.tracemalloc': snapshot.dump}
+    if output.startswith('s3://'):
+        bucket, _, key_prefix = output[len('s3://'):].partition('/')
+        for name, dump in dumps.items():
+            path = os.path.join('/tmp', name)
+            dump(path)
+            try:
+                get_client('s3').upload_file(path, bucket, '/'.join(p for p in [key_prefix.strip('/'), name] if p))
+            finally:
+                os.remove(path)
+    else:
+        os.makedirs(output, exist_ok=True)
+        for name, dump in dumps.items():
+            dump(os.path.join(output, name))
+    logger.info('Saved the profile to %s: %s', output, list(dumps))
+
+
+# set while an invocation is being profiled
+_profiling = False
+
+
+def is_profiler_active():
+    """
+    Tell whether a profiler is already hooked, such as the profiled handler calling another one in process.
+    """
+    if _profiling:
+        return True
+    monitoring = getattr(sys, 'monitoring', None)
+    if monitoring is not None:
+        # cProfile of Python 3.12+ is a tool of sys.monitoring
+        return monitoring.get_tool(monitoring.PROFILER_ID) is not None
+    return sys.getprofile() is not None
+
+
+def profiled(handler):
+    """
+    Profile the Lambda handler with cProfile and tracemalloc if enabled by `is_profiling`, log the top
+    PROFILE_TOP_N functions by the cumulative time and the top allocations, and save the full profile
+    by `save_profile`, named after the module and the handler. The profilers are imported at the first
+    use, the invocations not profiled only pay for the check. The allocations of all the threads are
+    traced, the functions run by the worker threads are profiled where cProfile hooks the whole
+    interpreter (sys.monitoring of Python 3.12+).
+
+    The flag `profile` is removed from the event either way. The handler is not profiled again while
+    a profiler is active, the calls are covered by the outer one.
+    """
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        global _profiling
+
+        profiling = is_profiling(event)
+        if isinstance(event, dict) and 'profile' in event:
+            event = {k: v for k, v in event.items() if k != 'profile'}
+        if not profiling:
+            return handler(event, context)
+        if is_profiler_active():
+            logger.info('Skipped the profile of %s, a profiler is already active', handler.__name__)
+            return handler(event, context)
+
+        import cProfile
+        import io
+        import pstats
+        import tracemalloc
+
+        top_n = int(os.getenv('PROFILE_TOP_N', 20))
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:
+            # another profiling tool took the hook, the invocation runs without the profile
+            logger.warning('Failed to start the profile of %s: %s', handler.__name__, e)
+            return handler(event, context)
+        _profiling = True
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        start = time.time()
+        try:
+            return handler(event, context)
+        finally:
+            profiler.disable()
+            _profiling = False
+            elapsed = time.time() - start
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            if not tracing:
+                tracemalloc.stop()
+
+            stats = io.StringIO()
+            pstats.Stats(profiler, stream=stats).sort_stats('cumulative').print_stats(top_n)
+            allocations = snapshot.statistics('lineno')[:top_n]
+            logger.info('Profile of %s: %.3fs, peak memory: %.1f KiB\n%s',
+                        handler.__name__, elapsed, peak / 1024, stats.getvalue())
+            logger.info('Top allocations of %s:\n%s', handler.__name__, '\n'.join(str(s) for s in allocations))
+            try:
+                request_id = getattr(context, 'aws_request_id', None) or str(int(time.time() * 1000))
+                save_profile('{}-{}-{}'.format(handler.__module__, handler.__name__, request_id), profiler, snapshot)
+            except Exception as e:
+                # the profile never fails the invocation
+                logger.warning('Failed to save the profile: %s', e)
+    return wrapper
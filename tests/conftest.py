@@ -0,0 +1,12 @@
+import os
+import sys
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+LAMBDAS_DIR = os.path.join(ROOT_DIR, 'lambdas')
+# the shared module of the Lambda layer, at /opt/python in the Lambda runtime
+LAYER_DIR = os.path.join(LAMBDAS_DIR, 'layers', 'LambdaLayerCommon', 'python')
+BENCH_DIR = os.path.join(ROOT_DIR, 'benchmarks')
+
+for path in [BENCH_DIR, LAYER_DIR, LAMBDAS_DIR]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
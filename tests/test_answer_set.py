@@ -0,0 +1,125 @@
+import json
+import os
+import threading
+import time
+
+import pytest
+
+from conftest import BENCH_DIR
+
+RECORDS = '/domain/record/'
+LOOKUP = dict(fqdn='ss.example.com', type='A')
+
+
+@pytest.fixture
+def api():
+    import LambdaSsmApi
+
+    return LambdaSsmApi.MemoryAPI({RECORDS: [dict(id=1, fqdn='ss.example.com', type='A', answer='1.1.1.1')]},
+                                  backoff_base=0.001, backoff_cap=0.01)
+
+
+def get_answer(api):
+    records = api.data[RECORDS]
+    return records[0]['answer'] if records else None
+
+
+def test_concurrent_adds(api, monkeypatch):
+    ips = ['10.0.0.{}'.format(i) for i in range(20)]
+    barrier = threading.Barrier(len(ips))
+    errors = []
+    send = api.send
+    conflicts = []
+
+    def send_slowly(resource, **kwargs):
+        response = send(resource, **kwargs)
+        if kwargs.get('method') == 'get':
+            # widen the window between the read and the write, so the writes race
+            time.sleep(0.005)
+        elif response.status_code == 404:
+            conflicts.append(resource)
+        return response
+
+    monkeypatch.setattr(api, 'send', send_slowly)
+
+    def add(ip):
+        barrier.wait()
+        try:
+            api.update_set(RECORDS, lookup=LOOKUP, add=[ip], max_attempts=100)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=add, args=(ip,)) for ip in ips]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert conflicts
+    assert sorted(get_answer(api).split(',')) == sorted(['1.1.1.1'] + ips)
+
+
+def test_retry_on_concurrent_change(api, monkeypatch):
+    send = api.send
+    patches = []
+
+    def send_after_change(resource, **kwargs):
+        if kwargs.get('method') == 'patch' and not patches:
+            # another node adds its IP between the read and the write
+            api.data[RECORDS][0]['answer'] = '1.1.1.1,2.2.2.2'
+        if kwargs.get('method') == 'patch':
+            patches.append(kwargs.get('params'))
+        return send(resource, **kwargs)
+
+    monkeypatch.setattr(api, 'send', send_after_change)
+    status_code, body, action = api.update_set(RECORDS, lookup=LOOKUP, add=['3.3.3.3'])
+    assert (status_code, action) == (200, 'updated')
+    # the first write is conditional on the stale value and fails with 404, the retry reads the fresh one
+    assert patches == [{'answer': '1.1.1.1'}, {'answer': '1.1.1.1,2.2.2.2'}]
+    assert body['answer'] == get_answer(api) == '1.1.1.1,2.2.2.2,3.3.3.3'
+
+
+def test_retry_exhausted(api, monkeypatch):
+    send = api.send
+
+    def send_after_change(resource, **kwargs):
+        if kwargs.get('method') == 'patch':
+            api.data[RECORDS][0]['answer'] += ',9.9.9.9'
+        return send(resource, **kwargs)
+
+    monkeypatch.setattr(api, 'send', send_after_change)
+    with pytest.raises(RuntimeError):
+        api.update_set(RECORDS, lookup=LOOKUP, add=['3.3.3.3'], max_attempts=2)
+
+
+def test_delete_empty(api):
+    assert api.update_set(RECORDS, lookup=LOOKUP, remove=['1.1.1.1'])[2] == 'updated'
+    assert get_answer(api) == ''
+
+    api.data[RECORDS][0]['answer'] = '1.1.1.1'
+    assert api.update_set(RECORDS, lookup=LOOKUP, remove=['1.1.1.1'], delete_empty=True)[2] == 'deleted'
+    assert api.data[RECORDS] == []
+    # nothing to remove from the absent record, nothing created without a member to add
+    assert api.update_set(RECORDS, lookup=LOOKUP, remove=['1.1.1.1'], delete_empty=True)[2] == 'unchanged'
+    assert api.data[RECORDS] == []
+
+
+def test_record_update_replaces_previous_ip(monkeypatch):
+    import LambdaSnsTopicSubscriber
+    import LambdaSsmApi
+
+    monkeypatch.setenv('SSM_TRANSPORT', 'memory')
+    memory_api = LambdaSsmApi.get_memory_api()
+    memory_api.reset({RECORDS: [dict(id=1, fqdn='ss.example.com', type='A', answer='3.80.10.11,1.1.1.1')]})
+    try:
+        with open(os.path.join(BENCH_DIR, 'fixtures', 'update-ip.json')) as f:
+            event = json.load(f)['event']
+        cicn = LambdaSnsTopicSubscriber.CICN(json.loads(event['Records'][0]['Sns']['Message']))
+        assert cicn.change_type == 'UPDATE'
+
+        # the IP before the rotation is replaced, the IPs of the other nodes are kept
+        LambdaSnsTopicSubscriber.SsnRecordHandler(cicn).update()
+        assert memory_api.data[RECORDS][0]['answer'] == '1.1.1.1,54.90.20.22'
+    finally:
+        memory_api.reset()
@@ -0,0 +1,237 @@
+import copy
+import json
+import os
+
+import pytest
+
+from conftest import BENCH_DIR
+
+HANDLERS = ['NameServerHandler', 'SsnRecordHandler', 'NodeHandler', 'SSManagerHandler']
+
+
+def load_message(name='update-ip'):
+    with open(os.path.join(BENCH_DIR, 'fixtures', '{}.json'.format(name))) as f:
+        event = json.load(f)['event']
+    return json.loads(event['Records'][0]['Sns']['Message'])
+
+
+def make_message(changed_properties, change_type='UPDATE', capture_time=None, resource_id=None):
+    message = copy.deepcopy(load_message())
+    message['configurationItemDiff'] = dict(changeType=change_type, changedProperties=changed_properties)
+    if capture_time:
+        message['configurationItem']['configurationItemCaptureTime'] = capture_time
+    if resource_id:
+        message['configurationItem']['resourceId'] = resource_id
+    return message
+
+
+def make_cicn(changed_properties, change_type='UPDATE', capture_time=None, resource_id=None):
+    import LambdaSnsTopicSubscriber
+
+    return LambdaSnsTopicSubscriber.CICN(make_message(changed_properties, change_type, capture_time, resource_id))
+
+
+def tag(key, value='x'):
+    return {'key': key, 'value': value}
+
+
+@pytest.mark.parametrize('changed_properties, paths, tag_keys, affected', [
+    # the IP rotation
+    ({'Configuration.PublicIpAddress': {'previousValue': '3.80.10.11', 'updatedValue': '54.90.20.22',
+                                        'changeType': 'UPDATE'}},
+     {'publicipaddress'}, set(), ['SsnRecordHandler', 'NodeHandler']),
+    # a child of a path of the handler
+    ({'Configuration.State.Name': {'previousValue': 'running', 'updatedValue': 'stopped', 'changeType': 'UPDATE'}},
+     {'state.name'}, set(), ['NodeHandler']),
+    # a parent of a path of the handler
+    ({'Configuration.State': {'previousValue': {'name': 'running'}, 'updatedValue': {'name': 'stopped'},
+                              'changeType': 'UPDATE'}},
+     {'state'}, set(), ['NodeHandler']),
+    # the inputs of none of the handlers
+    ({'Configuration.NetworkInterfaces.0': {'previousValue': None, 'updatedValue': None, 'changeType': 'UPDATE'}},
+     {'networkinterfaces.0'}, set(), []),
+    # a tag removed, only the previous value
+    ({'Configuration.Tags.3': {'previousValue': tag('SSManager'), 'changeType': 'DELETE'}},
+     set(), {'SSManager'}, ['SSManagerHandler']),
+    # a tag added, only the updated value
+    ({'Configuration.Tags.4': {'updatedValue': tag('Name', 'vpn-01'), 'changeType': 'CREATE'}},
+     set(), {'Name'}, ['NodeHandler', 'SSManagerHandler']),
+    # a tag changed
+    ({'Configuration.Tags.2': {'previousValue': tag('DomainNameServerEnv', 'a'),
+                               'updatedValue': tag('DomainNameServerEnv', 'b'), 'changeType': 'UPDATE'}},
+     set(), {'DomainNameServerEnv'}, ['NameServerHandler']),
+    # the handlers enabled are changed
+    ({'Configuration.Tags.1': {'previousValue': tag('ConfigHandlerClass', 'NodeHandler'),
+                               'updatedValue': tag('ConfigHandlerClass', 'NodeHandler,SSManagerHandler'),
+                               'changeType': 'UPDATE'}},
+     set(), {'ConfigHandlerClass'}, HANDLERS),
+    # the changed tags can't be told from the diff
+    ({'Configuration.Tags': {'previousValue': None, 'updatedValue': None, 'changeType': 'UPDATE'}},
+     set(), {'*'}, HANDLERS),
+    # the whole configuration
+    ({'Configuration': {'previousValue': {}, 'updatedValue': {}, 'changeType': 'UPDATE'}},
+     {''}, {'*'}, HANDLERS),
+])
+def test_is_affected(changed_properties, paths, tag_keys, affected):
+    import LambdaSnsTopicSubscriber
+
+    cicn = make_cicn(changed_properties)
+    assert cicn.changed_paths == paths
+    assert cicn.changed_tag_keys == tag_keys
+    assert [name for name in HANDLERS if cicn.is_affected(getattr(LambdaSnsTopicSubscriber, name))] == affected
+
+
+@pytest.mark.parametrize('change_type', ['CREATE', 'DELETE'])
+def test_is_affected_except_update(change_type):
+    import LambdaSnsTopicSubscriber
+
+    cicn = make_cicn({}, change_type)
+    assert all(cicn.is_affected(getattr(LambdaSnsTopicSubscriber, name)) for name in HANDLERS)
+
+
+def make_handlers(monkeypatch, specs, calls):
+    """
+    Define the handlers of the names to their dependencies in the module, the handlers named `*Failing`
+    raise ValueError, the others record their names in `calls`.
+    """
+    import LambdaSnsTopicSubscriber
+
+    classes = []
+    for name, depends_on in specs:
+        def create(self, name=name):
+            calls.append(name)
+            if name.endswith('Failing'):
+                raise ValueError(name)
+            return name
+
+        cls = type(name, (LambdaSnsTopicSubscriber.Handler,), dict(depends_on=depends_on, create=create))
+        monkeypatch.setattr(LambdaSnsTopicSubscriber, name, cls, raising=False)
+        classes.append(cls)
+    return classes
+
+
+def make_cicn_with_handlers(monkeypatch, specs, calls):
+    import LambdaSnsTopicSubscriber
+
+    make_handlers(monkeypatch, specs, calls)
+    message = copy.deepcopy(load_message('create'))
+    for item in message['configurationItem']['configuration']['tags']:
+        if item['key'] == 'ConfigHandlerClass':
+            item['value'] = ','.join(name for name, _ in specs)
+    return LambdaSnsTopicSubscriber.CICN(message)
+
+
+def test_sort_handlers(monkeypatch):
+    import LambdaSnsTopicSubscriber
+
+    a, b, c, d = make_handlers(monkeypatch, [('A', ()), ('B', ('A',)), ('C', ('B', 'Missing')), ('D', ())], [])
+    assert LambdaSnsTopicSubscriber.sort_handlers([c, b, d, a]) == [d, a, b, c]
+
+    x, y = make_handlers(monkeypatch, [('X', ('Y',)), ('Y', ('X',))], [])
+    with pytest.raises(RuntimeError, match='circular dependencies'):
+        LambdaSnsTopicSubscriber.sort_handlers([x, y])
+
+
+def test_process_in_dependency_order(monkeypatch):
+    calls = []
+    cicn = make_cicn_with_handlers(monkeypatch, [('C', ('B',)), ('B', ('A',)), ('A', ()), ('D', ('A',))], calls)
+    succeeded = []
+    results = cicn.process(max_workers=4, on_success=succeeded.append)
+
+    # the results are in the scheduled order, the dependents run after their dependencies
+    assert [r['handler'] for r in results] == ['A', 'B', 'C', 'D']
+    assert calls.index('A') < calls.index('B') < calls.index('C')
+    assert calls.index('A') < calls.index('D')
+    assert sorted(succeeded) == ['A', 'B', 'C', 'D']
+    assert all(r['error'] is None and r['result'] == r['handler'] for r in results)
+
+
+def test_process_skips_dependents_of_failure(monkeypatch, caplog):
+    calls = []
+    cicn = make_cicn_with_handlers(monkeypatch, [
+        ('AFailing', ()), ('B', ('AFailing',)), ('C', ('B',)), ('D', ()), ('EFailing', ()),
+    ], calls)
+    succeeded = []
+
+    # the first error in the scheduled order is raised after all the handlers are done
+    with pytest.raises(ValueError, match='^AFailing$'):
+        cicn.process(max_workers=4, on_success=succeeded.append)
+
+    assert sorted(calls) == ['AFailing', 'D', 'EFailing']
+    assert succeeded == ['D']
+    messages = [r.getMessage() for r in caplog.records]
+    assert 'CREATE B skipped due to the failure of the dependency: AFailing' in messages
+    assert 'CREATE C skipped due to the failure of the dependency: B' in messages
+
+
+def test_process_skips_done(monkeypatch):
+    calls = []
+    cicn = make_cicn_with_handlers(monkeypatch, [('A', ()), ('B', ('A',))], calls)
+    results = cicn.process(done={'A'})
+    assert calls == ['B']
+    assert [r['handler'] for r in results] == ['B']
+
+
+def ip_change(previous, updated):
+    return {'Configuration.PublicIpAddress': {'previousValue': previous, 'updatedValue': updated,
+                                              'changeType': 'UPDATE'}}
+
+
+def test_coalesce_keeps_earliest_previous_value():
+    import LambdaSnsTopicSubscriber
+
+    earlier = make_cicn(dict(ip_change('1.1.1.1', '2.2.2.2'), **{
+        'Configuration.State.Name': {'previousValue': 'running', 'updatedValue': 'stopped', 'changeType': 'UPDATE'},
+    }), capture_time='2024-05-02T09:00:00.000Z')
+    latest = make_cicn(ip_change('2.2.2.2', '3.3.3.3'), capture_time='2024-05-02T09:05:00.000Z')
+    assert latest.changed_paths == {'publicipaddress'}
+
+    for cicn in [latest.coalesce(earlier), make_cicn(ip_change('2.2.2.2', '3.3.3.3'),
+                                                      capture_time='2024-05-02T09:05:00.000Z').coalesce(earlier)]:
+        assert cicn.capture_time == '2024-05-02T09:05:00.000Z'
+        assert cicn.diff_item['changedProperties']['Configuration.PublicIpAddress'] == {
+            'previousValue': '1.1.1.1', 'updatedValue': '3.3.3.3', 'changeType': 'UPDATE'}
+        # the changes of the earlier one are kept, the memoized properties are recomputed
+        assert cicn.changed_paths == {'publicipaddress', 'state.name'}
+        assert LambdaSnsTopicSubscriber.SsnRecordHandler(cicn).previous_answer == '1.1.1.1'
+
+
+def test_coalesce_in_either_order():
+    for change_types in [('CREATE', 'UPDATE'), ('UPDATE', 'CREATE')]:
+        earlier = make_cicn(ip_change(None, '1.1.1.1'), change_types[0], '2024-05-02T09:00:00.000Z')
+        latest = make_cicn(ip_change('1.1.1.1', '2.2.2.2'), change_types[1], '2024-05-02T09:05:00.000Z')
+        for cicn in [earlier.coalesce(latest), latest.coalesce(earlier)]:
+            assert cicn is latest
+            # the resource created in the batch needs a full sync
+            assert cicn.change_type == 'CREATE'
+
+    # the resource deleted at last is deleted
+    earlier = make_cicn(ip_change(None, '1.1.1.1'), 'CREATE', '2024-05-02T09:00:00.000Z')
+    latest = make_cicn({}, 'DELETE', '2024-05-02T09:05:00.000Z')
+    assert earlier.coalesce(latest).change_type == 'DELETE'
+
+
+def make_event(*messages):
+    return {'Records': [{'Sns': {'Subject': 'test', 'Message': json.dumps(message)}} for message in messages]}
+
+
+def test_lambda_handler_processes_latest_per_resource(monkeypatch):
+    import LambdaSnsTopicSubscriber
+
+    processed = []
+    monkeypatch.setattr(LambdaSnsTopicSubscriber, 'process_cicns', processed.extend)
+    event = make_event(
+        make_message(ip_change('3.3.3.3', '4.4.4.4'), capture_time='2024-05-02T09:10:00.000Z', resource_id='i-1'),
+        make_message(ip_change(None, '5.5.5.5'), 'CREATE', '2024-05-02T09:00:00.000Z', resource_id='i-2'),
+        make_message(ip_change('1.1.1.1', '2.2.2.2'), capture_time='2024-05-02T09:01:00.000Z', resource_id='i-1'),
+        make_message({}, 'DELETE', '2024-05-02T09:05:00.000Z', resource_id='i-2'),
+        {'messageType': 'ScheduledNotification'},
+        make_message(ip_change('2.2.2.2', '3.3.3.3'), capture_time='2024-05-02T09:05:00.000Z', resource_id='i-1'),
+    )
+    LambdaSnsTopicSubscriber.lambda_handler(event, None)
+
+    # the latest item of i-1 wins regardless of the order in the batch, with the IP before the batch,
+    # the deleted i-2 is skipped
+    assert [(cicn.resource_id, cicn.capture_time) for cicn in processed] == [('i-1', '2024-05-02T09:10:00.000Z')]
+    assert processed[0].diff_item['changedProperties']['Configuration.PublicIpAddress'] == {
+        'previousValue': '1.1.1.1', 'updatedValue': '4.4.4.4', 'changeType': 'UPDATE'}
@@ -0,0 +1,177 @@
+import json
+import os
+import threading
+
+import boto3
+import pytest
+from botocore.stub import Stubber
+
+from conftest import BENCH_DIR
+
+RESOURCE_ID = 'i-0a1b2c3d4e5f60718'
+
+
+def load_event(name='create', state_id=None, capture_time=None):
+    with open(os.path.join(BENCH_DIR, 'fixtures', '{}.json'.format(name))) as f:
+        event = json.load(f)['event']
+    message = json.loads(event['Records'][0]['Sns']['Message'])
+    if state_id is not None:
+        message['configurationItem']['configurationStateId'] = state_id
+    if capture_time:
+        message['configurationItem']['configurationItemCaptureTime'] = capture_time
+    event['Records'][0]['Sns']['Message'] = json.dumps(message)
+    return event
+
+
+@pytest.fixture
+def subscriber(monkeypatch, tmp_path):
+    import LambdaSnsTopicSubscriber
+    import LambdaSsmApi
+
+    for name in ['EVENT_JOURNAL_TABLE', 'PROFILE']:
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv('SSM_TRANSPORT', 'memory')
+    monkeypatch.setenv('EVENT_JOURNAL_SQLITE', str(tmp_path / 'journal.db'))
+    monkeypatch.setattr(LambdaSnsTopicSubscriber, '_journal', {})
+    LambdaSsmApi.get_memory_api().reset()
+
+    # the SSM calls made by the handlers
+    calls = []
+    invoke_ssm = LambdaSnsTopicSubscriber.invoke_ssm
+
+    def record(payload):
+        calls.append((payload.get('method'), payload.get('resource')))
+        return invoke_ssm(payload)
+
+    monkeypatch.setattr(LambdaSnsTopicSubscriber, 'invoke_ssm', record)
+    LambdaSnsTopicSubscriber.calls = calls
+    yield LambdaSnsTopicSubscriber
+    LambdaSsmApi.get_memory_api().reset()
+
+
+def test_duplicate_skipped(subscriber):
+    subscriber.lambda_handler(load_event(), None)
+    assert subscriber.calls
+    assert subscriber.get_journal().get(RESOURCE_ID)['applied']
+
+    del subscriber.calls[:]
+    subscriber.lambda_handler(load_event(), None)
+    assert subscriber.calls == []
+
+
+def test_out_of_order_skipped(subscriber):
+    subscriber.lambda_handler(load_event(state_id='2', capture_time='2024-05-01T09:00:00.000Z'), None)
+
+    del subscriber.calls[:]
+    subscriber.lambda_handler(load_event(state_id='1', capture_time='2024-05-01T08:00:00.000Z'), None)
+    assert subscriber.calls == []
+    assert subscriber.get_journal().get(RESOURCE_ID)['state_id'] == '2'
+
+
+def test_partial_retry(subscriber, monkeypatch):
+    create = subscriber.NodeHandler.create
+
+    def fail(self):
+        raise RuntimeError('boom')
+
+    monkeypatch.setattr(subscriber.NodeHandler, 'create', fail)
+    with pytest.raises(RuntimeError):
+        subscriber.lambda_handler(load_event(), None)
+    record = subscriber.get_journal().get(RESOURCE_ID)
+    assert not record['applied']
+    assert 'SsnRecordHandler' in record['handlers'] and 'NodeHandler' not in record['handlers']
+
+    # only the failed handler and its dependents run again
+    monkeypatch.setattr(subscriber.NodeHandler, 'create', create)
+    del subscriber.calls[:]
+    subscriber.lambda_handler(load_event(), None)
+    assert subscriber.calls == [('get', '/domain/record/'), ('upsert', '/shadowsocks/node/'),
+                                ('upsert', '/shadowsocks/ssmanager/')]
+    assert subscriber.get_journal().get(RESOURCE_ID)['applied']
+
+
+def test_numeric_state_id(subscriber, monkeypatch):
+    # AWS Config sends the state id as a JSON number
+    create = subscriber.NodeHandler.create
+
+    def fail(self):
+        raise RuntimeError('boom')
+
+    monkeypatch.setattr(subscriber.NodeHandler, 'create', fail)
+    with pytest.raises(RuntimeError):
+        subscriber.lambda_handler(load_event(state_id=1714550460000), None)
+    assert subscriber.get_journal().get(RESOURCE_ID)['state_id'] == '1714550460000'
+
+    monkeypatch.setattr(subscriber.NodeHandler, 'create', create)
+    del subscriber.calls[:]
+    subscriber.lambda_handler(load_event(state_id=1714550460000), None)
+    assert subscriber.calls == [('get', '/domain/record/'), ('upsert', '/shadowsocks/node/'),
+                                ('upsert', '/shadowsocks/ssmanager/')]
+
+    del subscriber.calls[:]
+    subscriber.lambda_handler(load_event(state_id=1714550460000), None)
+    assert subscriber.calls == []
+
+
+def test_dynamodb_numeric_state_id(monkeypatch):
+    import LambdaSnsTopicSubscriber
+
+    client = boto3.client('dynamodb', region_name='us-east-1', aws_access_key_id='x', aws_secret_access_key='x')
+    monkeypatch.setattr(LambdaSnsTopicSubscriber, 'get_client', lambda name: client)
+    journal = LambdaSnsTopicSubscriber.DynamoDBJournal('journal')
+    message = json.loads(load_event(state_id=1714550460000)['Records'][0]['Sns']['Message'])
+    cicn = LambdaSnsTopicSubscriber.CICN(message)
+
+    with Stubber(client) as stubber:
+        stubber.add_response('get_item', {})
+        stubber.add_response('put_item', {}, {
+            'TableName': 'journal',
+            'Item': {
+                'resource_id': {'S': RESOURCE_ID},
+                'state_id': {'S': '1714550460000'},
+                'capture_time': {'S': cicn.capture_time},
+                'applied': {'BOOL': False},
+            },
+            'ConditionExpression': 'attribute_not_exists(resource_id) OR capture_time < :t',
+            'ExpressionAttributeValues': {':t': {'S': cicn.capture_time}},
+        })
+        assert journal.begin(cicn.resource_id, cicn.state_id, cicn.capture_time) == set()
+        stubber.assert_no_pending_responses()
+
+
+def test_concurrent_start(subscriber):
+    journal = subscriber.get_journal()
+    capture_times = ['2024-05-01T08:{:02d}:00.000Z'.format(i) for i in range(20)]
+    barrier = threading.Barrier(len(capture_times))
+    started = {}
+
+    def start(capture_time):
+        barrier.wait()
+        started[capture_time] = journal.start(RESOURCE_ID, capture_time, capture_time)
+
+    threads = [threading.Thread(target=start, args=(t,)) for t in reversed(capture_times)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # the record never steps back, the latest item wins whatever the order
+    assert journal.get(RESOURCE_ID)['state_id'] == capture_times[-1]
+    assert started[capture_times[-1]]
+    assert not journal.start(RESOURCE_ID, capture_times[0], capture_times[0])
+    assert journal.begin(RESOURCE_ID, capture_times[0], capture_times[0]) is None
+
+
+def test_dynamodb_start_conditional(monkeypatch):
+    import LambdaSnsTopicSubscriber
+
+    client = boto3.client('dynamodb', region_name='us-east-1', aws_access_key_id='x', aws_secret_access_key='x')
+    monkeypatch.setattr(LambdaSnsTopicSubscriber, 'get_client', lambda name: client)
+    journal = LambdaSnsTopicSubscriber.DynamoDBJournal('journal')
+
+    with Stubber(client) as stubber:
+        stubber.add_response('put_item', {})
+        stubber.add_client_error('put_item', 'ConditionalCheckFailedException')
+        assert journal.start(RESOURCE_ID, '2', '2024-05-01T09:00:00.000Z')
+        assert not journal.start(RESOURCE_ID, '1', '2024-05-01T08:00:00.000Z')
+        stubber.assert_no_pending_responses()
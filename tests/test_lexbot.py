@@ -0,0 +1,76 @@
+import json
+from unittest import mock
+
+import pytest
+
+NODES = [
+    dict(id=1, name='vpn-0', sns_endpoint='arn:aws:sns:us-east-1:123456789012:vpn-0', is_active=True),
+    dict(id=2, name='vpn-1', sns_endpoint='arn:aws:sns:us-east-1:123456789012:vpn-1', is_active=False),
+]
+
+
+@pytest.fixture
+def lex(monkeypatch):
+    import LambdaLexBot
+    import LambdaSsmApi
+
+    monkeypatch.setenv('SSM_TRANSPORT', 'memory')
+    LambdaSsmApi.get_memory_api().reset({'/shadowsocks/node/': NODES})
+    monkeypatch.setattr(LambdaLexBot, '_nodes_cache', {'expires': 0, 'index': {}})
+    published = []
+    monkeypatch.setattr(LambdaLexBot, 'publish_change_ip', published.append)
+    LambdaLexBot.published = published
+    yield LambdaLexBot
+    LambdaSsmApi.get_memory_api().reset()
+
+
+def event(name, source, session_attributes=None):
+    return {
+        'userId': 'user',
+        'invocationSource': source,
+        'sessionAttributes': session_attributes,
+        'currentIntent': {'name': 'GetNewIpForVpnInstance', 'slots': {'VpnInstanceName': name}},
+    }
+
+
+def test_names_carried_over(lex):
+    session_attributes = {}
+    assert lex.validate_instance('vpn-0', session_attributes)['isValid']
+    assert json.loads(session_attributes[lex.SESSION_NODES_KEY]) == ['vpn-0', 'vpn-1']
+
+    # a later turn on a cold container validates by the carried over names
+    lex._nodes_cache['expires'] = 0
+    with mock.patch.object(lex, 'get_instances', side_effect=AssertionError('refetched')):
+        assert lex.validate_instance('vpn-1', session_attributes)['isValid']
+        resp = lex.lambda_handler(event('vpn-1', 'DialogCodeHook', session_attributes), None)
+    assert resp['dialogAction'] == {'type': 'Delegate', 'slots': {'VpnInstanceName': 'vpn-1'}}
+    assert lex.published == []
+
+
+def test_forged_session_never_publishes(lex):
+    forged = {lex.SESSION_NODES_KEY: json.dumps({
+        'expires': 9999999999,
+        'index': {'evil': dict(name='evil', sns_endpoint='arn:aws:sns:us-east-1:999999999999:evil', is_active=True)},
+    })}
+    resp = lex.lambda_handler(event('evil', 'DialogCodeHook', forged), None)
+    assert resp['dialogAction']['type'] == 'ElicitSlot'
+
+    # a forged name passes the validation hint, but the node is resolved from the SSM listing
+    lex._nodes_cache['expires'] = 0
+    forged = {lex.SESSION_NODES_KEY: json.dumps(['evil'])}
+    resp = lex.lambda_handler(event('evil', 'DialogCodeHook', forged), None)
+    assert resp['dialogAction']['type'] == 'Delegate'
+    resp = lex.lambda_handler(event('evil', 'FulfillmentCodeHook', forged), None)
+    assert resp['dialogAction']['fulfillmentState'] == 'Failed'
+    assert lex.published == []
+
+    resp = lex.lambda_handler(event('vpn-0', 'FulfillmentCodeHook', forged), None)
+    assert resp['dialogAction']['fulfillmentState'] == 'Fulfilled'
+    assert lex.published == [NODES[0]['sns_endpoint']]
+
+
+def test_names_capped(lex, monkeypatch):
+    monkeypatch.setattr(lex, 'SESSION_NODES_MAX', 1)
+    session_attributes = {lex.SESSION_NODES_KEY: json.dumps(['vpn-0'] * 2)}
+    assert lex.validate_instance('vpn-0', session_attributes)['isValid']
+    assert lex.SESSION_NODES_KEY not in session_attributes
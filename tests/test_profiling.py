@@ -0,0 +1,60 @@
+import logging
+
+import pytest
+
+import vpn_common
+
+
+@pytest.fixture
+def ssm_env(monkeypatch):
+    import LambdaSsmApi
+    from fake_ssm import FakeSsmServer
+
+    server = FakeSsmServer().start()
+    monkeypatch.setattr(LambdaSsmApi, '_api_clients', {})
+    for name, value in dict(SSM_SCHEME='http', SSM_HOST=server.host, SSM_ADMIN_USERNAME=server.username,
+                            SSM_ADMIN_PASSWORD=server.password).items():
+        monkeypatch.setenv(name, value)
+    yield LambdaSsmApi
+    server.stop()
+
+
+def test_profile_flag_removed_when_not_profiling(monkeypatch):
+    monkeypatch.delenv('PROFILE', raising=False)
+    events = []
+    handler = vpn_common.profiled(lambda event, context: events.append(event))
+
+    handler({'resource': '/foo/', 'profile': False}, None)
+    assert events == [{'resource': '/foo/'}]
+
+
+def test_nested_handler_not_profiled_again(monkeypatch, caplog):
+    monkeypatch.setenv('PROFILE', 'true')
+    monkeypatch.delenv('PROFILE_OUTPUT', raising=False)
+    inner = vpn_common.profiled(lambda event, context: 'inner')
+    outer = vpn_common.profiled(lambda event, context: inner(event, context))
+
+    with caplog.at_level(logging.INFO):
+        assert outer({}, None) == 'inner'
+    assert 'a profiler is already active' in caplog.text
+    assert not vpn_common.is_profiler_active()
+
+
+def test_ssm_api_ignores_profile_flag(monkeypatch, ssm_env):
+    monkeypatch.delenv('PROFILE', raising=False)
+    resp = ssm_env.lambda_handler(dict(resource='/shadowsocks/node/', method='get', profile=False), None)
+    assert resp['status_code'] == 200
+
+    resp = ssm_env.lambda_handler([dict(resource='/shadowsocks/node/', method='get', profile=True)], None)
+    assert [r['status_code'] for r in resp] == [200]
+
+
+def test_direct_transport_under_profile(monkeypatch, ssm_env):
+    import LambdaSnsTopicSubscriber
+
+    monkeypatch.setenv('PROFILE', 'true')
+    monkeypatch.delenv('PROFILE_OUTPUT', raising=False)
+    monkeypatch.setenv('SSM_TRANSPORT', 'direct')
+    handler = vpn_common.profiled(lambda event, context: LambdaSnsTopicSubscriber.invoke_ssm(event))
+
+    assert handler(dict(resource='/shadowsocks/node/', method='get'), None)['status_code'] == 200
@@ -0,0 +1,113 @@
+import copy
+import json
+import os
+
+import pytest
+
+from conftest import BENCH_DIR
+
+
+def load_instance():
+    with open(os.path.join(BENCH_DIR, 'fixtures', 'create.json')) as f:
+        event = json.load(f)['event']
+    item = json.loads(event['Records'][0]['Sns']['Message'])['configurationItem']
+    return event, item['awsRegion'], item['configuration']
+
+
+def to_instance(configuration, **changes):
+    # the output of EC2 describe_instances
+    configuration = dict(configuration, **changes)
+    return {
+        'InstanceId': configuration['instanceId'],
+        'PublicIpAddress': configuration['publicIpAddress'],
+        'PrivateIpAddress': configuration['privateIpAddress'],
+        'State': {'Name': configuration['state']['name']},
+        'Tags': [{'Key': t['key'], 'Value': t['value']} for t in configuration['tags']],
+    }
+
+
+@pytest.fixture
+def subscriber(monkeypatch):
+    import LambdaSnsTopicSubscriber
+    import LambdaSsmApi
+
+    for name in ['EVENT_JOURNAL_TABLE', 'EVENT_JOURNAL_SQLITE', 'PROFILE']:
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv('SSM_TRANSPORT', 'memory')
+    # the account of the node stack in the fixture
+    monkeypatch.setattr(LambdaSnsTopicSubscriber, 'get_account_id', lambda: '123456789012')
+    LambdaSsmApi.get_memory_api().reset()
+    yield LambdaSnsTopicSubscriber
+    LambdaSsmApi.get_memory_api().reset()
+
+
+def get_record(fqdn):
+    import LambdaSsmApi
+
+    return [r for r in LambdaSsmApi.get_memory_api().data['/domain/record/'] if r['fqdn'] == fqdn][0]
+
+
+def test_reconcile_removes_stale_answer(subscriber, monkeypatch):
+    event, region, configuration = load_instance()
+    subscriber.lambda_handler(copy.deepcopy(event), None)
+    assert get_record('ss.example.com')['answer'] == '3.80.10.11'
+
+    # the notification of the IP rotation is lost
+    instance = to_instance(configuration, publicIpAddress='7.7.7.7')
+    monkeypatch.setattr(subscriber, 'list_instances', lambda regions: iter([(region, instance)]))
+
+    result = subscriber.reconcile_handler(dict(dry_run=True, regions=[region]), None)
+    assert result['errors'] == []
+    answers = [entry['changes']['answer'] for entry in result['plan']
+               if entry['resource'] == '/domain/record/' and 'answer' in entry['changes']]
+    assert ['3.80.10.11,7.7.7.7', '7.7.7.7'] in answers
+    assert get_record('ss.example.com')['answer'] == '3.80.10.11'
+
+    subscriber.reconcile_handler(dict(regions=[region]), None)
+    assert get_record('ss.example.com')['answer'] == '7.7.7.7'
+    assert get_record('admin.ss.example.com')['answer'] == '7.7.7.7'
+
+    # nothing left to do
+    assert subscriber.reconcile_handler(dict(dry_run=True, regions=[region]), None)['plan'] == []
+
+
+def test_reconcile_keeps_answers_of_other_regions(subscriber, monkeypatch):
+    import LambdaSsmApi
+
+    event, region, configuration = load_instance()
+    subscriber.lambda_handler(copy.deepcopy(event), None)
+    data = LambdaSsmApi.get_memory_api().data
+    record = get_record('ss.example.com')
+    record['answer'] += ',8.8.8.8'
+    data['/shadowsocks/node/'].append(dict(id=99, name='vpn-99', public_ip='8.8.8.8', location='Asia Pacific (Tokyo)',
+                                           sns_endpoint='arn:aws:sns:ap-northeast-1:123456789012:vpn-99-ssn-topic',
+                                           is_active=True, record=record['id']))
+
+    instance = to_instance(configuration, publicIpAddress='7.7.7.7')
+    monkeypatch.setattr(subscriber, 'list_instances', lambda regions: iter([(region, instance)]))
+    subscriber.reconcile_handler(dict(regions=[region]), None)
+    # the node of the other region is not reconciled, the record is left as is
+    assert get_record('ss.example.com')['answer'] == '3.80.10.11,8.8.8.8,7.7.7.7'
+
+
+def test_reconcile_keeps_nodes_of_other_accounts(subscriber, monkeypatch):
+    import LambdaSsmApi
+
+    event, region, configuration = load_instance()
+    subscriber.lambda_handler(copy.deepcopy(event), None)
+    data = LambdaSsmApi.get_memory_api().data
+    record = get_record('ss.example.com')
+    record['answer'] += ',9.9.9.9'
+    location = data['/shadowsocks/node/'][0]['location']
+    data['/shadowsocks/node/'].append(dict(id=99, name='vpn-1', public_ip='9.9.9.9', location=location,
+                                           sns_endpoint='arn:aws:sns:us-east-1:999999999999:vpn-1-ssn-topic',
+                                           is_active=True, record=record['id']))
+
+    # the node stack of the other account is not listed by describe_instances
+    instance = to_instance(configuration, publicIpAddress='7.7.7.7')
+    monkeypatch.setattr(subscriber, 'list_instances', lambda regions: iter([(region, instance)]))
+    result = subscriber.reconcile_handler(dict(regions=[region]), None)
+    assert result['errors'] == []
+    assert [entry for entry in result['plan'] if entry['resource'] == '/shadowsocks/node/99/'] == []
+    assert [n for n in data['/shadowsocks/node/'] if n['id'] == 99][0]['is_active']
+    assert '9.9.9.9' in get_record('ss.example.com')['answer'].split(',')
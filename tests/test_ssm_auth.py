@@ -0,0 +1,103 @@
+import threading
+import time
+
+import pytest
+
+import LambdaSsmApi
+from fake_ssm import FakeSsmServer
+
+NODES = '/shadowsocks/node/'
+
+
+@pytest.fixture
+def server():
+    server = FakeSsmServer().start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def make_api(server, tmp_path):
+    def make_api(**kwargs):
+        kwargs = dict(dict(scheme='http', host=server.host, username=server.username, password=server.password,
+                           max_retries=0), **kwargs)
+        api = LambdaSsmApi.DRFAPI(**kwargs)
+        if api.token_cache:
+            # the cache file is shared by the API instances of the test only
+            api.token_cache.path = str(tmp_path / 'token.json')
+        return api
+
+    return make_api
+
+
+def count(server, path, method='POST'):
+    return server.requests.count((method, path))
+
+
+def test_cached_token_reused(server, make_api):
+    assert make_api(auth_scheme='token').call(NODES, method='get').status_code == 200
+    assert count(server, server.token_path) == 1
+
+    # a new container loads the token from the cache instead of obtaining one
+    assert make_api(auth_scheme='token').call(NODES, method='get').status_code == 200
+    assert count(server, server.token_path) == 1
+    assert count(server, server.login_path) == 0
+
+
+def test_rejected_token_obtained_again(server, make_api):
+    api = make_api(auth_scheme='token')
+    api.call(NODES, method='get')
+    rejected = api.token
+
+    server.revoke_tokens()
+    assert api.call(NODES, method='get').status_code == 200
+    assert count(server, server.token_path) == 2
+    assert api.token != rejected
+    assert api.token_cache.load() == api.token
+
+
+def test_jwt_refreshed_in_background(server, make_api):
+    server.jwt_ttl = 30
+    api = make_api(auth_scheme='jwt', token_refresh_margin=60)
+    api.call(NODES, method='get')
+    token = api.token
+    assert count(server, server.jwt_path) == 1
+
+    # the token expiring within the margin is still used, and refreshed without blocking the call
+    assert api.call(NODES, method='get').status_code == 200
+    api._refresh_thread.join(5)
+    assert count(server, server.jwt_refresh_path) == 1
+    assert api.token['access'] != token['access'] and api.token['refresh'] == token['refresh']
+    assert api.call(NODES, method='get').status_code == 200
+    assert count(server, server.jwt_path) == 1
+
+
+def test_session_login_fallback(server, make_api):
+    api = make_api(auth_scheme='jwt', token_path='/missing/')
+    assert api.call(NODES, method='get').status_code == 200
+    assert api.token is None
+    assert count(server, server.login_path) == 1
+    assert 'Authorization' not in api.session.headers
+
+
+def test_hedge_executor_created_once(make_api, monkeypatch):
+    created = []
+
+    class SlowExecutor(LambdaSsmApi.ThreadPoolExecutor):
+        def __init__(self, *args, **kwargs):
+            created.append(self)
+            # widen the window of the race
+            time.sleep(0.05)
+            super().__init__(*args, **kwargs)
+
+    monkeypatch.setattr(LambdaSsmApi, 'ThreadPoolExecutor', SlowExecutor)
+    api = make_api(hedge=True, hedge_delay=1)
+    monkeypatch.setattr(api, 'request', lambda resource, **kwargs: resource)
+
+    threads = [threading.Thread(target=api.request_hedged, args=(NODES,)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(created) == 1
+    api._hedge_executor.shutdown()
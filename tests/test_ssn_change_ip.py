@@ -0,0 +1,192 @@
+import json
+
+import boto3
+import pytest
+from botocore.stub import ANY, Stubber
+
+STACK_ID = 'arn:aws:cloudformation:us-east-1:123456789012:stack/vpn-1/0a1b2c3d'
+MARKER = '/aws-cfn-vpn/vpn-1/change-ip'
+LOCK = MARKER + '-lock'
+CLAIM = {'time': 1000.0, 'id': 'claim-id'}
+
+
+class FakeResource(object):
+
+    def __init__(self, physical_resource_id):
+        self.physical_resource_id = physical_resource_id
+
+
+class FakeStack(object):
+    stack_id = STACK_ID
+    stack_name = 'vpn-1'
+    stack_status = 'UPDATE_COMPLETE'
+
+    def __init__(self, instance_id='i-0a1b2c3d4e5f60718', update_error=None):
+        self.instance_id = instance_id
+        self.update_error = update_error
+        self.parameters = [{'ParameterKey': 'EipDomain', 'ParameterValue': ''},
+                           {'ParameterKey': 'Domain', 'ParameterValue': 'example.com'}]
+        self.updates = []
+
+    def Resource(self, logical_id):
+        if self.instance_id is None:
+            raise KeyError('physical_resource_id')
+        return FakeResource(self.instance_id)
+
+    def update(self, **kwargs):
+        if self.update_error:
+            raise self.update_error
+        self.updates.append(kwargs)
+        return {'StackId': self.stack_id}
+
+
+@pytest.fixture
+def ssn(monkeypatch):
+    import SsnLambdaSnsTopicSubscriber
+
+    monkeypatch.setenv('CHANGE_IP_MODE', 'eip')
+    monkeypatch.delenv('CHANGE_IP_MARKER_PARAMETER', raising=False)
+    monkeypatch.setattr(SsnLambdaSnsTopicSubscriber.time, 'time', lambda: CLAIM['time'])
+    monkeypatch.setattr(SsnLambdaSnsTopicSubscriber.uuid, 'uuid4', lambda: CLAIM['id'])
+
+    clients = {name: boto3.client(name, region_name='us-east-1', aws_access_key_id='x', aws_secret_access_key='x')
+               for name in ['ec2', 'ssm']}
+    stubbers = {name: Stubber(client) for name, client in clients.items()}
+    monkeypatch.setattr(SsnLambdaSnsTopicSubscriber, 'get_client', lambda name: clients[name])
+    for stubber in stubbers.values():
+        stubber.activate()
+    SsnLambdaSnsTopicSubscriber.stubbers = stubbers
+    yield SsnLambdaSnsTopicSubscriber
+    for stubber in stubbers.values():
+        stubber.deactivate()
+
+
+def stub_lock(ssm):
+    ssm.add_response('put_parameter', {'Version': 1},
+                     {'Name': LOCK, 'Value': json.dumps(CLAIM), 'Type': 'String', 'Overwrite': False})
+
+
+def stub_claim(ssm):
+    stub_lock(ssm)
+    ssm.add_client_error('get_parameter', 'ParameterNotFound', expected_params={'Name': MARKER})
+    ssm.add_response('put_parameter', {'Version': 1},
+                     {'Name': MARKER, 'Value': json.dumps(CLAIM), 'Type': 'String', 'Overwrite': True})
+    ssm.add_response('delete_parameter', {}, {'Name': LOCK})
+
+
+def stub_get_claim(ssm):
+    ssm.add_response('get_parameter', {'Parameter': {'Name': MARKER, 'Value': json.dumps(CLAIM)}},
+                     {'Name': MARKER})
+
+
+def stub_release(ssm):
+    stub_get_claim(ssm)
+    ssm.add_response('delete_parameter', {}, {'Name': MARKER})
+
+
+def stub_allocate(ec2, previous=()):
+    ec2.add_response('describe_addresses', {'Addresses': list(previous)},
+                     {'Filters': [{'Name': 'tag:aws-cfn-vpn:stack-id', 'Values': [STACK_ID]}]})
+    ec2.add_response('allocate_address', {'AllocationId': 'eipalloc-new', 'PublicIp': '7.7.7.7'},
+                     {'Domain': 'vpc', 'TagSpecifications': ANY})
+
+
+def assert_no_pending(ssn):
+    for stubber in ssn.stubbers.values():
+        stubber.assert_no_pending_responses()
+
+
+def test_allocate_associate_release(ssn):
+    ec2, ssm = ssn.stubbers['ec2'], ssn.stubbers['ssm']
+    stub_claim(ssm)
+    stub_allocate(ec2, [{'AllocationId': 'eipalloc-old', 'PublicIp': '1.1.1.1'}])
+    ec2.add_response('associate_address', {'AssociationId': 'eipassoc-new'},
+                     {'AllocationId': 'eipalloc-new', 'InstanceId': 'i-0a1b2c3d4e5f60718', 'AllowReassociation': True})
+    ec2.add_response('release_address', {}, {'AllocationId': 'eipalloc-old'})
+
+    stack = FakeStack()
+    assert ssn.change_ip_once(stack) == {
+        'InstanceId': 'i-0a1b2c3d4e5f60718', 'PublicIp': '7.7.7.7', 'Released': ['1.1.1.1']}
+    assert stack.updates == []
+    assert_no_pending(ssn)
+
+
+def test_associate_failure_releases_and_falls_back(ssn):
+    ec2, ssm = ssn.stubbers['ec2'], ssn.stubbers['ssm']
+    stub_claim(ssm)
+    stub_allocate(ec2)
+    ec2.add_client_error('associate_address', 'InvalidInstanceID')
+    ec2.add_response('release_address', {}, {'AllocationId': 'eipalloc-new'})
+
+    stack = FakeStack()
+    assert ssn.change_ip_once(stack) == {'StackId': STACK_ID}
+    assert stack.updates[0]['Parameters'][0] == {
+        'ParameterKey': 'EipDomain', 'ParameterValue': 'vpc', 'UsePreviousValue': False}
+    assert_no_pending(ssn)
+
+
+def test_unexpected_error_falls_back(ssn):
+    ssm = ssn.stubbers['ssm']
+    stub_claim(ssm)
+
+    stack = FakeStack(instance_id=None)
+    assert ssn.change_ip_once(stack) == {'StackId': STACK_ID}
+    assert_no_pending(ssn)
+
+
+def test_fallback_failure_releases_marker(ssn):
+    ssm = ssn.stubbers['ssm']
+    stub_claim(ssm)
+    stub_release(ssm)
+
+    stack = FakeStack(instance_id=None, update_error=RuntimeError('boom'))
+    with pytest.raises(RuntimeError):
+        ssn.change_ip_once(stack)
+    assert_no_pending(ssn)
+
+
+def test_debounced(ssn):
+    ssm = ssn.stubbers['ssm']
+    stub_lock(ssm)
+    ssm.add_response('get_parameter', {'Parameter': {'Name': MARKER, 'Value': json.dumps(dict(CLAIM, time=990.0))}},
+                     {'Name': MARKER})
+    ssm.add_response('delete_parameter', {}, {'Name': LOCK})
+
+    assert ssn.change_ip_once(FakeStack()) is None
+    assert_no_pending(ssn)
+
+
+def test_locked_by_another_invocation(ssn):
+    ssm = ssn.stubbers['ssm']
+    ssm.add_client_error('put_parameter', 'ParameterAlreadyExists')
+    ssm.add_response('get_parameter', {'Parameter': {'Name': LOCK, 'Value': json.dumps(dict(CLAIM, time=999.0))}},
+                     {'Name': LOCK})
+
+    stack = FakeStack()
+    assert ssn.change_ip_once(stack) is None
+    assert stack.updates == []
+    assert_no_pending(ssn)
+
+
+def test_stale_lock_removed(ssn):
+    ssm = ssn.stubbers['ssm']
+    ssm.add_client_error('put_parameter', 'ParameterAlreadyExists')
+    ssm.add_response('get_parameter', {'Parameter': {'Name': LOCK, 'Value': json.dumps(dict(CLAIM, time=900.0))}},
+                     {'Name': LOCK})
+    ssm.add_response('delete_parameter', {}, {'Name': LOCK})
+
+    # the request removing the lock is skipped, the next one claims
+    assert ssn.change_ip_once(FakeStack()) is None
+    assert_no_pending(ssn)
+
+
+def test_lock_release_failure_keeps_claim(ssn):
+    ssm = ssn.stubbers['ssm']
+    stub_lock(ssm)
+    ssm.add_client_error('get_parameter', 'ParameterNotFound', expected_params={'Name': MARKER})
+    ssm.add_response('put_parameter', {'Version': 1},
+                     {'Name': MARKER, 'Value': json.dumps(CLAIM), 'Type': 'String', 'Overwrite': True})
+    ssm.add_client_error('delete_parameter', 'InternalServerError')
+
+    assert ssn.claim_marker(ssm.client, MARKER) == CLAIM
+    assert_no_pending(ssn)
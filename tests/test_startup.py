@@ -0,0 +1,30 @@
+import json
+import os
+
+import pytest
+
+import bench_startup
+from conftest import LAMBDAS_DIR
+
+NAMES = sorted(p[:-len('.py')] for p in os.listdir(LAMBDAS_DIR) if p.endswith('.py'))
+
+
+@pytest.fixture(scope='module')
+def budgets():
+    with open(bench_startup.BUDGET_FILE) as f:
+        return json.load(f)
+
+
+# the wall-clock budgets depend on the machine, they're left to bench_startup.py unless opted in
+STARTUP_TIMING = os.getenv('STARTUP_TIMING', '').lower() in ['1', 'true', 'yes']
+
+
+@pytest.mark.parametrize('name', NAMES)
+def test_startup_modules(name, budgets):
+    assert name in budgets, 'no budget for {}'.format(name)
+    assert name in bench_startup.SCENARIOS, 'no first invoke scenario for {}'.format(name)
+    budget = budgets[name]
+    if not STARTUP_TIMING:
+        budget = {k: v for k, v in budget.items() if k not in ['import_ms', 'first_invoke_ms']}
+    result = bench_startup.measure(name, runs=3 if STARTUP_TIMING else 1)
+    assert bench_startup.check(name, result, budget) == []
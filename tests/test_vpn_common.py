@@ -0,0 +1,100 @@
+import json
+import os
+import zipfile
+
+import pytest
+
+import vpn_common
+from conftest import LAMBDAS_DIR, LAYER_DIR
+
+
+def test_layer_package_is_up_to_date():
+    # the layer is deployed from the zip, re-create it after changing the module, see README
+    with zipfile.ZipFile(os.path.join(LAMBDAS_DIR, 'layers', 'LambdaLayerCommon.zip')) as zf:
+        packaged = zf.read('python/vpn_common.py')
+    with open(os.path.join(LAYER_DIR, 'vpn_common.py'), 'rb') as f:
+        assert packaged == f.read()
+
+
+def test_redact():
+    obj = {
+        'password': 'p',
+        'tags': [{'key': 'SecretKeyForUserSnsPublisher', 'value': 's'}, {'key': 'Name', 'value': 'vpn-0'}],
+        'cmd': 'LEXICON_NAMECOM_AUTH_TOKEN=xxx other',
+    }
+    assert vpn_common.redact(obj) == {
+        'password': '******',
+        'tags': [{'key': 'SecretKeyForUserSnsPublisher', 'value': '******'}, {'key': 'Name', 'value': 'vpn-0'}],
+        'cmd': 'LEXICON_NAMECOM_AUTH_TOKEN=****** other',
+    }
+
+
+def test_lazy_json_truncates(monkeypatch):
+    monkeypatch.setattr(vpn_common, 'LOG_MAX_LENGTH', 10)
+    text = str(vpn_common.LazyJson({'name': 'x' * 20}))
+    assert text.startswith(json.dumps({'name': 'x' * 20})[:10])
+    assert text.endswith('more chars)')
+
+
+def test_span_prints_emf(capsys):
+    with pytest.raises(ValueError):
+        with vpn_common.span('LambdaFoo', 'call', 'cid', Method='get'):
+            raise ValueError()
+    record = json.loads(capsys.readouterr().out)
+    assert (record['Service'], record['Span'], record['Method']) == ('LambdaFoo', 'call', 'get')
+    assert (record['Error'], record['CorrelationId']) == (1, 'cid')
+    assert record['_aws']['CloudWatchMetrics'][0]['Dimensions'] == [['Service', 'Span'], ['Service', 'Span', 'Method']]
+
+
+def test_circuit_breaker(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(vpn_common.time, 'time', lambda: now[0])
+    breaker = vpn_common.CircuitBreaker('test', threshold=2, reset_timeout=30)
+
+    for _ in range(2):
+        breaker.allow()
+        breaker.record_failure()
+    assert breaker.state == 'open'
+    with pytest.raises(vpn_common.CircuitOpenError):
+        breaker.allow()
+
+    # a single trial call passes after the reset timeout
+    now[0] += 31
+    breaker.allow()
+    assert breaker.state == 'half-open'
+    with pytest.raises(vpn_common.CircuitOpenError):
+        breaker.allow()
+    breaker.record_success()
+    assert breaker.state == 'closed'
+
+
+def test_split_members():
+    assert vpn_common.split_members(' 1.2.3.4, 5.6.7.8,,1.2.3.4 ') == ['1.2.3.4', '5.6.7.8']
+    assert vpn_common.split_members(None) == []
+
+
+def test_get_client_cached_by_config(monkeypatch):
+    monkeypatch.setattr(vpn_common, '_clients', {})
+    config = dict(read_timeout=15, retries={'mode': 'adaptive', 'max_attempts': 3})
+    client = vpn_common.get_client('lambda', 'us-east-1', config=config)
+    assert vpn_common.get_client('lambda', 'us-east-1', config=dict(config)) is client
+    assert client.meta.config.read_timeout == 15
+    assert vpn_common.get_client('lambda', 'us-east-1') is not client
+
+
+def test_invoke_ssm_transport(monkeypatch):
+    import LambdaLexBot
+    import LambdaSnsTopicSubscriber
+    import LambdaSsmApi
+
+    # both Lambdas call the API through the shared transport
+    assert LambdaLexBot.invoke_ssm is LambdaSnsTopicSubscriber.invoke_ssm is vpn_common.invoke_ssm
+
+    monkeypatch.setenv('SSM_TRANSPORT', 'memory')
+    LambdaSsmApi.get_memory_api().reset()
+    payload = {'resource': '/shadowsocks/node/', 'method': 'get'}
+    assert vpn_common.invoke_ssm(payload)['status_code'] == 200
+
+    monkeypatch.setenv('SSM_TRANSPORT', 'carrier-pigeon')
+    with pytest.raises(ValueError):
+        vpn_common.invoke_ssm(payload)